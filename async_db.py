@@ -0,0 +1,229 @@
+import asyncio
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+
+import db
+from repository import get_backend
+
+# همه‌ی کوئری‌ها روی تردهای جداگانه اجرا میشن تا event loop بلاک نشه
+# یک ترد برای هر reader به اضافه‌ی یک ترد برای writer
+_executor = None
+
+# اگه یک لیست [0.0] داخلش باشه، زمان صرف شده در دیتابیس برای همین
+# update به آن اضافه میشه (loadtest.py ازش استفاده میکنه)
+db_timer = contextvars.ContextVar("db_timer", default=None)
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=get_backend().get_pool_size() + 1, thread_name_prefix="otos-db"
+        )
+    return _executor
+
+
+async def run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    call = partial(func, *args, **kwargs)
+
+    timer = db_timer.get()
+    if timer is None:
+        return await loop.run_in_executor(get_executor(), call)
+
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(get_executor(), call)
+    finally:
+        timer[0] += time.perf_counter() - started
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+    get_backend().close()
+
+
+async def iterate(gen_func, *args, chunk_size=500, **kwargs):
+    # یک generator همگام از backend رو تکه تکه روی ترد دیتابیس میخونه
+    gen = await run(gen_func, *args, **kwargs)
+    try:
+        while True:
+            chunk = await run(lambda: list(islice(gen, chunk_size)))
+            if not chunk:
+                return
+            for item in chunk:
+                yield item
+    finally:
+        await run(gen.close)
+
+
+class WriteQueue:
+    # group commit: عملیات‌های نوشتنی چند میلی‌ثانیه (یا تا max_batch عملیات)
+    # جمع میشن و همه با یک تراکنش و یک fsync در apply_writes ثبت میشن
+    def __init__(self, max_delay=0.005, max_batch=64):
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._ops = []
+        self._full = asyncio.Event()
+        self._runner = None
+
+        self.batches = 0
+        self.ops = 0
+        self.max_batch_size = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def submit(self, name, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._ops.append((name, args, future, loop.time()))
+
+        if len(self._ops) >= self.max_batch:
+            self._full.set()
+        if self._runner is None:
+            # context جدا تا زمان کل دسته به حساب اولین درخواست‌دهنده نوشته نشه
+            self._runner = asyncio.create_task(
+                self._run(), context=contextvars.Context()
+            )
+
+        timer = db_timer.get()
+        if timer is None:
+            return await future
+
+        started = time.perf_counter()
+        try:
+            return await future
+        finally:
+            timer[0] += time.perf_counter() - started
+
+    async def _run(self):
+        try:
+            while self._ops:
+                if len(self._ops) < self.max_batch:
+                    try:
+                        await asyncio.wait_for(self._full.wait(), self.max_delay)
+                    except asyncio.TimeoutError:
+                        pass
+                self._full.clear()
+
+                batch = self._ops[: self.max_batch]
+                self._ops = self._ops[self.max_batch :]
+                await self._apply(batch)
+        finally:
+            self._runner = None
+
+    async def _apply(self, batch):
+        now = asyncio.get_running_loop().time()
+        for _, _, _, queued_at in batch:
+            wait = now - queued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+        self.batches += 1
+        self.ops += len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+
+        try:
+            results = await run(
+                get_backend().apply_writes, [(name, args) for name, args, _, _ in batch]
+            )
+        except Exception as e:
+            # خطا در commit؛ هیچ‌کدوم ثبت نشدن
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, _, future, _), (ok, result) in zip(batch, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "ops": self.ops,
+            "avg_batch": self.ops / self.batches if self.batches else 0,
+            "max_batch": self.max_batch_size,
+            "avg_wait_ms": self.total_wait / self.ops * 1000 if self.ops else 0,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+
+write_queue = WriteQueue()
+
+
+# توابع backend موقع صدا زدن پیدا میشن، پس DB_BACKEND تا اولین کوئری خونده نمیشه
+
+
+def _direct(name):
+    def wrapper(*args, **kwargs):
+        return getattr(get_backend(), name)(*args, **kwargs)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+def _wrap(name):
+    async def wrapper(*args, **kwargs):
+        return await run(getattr(get_backend(), name), *args, **kwargs)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+def _queued(name):
+    async def wrapper(*args):
+        return await write_queue.submit(name, *args)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+init_db = _wrap("init_db")
+get_user_by_telegram_id = _wrap("get_user_by_telegram_id")
+add_user = _wrap("add_user")
+add_task = _queued("add_task")
+add_tasks = _queued("add_tasks")
+get_user_tasks = _wrap("get_user_tasks")
+get_prev_tasks_cursor = _wrap("get_prev_tasks_cursor")
+delete_task = _queued("delete_task")
+mark_task_done = _queued("mark_task_done")
+get_all_users = _wrap("get_all_users")
+get_active_users = _wrap("get_active_users")
+set_user_active = _wrap("set_user_active")
+get_done_tasks_today = _wrap("get_done_tasks_today")
+get_user_count = _wrap("get_user_count")
+get_total_done_tasks = _wrap("get_total_done_tasks")
+get_stats = _wrap("get_stats")
+rebuild_stats = _wrap("rebuild_stats")
+get_user_done_tasks_today = _wrap("get_user_done_tasks_today")
+get_task_by_id = _wrap("get_task_by_id")
+count_users_done_between = _wrap("count_users_done_between")
+get_meta = _wrap("get_meta")
+get_top_users = _wrap("get_top_users")
+get_fsm_record = _wrap("get_fsm_record")
+save_fsm_records = _wrap("save_fsm_records")
+delete_expired_fsm_records = _wrap("delete_expired_fsm_records")
+get_user_position = _wrap("get_user_position")
+set_meta = _wrap("set_meta")
+expire_stale_tasks = _wrap("expire_stale_tasks")
+archive_tasks = _wrap("archive_tasks")
+optimize_db = _wrap("optimize_db")
+
+# generator ها (برای iterate) و توابع بدون I/O، نیازی به ترد ندارن
+iter_done_tasks_between = _direct("iter_done_tasks_between")
+iter_user_tasks = _direct("iter_user_tasks")
+get_user_cache_stats = _direct("get_user_cache_stats")
+forget_users = _direct("forget_users")
+get_rank = db.get_rank
@@ -0,0 +1,261 @@
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import db
+
+# python bench.py --users 10000 --tasks 1000000 --json bench.json
+# python bench.py --db big.db --reuse --users 1000000 --tasks 50000000
+# python bench.py --db big.db --reuse --baseline bench.json
+
+DONE_RATIO = 0.7
+EXPIRED_RATIO = 0.05
+HISTORY_DAYS = 180
+BATCH = 50000
+
+
+def generate(path, users, tasks, seed):
+    # داده‌ی مصنوعی: چند کاربر پرکار و تعداد زیادی کاربر کم‌کار
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+
+    def timestamp(moment):
+        return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+    def user_rows():
+        for i in range(1, users + 1):
+            joined = now - timedelta(days=rng.random() * HISTORY_DAYS * 2)
+            yield i, 100_000_000 + i, f"user{i}", rng.randrange(0, 3000), timestamp(
+                joined
+            )
+
+    def task_rows():
+        for _ in range(tasks):
+            user_id = int(users * rng.random() ** 2) + 1
+            created = now - timedelta(days=rng.random() * HISTORY_DAYS)
+            roll = rng.random()
+            is_done = roll < DONE_RATIO
+            is_expired = not is_done and roll > 1 - EXPIRED_RATIO
+            done_date = None
+            if is_done:
+                done = min(now, created + timedelta(hours=rng.random() * 48))
+                done_date = timestamp(done)
+            yield (
+                user_id,
+                "task",
+                "نامشخص",
+                rng.randint(1, 3),
+                timestamp(created),
+                int(is_done),
+                done_date,
+                int(is_expired),
+            )
+
+    db.DB_NAME = path
+    db.create_users_table()
+    db.create_tasks_table()
+    db.close()
+
+    def insert(sql, rows):
+        while True:
+            chunk = [row for _, row in zip(range(BATCH), rows)]
+            if not chunk:
+                break
+            conn.executemany(sql, chunk)
+            conn.commit()
+
+    insert(
+        "INSERT INTO users (id, telegram_id, full_name, score, join_date)"
+        " VALUES (?, ?, ?, ?, ?)",
+        user_rows(),
+    )
+    insert(
+        "INSERT INTO tasks (user_id, title, category, priority, created_at,"
+        " is_done, done_date, is_expired) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        task_rows(),
+    )
+    conn.close()
+
+    # ایندکس‌ها بعد از درج داده ساخته میشن (سریعتر)
+    db.init_db()
+    with db.writer() as conn:
+        conn.execute("ANALYZE")
+
+
+def sample_users(users, count, rng):
+    return [100_000_000 + int(users * rng.random() ** 2) + 1 for _ in range(count)]
+
+
+def sample_pending_tasks(count):
+    with db.reader() as conn:
+        return conn.execute(
+            """
+            SELECT t.id, u.telegram_id
+            FROM tasks t
+            JOIN users u ON t.user_id = u.id
+            WHERE t.is_done = 0 AND t.is_expired = 0
+              AND t.created_at <= DATETIME('now', '-30 minutes')
+            ORDER BY RANDOM()
+            LIMIT ?
+        """,
+            (count,),
+        ).fetchall()
+
+
+def reset_caches():
+    # شروع سرد: کانکشن‌های تازه و کش‌های خالی داخل برنامه
+    db.close()
+    db.user_cache.clear()
+    db.leaderboard_cache.clear()
+
+
+def measure(func, calls, cold):
+    if cold:
+        reset_caches()
+
+    timings = []
+    for args in calls:
+        started = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - started)
+
+    timings.sort()
+    return {
+        "calls": len(timings),
+        "mean_ms": statistics.fmean(timings) * 1000,
+        "p50_ms": timings[len(timings) // 2] * 1000,
+        "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000,
+        "max_ms": timings[-1] * 1000,
+    }
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="otos-bench-"), "otos.db")
+
+    if not (args.reuse and os.path.exists(path)):
+        if os.path.exists(path):
+            os.remove(path)
+        started = time.perf_counter()
+        generate(path, args.users, args.tasks, args.seed)
+        print(
+            f"generated {args.users} users / {args.tasks} tasks in "
+            f"{time.perf_counter() - started:.1f}s -> {path}"
+        )
+
+    db.DB_NAME = path
+    db.init_db()
+
+    with db.reader() as conn:
+        users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        tasks = conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+    n = args.iterations
+    user_calls = [(u,) for u in sample_users(users, n, rng)]
+    pending = sample_pending_tasks(n * 2)
+
+    benchmarks = {
+        "get_user_tasks": (db.get_user_tasks, user_calls),
+        "get_user_tasks_page": (
+            lambda u: db.get_user_tasks(u, after_id=0, limit=11),
+            user_calls,
+        ),
+        "get_done_tasks_today": (db.get_done_tasks_today, user_calls),
+        "get_user_done_tasks_today": (db.get_user_done_tasks_today, user_calls),
+        "get_total_done_tasks": (db.get_total_done_tasks, [()] * max(1, n // 10)),
+        "get_all_users": (db.get_all_users, [()] * max(1, n // 100)),
+        "mark_task_done": (db.mark_task_done, pending[:n]),
+    }
+
+    results = {}
+    for name, (func, calls) in benchmarks.items():
+        if not calls:
+            continue
+        if name == "mark_task_done":
+            # هر فراخوانی یک تسک رو مصرف میکنه، پس گرم و سرد تسک‌های جدا دارن
+            cold = measure(func, pending[n : n + 1], cold=True)
+            warm = measure(func, calls, cold=False)
+        else:
+            cold = measure(func, calls[:1], cold=True)
+            warm = measure(func, calls, cold=False)
+        results[name] = {"cold_ms": cold["max_ms"], "warm": warm}
+
+    db.close()
+    return {
+        "config": {
+            "users": users,
+            "tasks": tasks,
+            "iterations": n,
+            "seed": args.seed,
+            "sqlite": sqlite3.sqlite_version,
+        },
+        "results": results,
+    }
+
+
+def print_report(report, baseline=None):
+    config = report["config"]
+    print(
+        f"users: {config['users']}  tasks: {config['tasks']}  "
+        f"sqlite: {config['sqlite']}"
+    )
+    print(
+        f"{'function':<28} {'cold ms':>10} {'mean ms':>10} {'p50 ms':>10} "
+        f"{'p95 ms':>10} {'vs base':>9}"
+    )
+
+    for name, result in report["results"].items():
+        warm = result["warm"]
+        change = ""
+        if baseline and name in baseline.get("results", {}):
+            old = baseline["results"][name]["warm"]["mean_ms"]
+            if old:
+                change = f"{(warm['mean_ms'] - old) / old * 100:+.1f}%"
+        print(
+            f"{name:<28} {result['cold_ms']:>10.3f} {warm['mean_ms']:>10.3f} "
+            f"{warm['p50_ms']:>10.3f} {warm['p95_ms']:>10.3f} {change:>9}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="db.py micro-benchmarks")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--tasks", type=int, default=1_000_000)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="database file (default: a temp file)")
+    parser.add_argument(
+        "--reuse", action="store_true", help="reuse --db if it already exists"
+    )
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--baseline", help="compare with a previous --json report")
+    args = parser.parse_args()
+
+    report = run(args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print_report(report, baseline)
+    print(json.dumps(report, indent=2))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,66 +1,111 @@
 import asyncio
+import csv
+import json
 import os
+import tempfile
 from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, CallbackQuery
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Message, CallbackQuery, FSInputFile
 from aiogram.filters import Command, CommandStart
 from dotenv import load_dotenv
-from db import init_db
+from repository import get_backend
+from models import Task
 from utils import START_MENU, HELP_MENU, GET_NAME_TEXT
-from utils import main_menu_keyboard, tasks_keyboard
+from utils import main_menu_keyboard, daily_report_text
+from utils import TASKS_PAGE_SIZE, TaskPagesCache
+from utils import EXPORT_FIELDS, export_record
+from utils import PRIORITY_MAP, TASK_ERRORS
+from utils import parse_task, split_task_blocks
+from utils import parse_task_blocks, bulk_task_text
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from db import get_user_by_telegram_id, add_user, get_all_users
-from db import add_task, get_user_tasks, delete_task, mark_task_done
-from db import get_done_tasks_today, get_user_count, get_rank, get_total_done_tasks
-from db import get_task_by_id, get_user_done_tasks_today
+from async_db import get_user_by_telegram_id, add_user
+from async_db import add_task, get_user_tasks, delete_task, mark_task_done
+from async_db import add_tasks
+from async_db import get_prev_tasks_cursor
+from async_db import get_done_tasks_today, get_rank
+from async_db import get_stats, rebuild_stats, get_task_by_id
+from async_db import get_active_users, set_user_active, iterate
+from async_db import get_top_users, get_user_position
+from async_db import iter_done_tasks_between, iter_user_tasks
+from async_db import get_user_cache_stats, forget_users
+from invalidation import invalidator
+from profiler import profiler
+from broadcast import Broadcaster
+from scheduler import DailyReportScheduler
+from maintenance import Maintenance
+from webhook import run_webhook
+from fsm_storage import SQLiteStorage
+import async_db
+import metrics
+import throttling
 
 # from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 
-# from apscheduler.schedulers.asyncio import AsyncIOScheduler
-
-
-init_db()
 load_dotenv()
+get_backend().init_db()
 
 API_KEY = os.getenv("API_KEY")
 ADMIN = int(os.getenv("ADMIN"))
-bot = Bot(API_KEY)
-dp = Dispatcher()
-
-
-class RegisterState(StatesGroup):
-    waiting_for_name = State()
-
-
-# async def daily_job(bot):
-#     # today_str = date.today().isoformat()
-#     today_str = now_tehran.date().isoformat()
-
-#     users = get_all_users()
-
-#     for telegram_id in users:
-#         tasks = get_user_done_tasks_today(telegram_id)
+DAILY_REPORT = os.getenv("DAILY_REPORT", "on") != "off"
+REPORT_TIME = os.getenv("REPORT_TIME", "23:30")
+REPORT_TZ = os.getenv("REPORT_TZ", "Asia/Tehran")
+REPORT_WINDOW = int(os.getenv("REPORT_WINDOW", 30 * 60))
+REPORT_BATCH = int(os.getenv("REPORT_BATCH", 200))
+TOP_USERS = int(os.getenv("TOP_USERS", 10))
+async_db.write_queue.max_delay = float(os.getenv("WRITE_BATCH_DELAY", 0.005))
+async_db.write_queue.max_batch = int(os.getenv("WRITE_BATCH_SIZE", 64))
+MAINTENANCE = os.getenv("MAINTENANCE", "on") != "off"
+EXPIRE_DAYS = int(os.getenv("EXPIRE_DAYS", 30))
+ARCHIVE_DAYS = int(os.getenv("ARCHIVE_DAYS", 90))
+MAINTENANCE_INTERVAL = int(os.getenv("MAINTENANCE_INTERVAL", 10 * 60))
+QUIET_HOURS = os.getenv("QUIET_HOURS", "03:00-05:00")
+THROTTLE = os.getenv("THROTTLE", "on") != "off"
+THROTTLE_READ_RATE = float(os.getenv("THROTTLE_READ_RATE", 3))
+THROTTLE_READ_BURST = int(os.getenv("THROTTLE_READ_BURST", 10))
+THROTTLE_WRITE_RATE = float(os.getenv("THROTTLE_WRITE_RATE", 1))
+THROTTLE_WRITE_BURST = int(os.getenv("THROTTLE_WRITE_BURST", 5))
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+# با supervisor.py: شماره‌ی این worker، تعداد worker ها و پورت worker صفر
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+WORKERS = int(os.getenv("WORKERS", 1))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", 0))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+DB_PROFILE_FILE = os.getenv("DB_PROFILE_FILE", "db_profile.json")
+# سرور Bot API دیگه (مثلا سرور محلی یا سرور جعلی loadtest.py)
+BOT_API_URL = os.getenv("BOT_API_URL")
+if BOT_API_URL:
+    bot = Bot(
+        API_KEY,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)),
+    )
+else:
+    bot = Bot(API_KEY)
+dp = Dispatcher(storage=SQLiteStorage())
 
-#         if not tasks:
-#             continue
 
-#         task_lines = [f"✅ {task['title']}" for task in tasks]
-#         total_smiles = sum(task["priority"] for task in tasks)
+task_pages = TaskPagesCache()
+throttler = None
 
-#         message_text = (
-#             f"🗒 گزارش امروز: {today_str}\n\n"
-#             + "\n".join(task_lines)
-#             + f"\n\n🙂 تعداد لبخندهای امروز: {total_smiles}"
-#         )
 
-#         try:
-#             await bot.send_message(chat_id=telegram_id, text=message_text)
-#         except Exception as e:
-#             print(f"Error in sending message to {telegram_id}: {e}")
+class RegisterState(StatesGroup):
+    waiting_for_name = State()
 
 
 async def start_handler(pm: Message):
+    user = await get_user_by_telegram_id(pm.from_user.id)
+    # کاربری که قبلا بات رو بلاک کرده بود و برگشته
+    if user and not user.is_active:
+        await set_user_active(pm.from_user.id, True)
+
     await pm.answer(START_MENU, reply_markup=main_menu_keyboard())
 
 
@@ -75,7 +120,7 @@ async def help_handler(pm: Message):
 async def register_handler(message: Message, state: FSMContext):
     telegram_id = message.from_user.id
 
-    user = get_user_by_telegram_id(telegram_id)
+    user = await get_user_by_telegram_id(telegram_id)
 
     if user:
         await message.answer("شما قبلا ثبت نام کردی!")
@@ -88,69 +133,68 @@ async def register_name_handler(message: Message, state: FSMContext):
     name = message.text.strip()
     telegram_id = message.from_user.id
 
-    add_user(telegram_id, name)
+    await add_user(telegram_id, name)
 
     await message.answer("اکانت شما ساخته شد ✅", reply_markup=main_menu_keyboard())
     await state.clear()
 
 
 async def task_handler(message: Message):
-    user = get_user_by_telegram_id(message.from_user.id)
+    user = await get_user_by_telegram_id(message.from_user.id)
     if not user:
         return
 
     if not message.text:
         return
 
-    lines = [l.strip() for l in message.text.strip().splitlines() if l.strip()]
-
-    # ❗ فقط دو حالت مجاز: 2 خط یا 3 خط
-    if len(lines) not in (2, 3):
-        await message.answer(
-            "فرمت درست:\n\n"
-            "تیتر\n#دسته‌بندی (اختیاری)\nعدد اولویت (1 تا 3)\n\n"
-            "یا بدون دسته‌بندی:\nتیتر\nعدد اولویت"
-        )
+    blocks = split_task_blocks(message.text)
+    if not blocks:
         return
 
-    title = lines[0]
+    # چند کار در یک پیام (با خط خالی بینشون) → یک تراکنش برای همه
+    if len(blocks) > 1:
+        await bulk_task_handler(message, blocks)
+        return
 
-    # 🔹 اگر 2 خط بود → دسته‌بندی نامشخص
-    if len(lines) == 2:
-        category = "نامشخص"
-        priority_num = lines[1]
+    # ❗ فقط دو حالت مجاز: 2 خط یا 3 خط (دسته‌بندی با یک هشتگ اختیاری است)
+    task, error = parse_task(blocks[0])
+    if error:
+        await message.answer(TASK_ERRORS[error])
+        return
 
-    # 🔹 اگر 3 خط بود → بررسی هشتگ
-    else:
-        category_line = lines[1]
-        priority_num = lines[2]
+    title, category, priority_num = task
+    priority_text = PRIORITY_MAP[priority_num]
 
-        hashtags = [word for word in category_line.split() if word.startswith("#")]
+    task_id = await add_task(message.from_user.id, title, category, priority_num)
 
-        if len(hashtags) != 1:
-            await message.answer(
-                "اگر دسته‌بندی می‌نویسی باید دقیقا یک هشتگ باشد\nمثال:\n#کدنویسی"
-            )
-            return
+    if not task_id:
+        await message.answer("خطا: کاربر پیدا نشد. لطفا ابتدا /start بزنید.")
+        return
 
-        category = hashtags[0][1:]
+    task_pages.add_task(
+        message.from_user.id,
+        Task(id=task_id, title=title, category=category, priority=int(priority_num)),
+    )
 
-    # ✅ اعتبارسنجی اولویت
-    priority_map = {"1": "معمولی", "2": "مهم", "3": "فوری"}
-    if priority_num not in priority_map:
-        await message.answer("عدد اولویت باید 1، 2 یا 3 باشد")
-        return
+    await message.answer(
+        f"کار شما با دسته‌بندی {category} و اولویت {priority_text} ثبت شد ✅",
+        reply_markup=main_menu_keyboard(),
+    )
 
-    priority_text = priority_map[priority_num]
 
-    success = add_task(message.from_user.id, title, category, priority_num)
+async def bulk_task_handler(message: Message, blocks):
+    tasks, rejected = parse_task_blocks(blocks)
 
-    if not success:
-        await message.answer("خطا: کاربر پیدا نشد. لطفا ابتدا /start بزنید.")
-        return
+    count = 0
+    if tasks:
+        count = await add_tasks(message.from_user.id, tasks)
+        if count is False:
+            await message.answer("خطا: کاربر پیدا نشد. لطفا ابتدا /start بزنید.")
+            return
+        task_pages.invalidate(message.from_user.id)
 
     await message.answer(
-        f"کار شما با دسته‌بندی {category} و اولویت {priority_text} ثبت شد ✅",
+        bulk_task_text(count, len(blocks), rejected),
         reply_markup=main_menu_keyboard(),
     )
 
@@ -198,36 +242,78 @@ async def task_handler(message: Message):
 #         )
 
 
+def forget_cached_users(telegram_ids):
+    # تسک‌ها یا ردیف این کاربرها جای دیگه‌ای عوض شده (invalidation.py) و
+    # صفحه‌ها و ردیف کش شده‌شون دیگه معتبر نیست
+    for telegram_id in telegram_ids:
+        task_pages.invalidate(telegram_id)
+    forget_users(telegram_ids)
+
+
+async def get_tasks_page(telegram_id, cursor=0, prev_cursor=None):
+    page = task_pages.get(telegram_id, cursor)
+    if page:
+        return page
+
+    # اگه وسط کوئری تسکی اضافه/حذف بشه، این صفحه کش نمیشه
+    generation = task_pages.generation(telegram_id)
+    tasks = await get_user_tasks(
+        telegram_id, only_pending=True, after_id=cursor, limit=TASKS_PAGE_SIZE + 1
+    )
+
+    # اگه صفحه خالی شده (مثلا آخرین تسکش انجام شده) برو صفحه‌ی قبل
+    if not tasks and cursor:
+        cursor = await get_prev_tasks_cursor(telegram_id, cursor, TASKS_PAGE_SIZE)
+        prev_cursor = None
+        tasks = await get_user_tasks(
+            telegram_id, only_pending=True, after_id=cursor, limit=TASKS_PAGE_SIZE + 1
+        )
+
+    if not tasks:
+        return None
+
+    has_next = len(tasks) > TASKS_PAGE_SIZE
+    return task_pages.set(
+        telegram_id,
+        cursor,
+        tasks[:TASKS_PAGE_SIZE],
+        has_next,
+        prev_cursor,
+        generation=generation,
+    )
+
+
 async def tasks_handler(message: Message):
     telegram_id = message.from_user.id
 
-    user = get_user_by_telegram_id(telegram_id)
+    user = await get_user_by_telegram_id(telegram_id)
     if not user:
         await message.answer("ابتدا /start بزن و ثبت نام کن 😅")
         return
 
-    tasks = get_user_tasks(telegram_id, only_pending=True)
-    if not tasks:
+    page = await get_tasks_page(telegram_id)
+    if not page:
         await message.answer("هیچ تسک انجام‌نشده‌ای پیدا نشد ✅")
         return
 
     text = "کارهای انجام نشده 👇"
 
-    await message.answer(text, reply_markup=tasks_keyboard(tasks))
+    await message.answer(text, reply_markup=page["markup"])
 
 
 async def profile_handler(message: Message):
     telegram_id = message.from_user.id
 
-    user = get_user_by_telegram_id(telegram_id)
+    user = await get_user_by_telegram_id(telegram_id)
     if not user:
         await message.answer("ابتدا /start بزن و ثبت نام کن 😅")
         return
 
-    full_name = user[2]
-    join_date_str = user[4]
-    score = user[3]
+    full_name = user.full_name
+    join_date_str = user.join_date
+    score = user.score
     rank = get_rank(score)
+    position, total_users = await get_user_position(telegram_id)
 
     join_date = datetime.strptime(join_date_str, "%Y-%m-%d %H:%M:%S")
     days_passed = (datetime.now() - join_date).days
@@ -236,10 +322,71 @@ async def profile_handler(message: Message):
         f"👤 اسم شما: {full_name}\n"
         f"📅 تاریخ عضویت: {join_date} ({days_passed} روز پیش)\n"
         f"⭐ امتیاز: {score}\n"
-        f"🔰 لقب شما: {rank}"
+        f"🔰 لقب شما: {rank}\n"
+        f"🏆 رتبه‌ی شما: {position} از {total_users}"
     )
 
 
+async def export_handler(message: Message):
+    telegram_id = message.from_user.id
+
+    user = await get_user_by_telegram_id(telegram_id)
+    if not user:
+        await message.answer("ابتدا /start بزن و ثبت نام کن 😅")
+        return
+
+    # /export  یا  /export json
+    fmt = "jsonl" if message.text[len("/export") :].strip() == "json" else "csv"
+
+    # ردیف‌ها تکه تکه از دیتابیس خونده و مستقیم در فایل نوشته میشن
+    # پس حافظه به اندازه‌ی تاریخچه‌ی کاربر بزرگ نمیشه
+    fd, path = tempfile.mkstemp(prefix="otos-export-", suffix=f".{fmt}")
+    count = 0
+    try:
+        with open(fd, "w", encoding="utf-8-sig" if fmt == "csv" else "utf-8") as f:
+            if fmt == "csv":
+                out = csv.DictWriter(f, fieldnames=EXPORT_FIELDS)
+                out.writeheader()
+
+            async for task in iterate(iter_user_tasks, telegram_id):
+                record = export_record(task)
+                if fmt == "csv":
+                    out.writerow(record)
+                else:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                count += 1
+
+        if not count:
+            await message.answer("هنوز هیچ کاری ثبت نکردی 🙂")
+            return
+
+        await message.answer_document(
+            FSInputFile(path, filename=f"otos-tasks.{fmt}"),
+            caption=f"📦 {count} کار",
+        )
+    finally:
+        os.remove(path)
+
+
+async def top_handler(message: Message):
+    top = await get_top_users(TOP_USERS)
+    if not top:
+        await message.answer("هنوز کسی توی رتبه‌بندی نیست 🙂")
+        return
+
+    lines = [
+        f"{i}. {user.full_name} - ⭐ {user.score}"
+        for i, user in enumerate(top, start=1)
+    ]
+    text = "🏆 برترین‌ها\n\n" + "\n".join(lines)
+
+    position, total_users = await get_user_position(message.from_user.id)
+    if position:
+        text += f"\n\n📍 رتبه‌ی شما: {position} از {total_users}"
+
+    await message.answer(text, reply_markup=main_menu_keyboard())
+
+
 # async def task_callback_handler(callback: CallbackQuery):
 #     data = callback.data
 #     action, task_id_str = data.split(":")
@@ -269,19 +416,38 @@ async def task_callback_handler(callback: CallbackQuery):
     data = callback.data
 
     # چون تو utils این فرمت رو داریم:
-    # task_done_12
-    # task_delete_12
-    # task_open_12
-
-    _, action, task_id_str = data.split("_")
-    task_id = int(task_id_str)
+    # task_done_12_0
+    # task_delete_12_0
+    # task_open_12_0
+    # task_next_12_0 / task_prev_12
+    # (عدد آخر cursor صفحه است؛ پیام‌های قدیمی بدون cursor هستن)
+
+    parts = data.split("_")
+    action = parts[1]
+    task_id = int(parts[2])
+    cursor = int(parts[3]) if len(parts) > 3 else 0
+    prev_cursor = None
 
     telegram_id = callback.from_user.id
 
-    if action == "delete":
-        success = delete_task(task_id, telegram_id)
+    if action == "next":
+        await callback.answer()
+        prev_cursor = cursor
+        cursor = task_id
+
+    elif action == "prev":
+        await callback.answer()
+        current = task_pages.get(telegram_id, task_id)
+        if current and current["prev"] is not None:
+            cursor = current["prev"]
+        else:
+            cursor = await get_prev_tasks_cursor(telegram_id, task_id, TASKS_PAGE_SIZE)
+
+    elif action == "delete":
+        success = await delete_task(task_id, telegram_id)
 
         if success:
+            task_pages.remove_task(telegram_id, task_id)
             await callback.answer(
                 "🗑️ تسک حذف شد\n2 امتیاز از شما کم شد", show_alert=True
             )
@@ -290,29 +456,40 @@ async def task_callback_handler(callback: CallbackQuery):
             return
 
     elif action == "done":
-        success, msg = mark_task_done(task_id)
+        success, msg = await mark_task_done(task_id, telegram_id)
+        if success:
+            task_pages.remove_task(telegram_id, task_id)
         await callback.answer(msg, show_alert=True)
 
         if not success:
             return
 
     elif action == "open":
-        task = get_task_by_id(task_id)  # یه تابع ساده که title رو برگردونه
+        page = task_pages.get(telegram_id, cursor)
+        task = None
+        if page:
+            task = next((t for t in page["tasks"] if t.id == task_id), None)
+        if task is None:
+            task = await get_task_by_id(task_id)  # یه تابع ساده که title رو برگردونه
+
         if task:
-            await callback.answer(task["title"])  # toast
+            await callback.answer(task.title)  # toast
         else:
             await callback.answer("تسک پیدا نشد", show_alert=True)
 
-    # ✅ گرفتن لیست جدید بعد از تغییر
-    tasks = get_user_tasks(telegram_id, only_pending=True)
+        # چیزی تغییر نکرده، پیام رو دوباره ویرایش نمیکنیم
+        return
 
-    if not tasks:
+    # ✅ گرفتن همین صفحه بعد از تغییر (از کش اگه باشه)
+    page = await get_tasks_page(telegram_id, cursor, prev_cursor)
+
+    if not page:
         await callback.message.edit_text("هیچ تسک انجام‌نشده‌ای باقی نمانده 🎉")
         return
 
     # ✅ ریفرش پیام
     await callback.message.edit_text(
-        "کارهای انجام نشده 👇", reply_markup=tasks_keyboard(tasks)
+        "کارهای انجام نشده 👇", reply_markup=page["markup"]
     )
 
 
@@ -326,22 +503,37 @@ async def send_handler(message: Message):
         await message.answer("❌ لطفا متن پیام را بعد از /send وارد کنید")
         return
 
-    users = get_all_users()
-    count = 0
-    for user_id in users:
-        try:
-            await message.bot.send_message(chat_id=user_id, text=text)
-            count += 1
-        except:
-            pass
+    users = await get_active_users()
+    status = await message.answer(f"⏳ ارسال پیام به {len(users)} کاربر شروع شد")
+
+    last_progress = [None]
+
+    async def on_progress(result):
+        progress = (
+            f"⏳ ارسال شده: {result.sent} | ناموفق: {result.failed} | "
+            f"بلاک: {result.blocked} (از {len(users)})"
+        )
+        # تلگرام ویرایش بدون تغییر رو قبول نمیکنه
+        if progress != last_progress[0]:
+            last_progress[0] = progress
+            await status.edit_text(progress)
 
-    await message.answer(f"✅ پیام به {count} کاربر ارسال شد")
+    result = await Broadcaster(message.bot).run(
+        ((user_id, text) for user_id in users), on_progress=on_progress
+    )
+
+    await message.answer(
+        f"✅ پیام به {result.sent} کاربر ارسال شد\n"
+        f"❌ ناموفق: {result.failed}\n"
+        f"🚫 بات را بلاک کرده‌اند: {result.blocked}\n"
+        f"⏱ زمان: {int(result.elapsed)} ثانیه"
+    )
 
 
 async def today_handler(message: Message):
     telegram_id = message.from_user.id
 
-    tasks, total_smiles = get_done_tasks_today(telegram_id)
+    tasks, total_smiles = await get_done_tasks_today(telegram_id)
 
     today_str = datetime.now().strftime("%Y-%m-%d")
 
@@ -367,65 +559,150 @@ async def log_handler(message: Message):
         await message.answer("❌ فقط ادمین می‌تواند این فرمان را استفاده کند")
         return
 
-    user_count = get_user_count()
-    done_count = get_total_done_tasks()
+    stats = await get_stats()
+    cache_stats = get_user_cache_stats()
+    # backend حافظه کش کاربر نداره
+    cache_line = "—"
+    if cache_stats:
+        cache_line = (
+            f"{cache_stats['size']}/{cache_stats['maxsize']} "
+            f"(hit: {cache_stats['hits']}, miss: {cache_stats['misses']})"
+        )
+    write_stats = async_db.write_queue.stats()
+    api_stats = metrics.registry.api_stats()
+    throttle_line = "خاموش"
+    if throttler:
+        throttle_stats = throttler.stats()
+        throttle_line = (
+            f"خواندن {throttle_stats['read']}، نوشتن {throttle_stats['write']} "
+            f"({throttle_stats['buckets']} bucket)"
+        )
+    handler_lines = "\n".join(
+        f"            • {s['handler']}: {s['count']} (خطا {s['errors']}، میانگین {s['avg_ms']:.1f}ms، p95 ≤ {s['p95_ms']:g}ms)"
+        for s in metrics.registry.handler_stats()[:5]
+    )
 
     await message.answer(
         f"""
             📊 آمار بات
 
-            👤 تعداد کاربران: {user_count}
-            ✅ کل کارهای انجام شده: {done_count}
+            👤 تعداد کاربران: {stats.users}
+            ✅ کل کارهای انجام شده: {stats.done_tasks}
+            ⏳ کارهای انجام نشده: {stats.pending_tasks}
+            🆕 کارهای ثبت شده‌ی امروز: {stats.tasks_created_today}
+            ☑️ کارهای انجام شده‌ی امروز: {stats.tasks_done_today}
+            🔥 کاربران فعال امروز: {stats.active_users_today}
+            🗃 کش کاربران: {cache_line}
+            ✍️ دسته‌های نوشتن: {write_stats['batches']} (میانگین {write_stats['avg_batch']:.1f}، بیشترین {write_stats['max_batch']}، انتظار {write_stats['avg_wait_ms']:.1f}ms / {write_stats['max_wait_ms']:.1f}ms)
+            🚦 درخواست‌های محدود شده: {throttle_line}
+            📡 Bot API: {api_stats['calls']} درخواست (میانگین {api_stats['avg_ms']:.1f}ms، خطا {api_stats['errors']}، 429: {api_stats['retry_after']})
+            ⏱ هندلرها:
+{handler_lines}
             """
     )
 
 
-async def send_log_handler(message: Message):
+async def rebuild_stats_handler(message: Message):
+    if message.from_user.id != ADMIN:
+        await message.answer("⛔ شما دسترسی ندارید")
+        return
+
+    stats = await rebuild_stats()
+    await message.answer(
+        f"✅ آمار دوباره حساب شد\n"
+        f"کاربران: {stats.users} | انجام شده: {stats.done_tasks} | "
+        f"انجام نشده: {stats.pending_tasks}"
+    )
+
+
+async def db_profile_handler(message: Message):
     if message.from_user.id != ADMIN:
         await message.answer("⛔ شما دسترسی ندارید")
         return
 
-    today_str = date.today().isoformat()
-    users = get_all_users()
+    if not profiler.enabled:
+        await message.answer("پروفایلر دیتابیس خاموش است (DB_PROFILE=on)")
+        return
 
-    sent_count = 0
+    # /db_profile reset  یا  /db_profile dump
+    action = message.text[len("/db_profile") :].strip()
 
-    for telegram_id in users:
-        tasks = get_user_done_tasks_today(telegram_id)
+    if action == "reset":
+        profiler.reset()
+        await message.answer("✅ آمار کوئری‌ها پاک شد")
+        return
 
-        if not tasks:
-            continue
+    if action == "dump":
+        path = profiler.dump(DB_PROFILE_FILE)
+        await message.answer_document(FSInputFile(path))
+        return
 
-        task_lines = [f"✅ {task['title']}" for task in tasks]
-        total_smiles = sum(task["priority"] for task in tasks)
+    top = profiler.top(limit=5)
+    if not top:
+        await message.answer("هنوز کوئری‌ای ثبت نشده")
+        return
 
-        text = (
-            f"خسته نباشید 🌱\n\n"
-            f"🗒 گزارش امروز: {today_str}\n\n"
-            + "\n".join(task_lines)
-            + f"\n\n🙂 تعداد لبخندهای امروز: {total_smiles}"
-        )
+    lines = [
+        f"{q['total_ms']:.0f}ms | {q['count']}x | avg {q['avg_ms']:.2f}ms | "
+        f"max {q['max_ms']:.1f}ms | slow {q['slow']}\n{q['sql'][:200]}"
+        for q in top
+    ]
+    await message.answer(
+        f"🐢 کوئری‌های کند (بیشتر از {profiler.slow_ms:g}ms): {len(profiler.slow)}\n\n"
+        + "\n\n".join(lines)
+    )
+
+
+async def send_log_handler(message: Message):
+    if message.from_user.id != ADMIN:
+        await message.answer("⛔ شما دسترسی ندارید")
+        return
 
-        try:
-            await bot.send_message(chat_id=telegram_id, text=text)
-            sent_count += 1
-        except Exception as e:
-            print(f"Error sending to {telegram_id}: {e}")
+    today = date.today()
+    today_str = today.isoformat()
+    start, end = today_str, (today + timedelta(days=1)).isoformat()
+
+    async def reports():
+        # مثل DailyReportScheduler صفحه به صفحه؛ هر صفحه قبل از ارسال کامل
+        # خونده میشه تا reader در طول ارسال پیام‌ها نگه داشته نشه
+        after_id = 0
+        while True:
+            batch = [
+                row
+                async for row in iterate(
+                    iter_done_tasks_between, start, end, after_id, limit=REPORT_BATCH
+                )
+            ]
+            if not batch:
+                return
+
+            for telegram_id, titles, total_smiles in batch:
+                yield telegram_id, daily_report_text(today_str, titles, total_smiles)
+            after_id = batch[-1][0]
+
+    result = await Broadcaster(message.bot).run(reports())
 
-    await message.answer(f"✅ log for {sent_count} user sent")
+    await message.answer(
+        f"✅ log for {result.sent} user sent\n"
+        f"failed: {result.failed}, blocked: {result.blocked}"
+    )
 
 
-async def main():
+def register_handlers(dp):
     dp.message.register(start_handler, CommandStart())
     dp.message.register(help_handler, Command("help"))
     dp.message.register(register_handler, Command("register"))
     dp.message.register(register_name_handler, RegisterState.waiting_for_name)
     dp.message.register(tasks_handler, Command("tasks"))
     dp.message.register(profile_handler, Command("profile"))
+    dp.message.register(top_handler, Command("top"))
+    dp.message.register(export_handler, Command("export"))
     dp.message.register(send_handler, Command("send"))
     dp.message.register(today_handler, Command("today"))
     dp.message.register(log_handler, Command("log"))
     dp.message.register(send_log_handler, Command("send_log"))
+    dp.message.register(db_profile_handler, Command("db_profile"))
+    dp.message.register(rebuild_stats_handler, Command("rebuild_stats"))
 
     dp.message.register(today_handler, F.text == "گزارش امروز")
     dp.message.register(profile_handler, F.text == "پروفایل شما")
@@ -435,11 +712,85 @@ async def main():
     dp.message.register(task_handler)
     dp.callback_query.register(task_callback_handler)
 
-    # scheduler.add_job(daily_job, "cron", hour=0, minute=25, kwargs={"bot": bot})
-    # scheduler.start()
 
-    await dp.start_polling(bot)
+async def main():
+    global throttler
+
+    register_handlers(dp)
+    metrics.setup(dp, bot)
+    if THROTTLE:
+        throttler = throttling.setup(
+            dp,
+            read_rate=THROTTLE_READ_RATE,
+            read_burst=THROTTLE_READ_BURST,
+            write_rate=THROTTLE_WRITE_RATE,
+            write_burst=THROTTLE_WRITE_BURST,
+            exempt=(ADMIN,),
+        )
+
+    invalidator.setup(
+        forget_cached_users,
+        index=WORKER_INDEX,
+        workers=WORKERS,
+        base_port=WORKER_BASE_PORT,
+        secret=WEBHOOK_SECRET,
+    )
+
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT)
+
+    if DAILY_REPORT:
+        scheduler = DailyReportScheduler(
+            bot,
+            at=REPORT_TIME,
+            tz=REPORT_TZ,
+            window=REPORT_WINDOW,
+            batch_size=REPORT_BATCH,
+        )
+        scheduler_task = asyncio.create_task(scheduler.run())
+
+    if MAINTENANCE:
+        maintenance = Maintenance(
+            expire_days=EXPIRE_DAYS,
+            archive_days=ARCHIVE_DAYS,
+            interval=MAINTENANCE_INTERVAL,
+            quiet_hours=QUIET_HOURS,
+            tz=REPORT_TZ,
+            on_expired=invalidator.invalidate,
+        )
+        maintenance_task = asyncio.create_task(maintenance.run())
+
+    try:
+        if RUN_MODE == "webhook":
+            await run_webhook(
+                dp,
+                bot,
+                host=WEBHOOK_HOST,
+                port=WEBHOOK_PORT,
+                path=WEBHOOK_PATH,
+                secret=WEBHOOK_SECRET,
+                url=WEBHOOK_URL,
+                # فقط worker های supervisor.py از هم invalidation میگیرن
+                on_invalidate=forget_cached_users if WORKERS > 1 else None,
+            )
+        else:
+            await dp.start_polling(bot)
+    finally:
+        if DAILY_REPORT:
+            scheduler_task.cancel()
+        if MAINTENANCE:
+            maintenance_task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await invalidator.close()
+        await dp.storage.close()
+        async_db.shutdown()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        # تمیزکاری در finally های main() انجام شده
+        pass
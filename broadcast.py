@@ -0,0 +1,170 @@
+import asyncio
+import time
+
+from aiogram.exceptions import (
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+from async_db import set_user_active
+from invalidation import invalidator
+
+# محدودیت‌های تلگرام: حدود 30 پیام در ثانیه برای کل بات و 1 پیام در ثانیه برای هر چت
+GLOBAL_RATE = 25
+PER_CHAT_INTERVAL = 1.0
+WORKERS = 20
+MAX_RETRIES = 3
+MAX_FLOOD_WAITS = 5
+BACKOFF_BASE = 1.0
+PROGRESS_INTERVAL = 5
+
+
+class RateLimiter:
+    # ارسال‌ها را با فاصله‌ی ثابت 1/rate ثانیه پشت سر هم قرار میده
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            delay = self._next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_at = max(self._next_at, time.monotonic()) + self.interval
+
+    def pause(self, seconds):
+        self._next_at = max(self._next_at, time.monotonic() + seconds)
+
+
+class BroadcastResult:
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.started_at = time.monotonic()
+
+    @property
+    def done(self):
+        return self.sent + self.failed + self.blocked
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+
+class Broadcaster:
+    def __init__(
+        self,
+        bot,
+        rate=GLOBAL_RATE,
+        per_chat_interval=PER_CHAT_INTERVAL,
+        workers=WORKERS,
+        max_retries=MAX_RETRIES,
+    ):
+        self.bot = bot
+        self.limiter = RateLimiter(rate)
+        self.per_chat_interval = per_chat_interval
+        self.workers = workers
+        self.max_retries = max_retries
+        self._last_sent = {}
+
+    async def run(self, jobs, on_progress=None):
+        # jobs: iterable یا async iterable از (chat_id, text)
+        result = BroadcastResult()
+        jobs_queue = asyncio.Queue(maxsize=self.workers * 2)
+
+        workers = [
+            asyncio.create_task(self._worker(jobs_queue, result))
+            for _ in range(self.workers)
+        ]
+        reporter = None
+        if on_progress is not None:
+            reporter = asyncio.create_task(self._report(result, on_progress))
+
+        try:
+            if hasattr(jobs, "__aiter__"):
+                async for job in jobs:
+                    await jobs_queue.put(job)
+            else:
+                for job in jobs:
+                    await jobs_queue.put(job)
+
+            for _ in workers:
+                await jobs_queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            if reporter is not None:
+                reporter.cancel()
+
+        return result
+
+    async def _report(self, result, on_progress):
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            try:
+                await on_progress(result)
+            except Exception as e:
+                print(f"Error in broadcast progress: {e}")
+
+    async def _worker(self, jobs_queue, result):
+        while True:
+            job = await jobs_queue.get()
+            if job is None:
+                return
+
+            chat_id, text = job
+            status = await self._send(chat_id, text)
+
+            if status == "sent":
+                result.sent += 1
+            elif status == "blocked":
+                result.blocked += 1
+                try:
+                    await set_user_active(chat_id, False)
+                    await invalidator.invalidate([chat_id])
+                except Exception as e:
+                    print(f"Error deactivating {chat_id}: {e}")
+            else:
+                result.failed += 1
+
+    async def _wait_for_chat(self, chat_id):
+        last = self._last_sent.get(chat_id)
+        if last is not None:
+            delay = last + self.per_chat_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def _send(self, chat_id, text):
+        retries = 0
+        flood_waits = 0
+
+        while True:
+            await self._wait_for_chat(chat_id)
+            await self.limiter.wait()
+            self._last_sent[chat_id] = time.monotonic()
+
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                return "sent"
+            except TelegramRetryAfter as e:
+                # کل ارسال‌ها باید صبر کنن، نه فقط همین چت
+                flood_waits += 1
+                if flood_waits > MAX_FLOOD_WAITS:
+                    return "failed"
+                self.limiter.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"
+            except (TelegramNetworkError, TelegramServerError) as e:
+                retries += 1
+                if retries > self.max_retries:
+                    print(f"Error sending to {chat_id}: {e}")
+                    return "failed"
+                await asyncio.sleep(BACKOFF_BASE * 2 ** (retries - 1))
+            except Exception as e:
+                print(f"Error sending to {chat_id}: {e}")
+                return "failed"
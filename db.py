@@ -1,264 +1,756 @@
+import json
+import os
+import queue
 import sqlite3
-from datetime import datetime, timedelta, date
+import threading
+from contextlib import contextmanager
+from datetime import timedelta, date
 
-DB_NAME = "otos.db"
+from cache import TTLCache
+from models import Stats, Task, User
+from profiler import ProfiledConnection, profiler
+from ranking import ScoreIndex
+
+# supervisor.py مسیر دیتابیس رو با env به worker ها میده
+DB_NAME = os.getenv("DB_NAME", "otos.db")
+POOL_SIZE = 4
+STATEMENT_CACHE = 256
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+
+# telegram_id -> User (یا None برای کاربری که ثبت نام نکرده)
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_MISSING = object()
+
+LEADERBOARD_TTL = 60
+
+# پیام‌های mark_task_done (memory_db.py هم همین‌ها رو برمیگردونه)
+TASK_NOT_FOUND = "تسک پیدا نشد"
+TASK_ALREADY_DONE = "این تسک قبلا انجام شده ✅"
+TASK_EXPIRED = "این تسک منقضی شده ⌛"
+TASK_TOO_NEW = "⚠️ هنوز نیم ساعت از ایجاد کار نگذشته. {} دقیقه دیگر صبر کنید."
+TASK_DONE = "✅ تسک با موفقیت انجام شد و {} امتیاز به شما اضافه شد"
+score_index = ScoreIndex()
+leaderboard_cache = TTLCache(maxsize=16, ttl=LEADERBOARD_TTL)
+
+_pool_lock = threading.Lock()
+_write_lock = threading.Lock()
+_writer = None
+_readers = None
+_readers_count = 0
+
+
+def get_pool_size():
+    return int(os.getenv("DB_POOL_SIZE", POOL_SIZE))
+
+
+def get_score_index_ttl():
+    # با چند پروسه (supervisor.py) امتیازهای بقیه‌ی پروسه‌ها فقط با بارگذاری
+    # دوباره دیده میشن؛ 0 یعنی هیچ وقت (یک پروسه، همه‌ی تغییرها همین‌جاست)
+    return float(os.getenv("SCORE_INDEX_TTL", 0))
 
 
 def get_connection():
-    return sqlite3.connect(DB_NAME)
+    conn = sqlite3.connect(
+        DB_NAME,
+        timeout=30,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE,
+        factory=ProfiledConnection if profiler.enabled else sqlite3.Connection,
+    )
+    # فقط روی دیتابیس خالی اثر داره و باید قبل از WAL باشه
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
 
 
-def create_users_table():
-    conn = get_connection()
-    cur = conn.cursor()
+def _open_pool():
+    global _writer, _readers, _readers_count
 
-    cur.execute(
+    if _readers is not None:
+        return
+
+    with _pool_lock:
+        if _readers is not None:
+            return
+
+        # DB_PROFILE=on: زمان همه‌ی کوئری‌ها ثبت میشه (profiler.py)
+        if os.getenv("DB_PROFILE", "off") == "on":
+            profiler.enabled = True
+            profiler.slow_ms = float(os.getenv("DB_SLOW_MS", profiler.slow_ms))
+
+        size = get_pool_size()
+        _writer = get_connection()
+
+        readers = queue.Queue()
+        for _ in range(size):
+            conn = get_connection()
+            conn.execute("PRAGMA query_only=1")
+            readers.put(conn)
+
+        _readers_count = size
+        _readers = readers
+
+
+@contextmanager
+def writer():
+    # فقط یک کانکشن برای نوشتن؛ SQLite در هر لحظه یک writer قبول میکنه
+    _open_pool()
+    # کش کاربران و score_index داخل همین بلوک (زیر قفل) به‌روز میشن تا ترتیب
+    # نوشتن‌ها در کش همون ترتیب دیتابیس باشه
+    with _write_lock:
+        try:
+            yield _writer
+        except BaseException:
+            _writer.rollback()
+            raise
+
+        try:
+            _writer.commit()
+        except BaseException:
+            _writer.rollback()
+            # چیزی که قبل از commit در کش نوشته شده دیگه معتبر نیست
+            user_cache.clear()
+            score_index.loaded = False
+            raise
+
+
+@contextmanager
+def reader():
+    _open_pool()
+    conn = _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put(conn)
+
+
+def close():
+    global _writer, _readers, _readers_count
+
+    with _pool_lock:
+        if _readers is None:
+            return
+
+        with _write_lock:
+            _writer.close()
+            _writer = None
+
+        for _ in range(_readers_count):
+            _readers.get().close()
+
+        _readers = None
+        _readers_count = 0
+
+
+def create_users_table():
+    with writer() as conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                telegram_id INTEGER UNIQUE,
+                full_name TEXT,
+                score INTEGER DEFAULT 0,
+                join_date TEXT DEFAULT CURRENT_TIMESTAMP
+            )
         """
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER UNIQUE,
-            full_name TEXT,
-            score INTEGER DEFAULT 0,
-            join_date TEXT DEFAULT CURRENT_TIMESTAMP
         )
-    """
-    )
-
-    conn.commit()
-    conn.close()
 
 
 def create_tasks_table():
-    conn = get_connection()
-    cur = conn.cursor()
+    with writer() as conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                title TEXT,
+                category TEXT,
+                priority INTEGER,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                is_done INTEGER DEFAULT 0,
+                done_date TEXT,
+                is_expired INTEGER DEFAULT 0,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            )
+        """
+        )
 
-    cur.execute(
+
+# هر مایگریشن یک لیست از دستورها است و شماره‌اش همان جایگاهش در لیست (از 1)
+# نسخه‌ی فعلی دیتابیس در PRAGMA user_version نگه داشته میشه
+# users.telegram_id به خاطر UNIQUE خودش ایندکس داره
+MIGRATIONS = [
+    # 1: ایندکس‌های کوئری‌های هر کاربر روی tasks
+    [
+        "CREATE INDEX IF NOT EXISTS idx_tasks_user_done ON tasks (user_id, is_done)",
+        "CREATE INDEX IF NOT EXISTS idx_tasks_user_done_date "
+        "ON tasks (user_id, done_date)",
+    ],
+    # 2: کاربرانی که بات را بلاک کرده‌اند در broadcast ها رد میشن
+    [
+        "ALTER TABLE users ADD COLUMN is_active INTEGER DEFAULT 1",
+    ],
+    # 3: گزارش روزانه‌ی همه‌ی کاربران فقط کارهای انجام شده‌ی امروز رو میخونه
+    [
+        "CREATE INDEX IF NOT EXISTS idx_tasks_done_date ON tasks (done_date)",
+    ],
+    # 4: تنظیمات و وضعیت‌های کوچک (مثل آخرین اجرای گزارش روزانه)
+    [
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    ],
+    # 5: جدول امتیازات (/top)
+    [
+        "CREATE INDEX IF NOT EXISTS idx_users_score ON users (score DESC, id)",
+    ],
+    # 6: state های FSM (مثل ثبت نام) تا بعد از ریستارت از بین نرن
+    [
+        """
+        CREATE TABLE IF NOT EXISTS fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at INTEGER
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_updated_at ON fsm (updated_at)",
+    ],
+    # 7: شمارنده‌های /log که با trigger به‌روز میشن (به جای COUNT روی کل جدول)
+    # روزها به UTC هستن، مثل CURRENT_TIMESTAMP
+    [
+        "ALTER TABLE users ADD COLUMN last_active TEXT",
+        """
+        CREATE TABLE IF NOT EXISTS stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            users INTEGER NOT NULL DEFAULT 0,
+            done_tasks INTEGER NOT NULL DEFAULT 0,
+            pending_tasks INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            tasks_created INTEGER NOT NULL DEFAULT 0,
+            tasks_done INTEGER NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """,
         """
-        CREATE TABLE IF NOT EXISTS tasks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+        INSERT INTO stats (id, users, done_tasks, pending_tasks)
+        SELECT 1,
+            (SELECT COUNT(*) FROM users),
+            (SELECT COUNT(*) FROM tasks WHERE is_done = 1),
+            (SELECT COUNT(*) FROM tasks WHERE is_done = 0)
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE stats SET users = users + 1 WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE stats SET users = users - 1 WHERE id = 1;
+        END
+        """,
+        # اولین کار هر کاربر در روز، او رو جزو کاربران فعال امروز میکنه
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_active AFTER UPDATE OF last_active ON users
+        WHEN NEW.last_active IS NOT OLD.last_active
+        BEGIN
+            INSERT INTO daily_stats (day, active_users) VALUES (NEW.last_active, 1)
+            ON CONFLICT (day) DO UPDATE SET active_users = active_users + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_tasks_insert AFTER INSERT ON tasks
+        BEGIN
+            UPDATE stats
+            SET done_tasks = done_tasks + NEW.is_done,
+                pending_tasks = pending_tasks + 1 - NEW.is_done
+            WHERE id = 1;
+            INSERT INTO daily_stats (day, tasks_created) VALUES (DATE('now'), 1)
+            ON CONFLICT (day) DO UPDATE SET tasks_created = tasks_created + 1;
+            UPDATE users SET last_active = DATE('now')
+            WHERE id = NEW.user_id AND last_active IS NOT DATE('now');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_tasks_done AFTER UPDATE OF is_done ON tasks
+        WHEN NEW.is_done != OLD.is_done
+        BEGIN
+            UPDATE stats
+            SET done_tasks = done_tasks + NEW.is_done - OLD.is_done,
+                pending_tasks = pending_tasks - NEW.is_done + OLD.is_done
+            WHERE id = 1;
+            INSERT INTO daily_stats (day, tasks_done)
+            VALUES (DATE('now'), NEW.is_done - OLD.is_done)
+            ON CONFLICT (day) DO UPDATE
+            SET tasks_done = tasks_done + NEW.is_done - OLD.is_done;
+            UPDATE users SET last_active = DATE('now')
+            WHERE id = NEW.user_id AND last_active IS NOT DATE('now');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_tasks_delete AFTER DELETE ON tasks
+        BEGIN
+            UPDATE stats
+            SET done_tasks = done_tasks - OLD.is_done,
+                pending_tasks = pending_tasks - 1 + OLD.is_done
+            WHERE id = 1;
+            UPDATE users SET last_active = DATE('now')
+            WHERE id = OLD.user_id AND last_active IS NOT DATE('now');
+        END
+        """,
+    ],
+    # 8: تسک‌های منقضی و آرشیو تسک‌های قدیمی (maintenance.py)
+    # pending_tasks دیگه تسک‌های منقضی رو نمیشمره و انتقال به آرشیو
+    # (که ردیفش قبل از DELETE در tasks_archive نوشته شده) آمار رو تغییر نمیده
+    [
+        """
+        CREATE TABLE IF NOT EXISTS tasks_archive (
+            id INTEGER PRIMARY KEY,
             user_id INTEGER,
             title TEXT,
             category TEXT,
             priority INTEGER,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            is_done INTEGER DEFAULT 0,
+            created_at TEXT,
+            is_done INTEGER,
             done_date TEXT,
-            is_expired INTEGER DEFAULT 0,
-            FOREIGN KEY (user_id) REFERENCES users(id)
+            is_expired INTEGER,
+            archived_at TEXT DEFAULT CURRENT_TIMESTAMP
         )
-    """
-    )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_tasks_archive_user ON tasks_archive (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_tasks_pending_created "
+        "ON tasks (created_at) WHERE is_done = 0 AND is_expired = 0",
+        "CREATE INDEX IF NOT EXISTS idx_tasks_expired_created "
+        "ON tasks (created_at) WHERE is_expired = 1",
+        "DROP TRIGGER IF EXISTS trg_tasks_delete",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_tasks_delete AFTER DELETE ON tasks
+        WHEN NOT EXISTS (SELECT 1 FROM tasks_archive WHERE id = OLD.id)
+        BEGIN
+            UPDATE stats
+            SET done_tasks = done_tasks - OLD.is_done,
+                pending_tasks = pending_tasks
+                    - (OLD.is_done = 0 AND OLD.is_expired = 0)
+            WHERE id = 1;
+            UPDATE users SET last_active = DATE('now')
+            WHERE id = OLD.user_id AND last_active IS NOT DATE('now');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_tasks_expired
+        AFTER UPDATE OF is_expired ON tasks
+        WHEN NEW.is_expired != OLD.is_expired AND NEW.is_done = 0
+        BEGIN
+            UPDATE stats
+            SET pending_tasks = pending_tasks - NEW.is_expired + OLD.is_expired
+            WHERE id = 1;
+        END
+        """,
+        """
+        UPDATE stats
+        SET pending_tasks = (
+            SELECT COUNT(*) FROM tasks WHERE is_done = 0 AND is_expired = 0
+        )
+        WHERE id = 1
+        """,
+    ],
+]
 
-    conn.commit()
-    conn.close()
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate():
+    with writer() as conn:
+        version = get_schema_version(conn)
+
+        for number in range(version + 1, len(MIGRATIONS) + 1):
+            # DDL در sqlite3 پایتون تراکنش ضمنی نمیسازه، پس دستی BEGIN میزنیم
+            # IMMEDIATE و چک دوباره‌ی نسخه: شاید پروسه‌ی دیگه‌ای همزمان مایگریت کرده
+            conn.execute("BEGIN IMMEDIATE")
+            if get_schema_version(conn) >= number:
+                conn.rollback()
+                continue
+            for statement in MIGRATIONS[number - 1]:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
 
 
 def init_db():
     create_users_table()
     create_tasks_table()
+    migrate()
 
 
-def get_user_by_telegram_id(telegram_id):
-    conn = get_connection()
-    cur = conn.cursor()
+def _load_user(cur, telegram_id):
+    user = user_cache.get(telegram_id, _MISSING)
+    if user is _MISSING:
+        cur.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
+        row = cur.fetchone()
+        user = User(*row) if row else None
+        user_cache.set(telegram_id, user)
+    return user
 
-    cur.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-    user = cur.fetchone()
 
-    conn.close()
+def _get_user_id(cur, telegram_id):
+    user = _load_user(cur, telegram_id)
+    if not user:
+        return None
+    return user.id
+
+
+def _remember_user(row):
+    # بعد از هر تغییر در users، کش و جدول رتبه‌ها هم به‌روز میشن
+    user = User(*row)
+    user_cache.set(user.telegram_id, user)
+    score_index.update(user.telegram_id, user.score)
     return user
 
 
+def get_user_cache_stats():
+    return user_cache.stats()
+
+
+def forget_users(telegram_ids):
+    # وقتی پروسه‌ی دیگه‌ای ردیف کاربر رو عوض کرده (invalidation.py)
+    for telegram_id in telegram_ids:
+        user_cache.pop(telegram_id)
+
+
+def get_user_by_telegram_id(telegram_id):
+    user = user_cache.get(telegram_id, _MISSING)
+    if user is not _MISSING:
+        return user
+
+    with reader() as conn:
+        return _load_user(conn.cursor(), telegram_id)
+
+
 def add_user(telegram_id, full_name):
-    conn = get_connection()
-    cur = conn.cursor()
+    with writer() as conn:
+        row = conn.execute(
+            """
+            INSERT INTO users (telegram_id, full_name)
+            VALUES (?, ?)
+            RETURNING *
+        """,
+            (telegram_id, full_name),
+        ).fetchone()
+        return _remember_user(row)
+
+
+# توابع نوشتنی به دو بخش تقسیم شدن: _xxx(cur, ...) که داخل یک تراکنش باز
+# اجرا میشه و (نتیجه، ردیف جدید users یا None) برمیگردونه، و xxx(...) که
+# تراکنش خودش رو داره. apply_writes چند عملیات رو در یک تراکنش اجرا میکنه.
+
+
+def _add_task(cur, user_telegram_id, title, category, priority):
+    user_id = _get_user_id(cur, user_telegram_id)
+    if user_id is None:
+        return False, None
 
     cur.execute(
         """
-        INSERT INTO users (telegram_id, full_name)
-        VALUES (?, ?)
+        INSERT INTO tasks (user_id, title, category, priority)
+        VALUES (?, ?, ?, ?)
+        RETURNING id
     """,
-        (telegram_id, full_name),
+        (user_id, title, category, int(priority)),
     )
-
-    conn.commit()
-    conn.close()
+    return cur.fetchone()[0], None
 
 
 def add_task(user_telegram_id, title, category, priority):
-    conn = get_connection()
-    cur = conn.cursor()
+    with writer() as conn:
+        task_id, _ = _add_task(
+            conn.cursor(), user_telegram_id, title, category, priority
+        )
+    return task_id
 
-    cur.execute("SELECT id FROM users WHERE telegram_id = ?", (user_telegram_id,))
-    user = cur.fetchone()
-    if not user:
-        conn.close()
-        return False
 
-    user_id = user[0]
+def _add_tasks(cur, user_telegram_id, tasks):
+    # tasks: لیست (title, category, priority)؛ همه با یک executemany
+    user_id = _get_user_id(cur, user_telegram_id)
+    if user_id is None:
+        return False, None
 
-    cur.execute(
+    cur.executemany(
         """
         INSERT INTO tasks (user_id, title, category, priority)
         VALUES (?, ?, ?, ?)
     """,
-        (user_id, title, category, int(priority)),
+        [
+            (user_id, title, category, int(priority))
+            for title, category, priority in tasks
+        ],
     )
+    return cur.rowcount, None
 
-    conn.commit()
-    conn.close()
-    return True
 
+def add_tasks(user_telegram_id, tasks):
+    with writer() as conn:
+        count, _ = _add_tasks(conn.cursor(), user_telegram_id, tasks)
+    return count
 
-def get_user_tasks(telegram_id, only_pending=True):
-    conn = get_connection()
-    cur = conn.cursor()
-
-    cur.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
-    user = cur.fetchone()
-    if not user:
-        conn.close()
-        return []
 
-    user_id = user[0]
+def get_user_tasks(telegram_id, only_pending=True, after_id=0, limit=None):
+    # صفحه‌بندی keyset: تسک‌های بعد از after_id به ترتیب id
+    with reader() as conn:
+        cur = conn.cursor()
+
+        user_id = _get_user_id(cur, telegram_id)
+        if user_id is None:
+            return []
+
+        if limit is None:
+            limit = -1
+
+        if only_pending:
+            cur.execute(
+                """
+                SELECT id, title, category, priority
+                FROM tasks
+                WHERE user_id = ? AND is_done = 0 AND is_expired = 0 AND id > ?
+                ORDER BY id
+                LIMIT ?
+            """,
+                (user_id, after_id, limit),
+            )
+        else:
+            cur.execute(
+                """
+                SELECT id, title, category, priority
+                FROM tasks
+                WHERE user_id = ? AND is_expired = 0 AND id > ?
+                ORDER BY id
+                LIMIT ?
+            """,
+                (user_id, after_id, limit),
+            )
+
+        rows = cur.fetchall()
+
+    return [
+        Task(id=task_id, title=title, category=category, priority=priority)
+        for task_id, title, category, priority in rows
+    ]
+
+
+def get_prev_tasks_cursor(telegram_id, before_id, limit):
+    # cursor صفحه‌ی قبل: id ای که limit تسک بعد از خودش تا before_id داره
+    with reader() as conn:
+        cur = conn.cursor()
+
+        user_id = _get_user_id(cur, telegram_id)
+        if user_id is None:
+            return 0
 
-    if only_pending:
         cur.execute(
             """
-            SELECT id, title, category, priority
+            SELECT id
             FROM tasks
-            WHERE user_id = ? AND is_done = 0
+            WHERE user_id = ? AND is_done = 0 AND is_expired = 0 AND id <= ?
+            ORDER BY id DESC
+            LIMIT 1 OFFSET ?
         """,
-            (user_id,),
-        )
-    else:
-        cur.execute(
-            """
-            SELECT id, title, category, priority
-            FROM tasks
-            WHERE user_id = ?
-        """,
-            (user_id,),
-        )
-
-    rows = cur.fetchall()
-    conn.close()
-
-    tasks = []
-    for row in rows:
-        tasks.append(
-            {"id": row[0], "title": row[1], "category": row[2], "priority": row[3]}
+            (user_id, before_id, limit),
         )
+        row = cur.fetchone()
 
-    return tasks
-
-
-def delete_task(task_id, telegram_id):
-    conn = get_connection()
-    cur = conn.cursor()
+    if not row:
+        return 0
+    return row[0]
 
-    cur.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
-    user = cur.fetchone()
-    if not user:
-        conn.close()
-        return False
 
-    user_id = user[0]
+def _delete_task(cur, task_id, telegram_id):
+    user_id = _get_user_id(cur, telegram_id)
+    if user_id is None:
+        return False, None
 
-    cur.execute("SELECT id FROM tasks WHERE id = ? AND user_id = ?", (task_id, user_id))
-    task = cur.fetchone()
-    if not task:
-        conn.close()
-        return False
+    cur.execute(
+        "DELETE FROM tasks WHERE id = ? AND user_id = ? RETURNING id",
+        (task_id, user_id),
+    )
+    if not cur.fetchone():
+        return False, None
 
-    cur.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
     cur.execute(
         """
         UPDATE users
         SET score = score - 2
         WHERE id = ?
+        RETURNING *
     """,
         (user_id,),
     )
+    return True, cur.fetchone()
+
 
-    conn.commit()
-    conn.close()
-    return True
+def delete_task(task_id, telegram_id):
+    with writer() as conn:
+        success, user = _delete_task(conn.cursor(), task_id, telegram_id)
+        if user:
+            _remember_user(user)
+    return success
 
 
-def mark_task_done(task_id):
-    conn = get_connection()
-    cur = conn.cursor()
+def _mark_task_done(cur, task_id, telegram_id):
+    user_id = _get_user_id(cur, telegram_id)
+    if user_id is None:
+        return (False, TASK_NOT_FOUND), None
 
+    # مالکیت، انجام نشده بودن و گذشتن نیم ساعت همه در خود UPDATE چک میشن
+    # پس دو بار زدن دکمه فقط یک بار امتیاز میده
     cur.execute(
-        "SELECT created_at, user_id, priority FROM tasks WHERE id = ?", (task_id,)
+        """
+        UPDATE tasks
+        SET is_done = 1, done_date = CURRENT_TIMESTAMP
+        WHERE id = ? AND user_id = ? AND is_done = 0 AND is_expired = 0
+            AND created_at <= DATETIME('now', '-30 minutes')
+        RETURNING priority
+    """,
+        (task_id, user_id),
     )
     row = cur.fetchone()
+
     if not row:
-        conn.close()
-        return False, "تسک پیدا نشد"
-
-    created_at_str, user_id, priority = row
-    created_at = datetime.strptime(created_at_str, "%Y-%m-%d %H:%M:%S")
-    now = datetime.now()
-    elapsed = now - created_at
-
-    if elapsed < timedelta(minutes=30):
-        remaining = timedelta(minutes=30) - elapsed
-        minutes_left = int(remaining.total_seconds() // 60)
-        conn.close()
-        return (
-            False,
-            f"⚠️ هنوز نیم ساعت از ایجاد کار نگذشته. {minutes_left} دقیقه دیگر صبر کنید.",
-        )
+        return (_mark_task_done_error(cur, task_id, user_id), None)
+
+    priority = row[0]
+    cur.execute(
+        "UPDATE users SET score = score + ? WHERE id = ? RETURNING *",
+        (priority, user_id),
+    )
+    user = cur.fetchone()
+
+    return (True, TASK_DONE.format(priority)), user
+
 
+def _mark_task_done_error(cur, task_id, user_id):
+    # فقط وقتی UPDATE چیزی رو تغییر نداده، دلیلش رو پیدا میکنیم
     cur.execute(
         """
-        UPDATE tasks
-        SET is_done = 1, done_date = CURRENT_TIMESTAMP
-        WHERE id = ?
+        SELECT is_done, is_expired,
+            (JULIANDAY(created_at, '+30 minutes') - JULIANDAY('now')) * 1440
+        FROM tasks
+        WHERE id = ? AND user_id = ?
     """,
-        (task_id,),
+        (task_id, user_id),
     )
+    row = cur.fetchone()
+
+    if not row:
+        return False, TASK_NOT_FOUND
+
+    is_done, is_expired, minutes_left = row
+    if is_done:
+        return False, TASK_ALREADY_DONE
+    if is_expired:
+        return False, TASK_EXPIRED
+
+    return False, TASK_TOO_NEW.format(int(minutes_left))
+
+
+def mark_task_done(task_id, telegram_id):
+    with writer() as conn:
+        result, user = _mark_task_done(conn.cursor(), task_id, telegram_id)
+        if user:
+            _remember_user(user)
+    return result
 
-    cur.execute("UPDATE users SET score = score + ? WHERE id = ?", (priority, user_id))
 
-    conn.commit()
-    conn.close()
-    return True, f"✅ تسک با موفقیت انجام شد و {priority} امتیاز به شما اضافه شد"
+WRITE_OPS = {
+    "add_task": _add_task,
+    "add_tasks": _add_tasks,
+    "delete_task": _delete_task,
+    "mark_task_done": _mark_task_done,
+}
+
+
+def apply_writes(ops):
+    # ops: لیست (نام عملیات، args). همه در یک تراکنش و با یک commit اجرا میشن
+    # و هر عملیات savepoint خودش رو داره تا خطای یکی بقیه رو خراب نکنه.
+    # خروجی: لیست (True, نتیجه) یا (False, exception) به همان ترتیب
+    results = []
+    users = []
+
+    with writer() as conn:
+        cur = conn.cursor()
+        conn.execute("BEGIN IMMEDIATE")
+
+        for name, args in ops:
+            cur.execute("SAVEPOINT write_op")
+            try:
+                result, user = WRITE_OPS[name](cur, *args)
+            except Exception as e:
+                cur.execute("ROLLBACK TO write_op")
+                cur.execute("RELEASE write_op")
+                results.append((False, e))
+                continue
+
+            cur.execute("RELEASE write_op")
+            results.append((True, result))
+            if user:
+                users.append(user)
+
+        for user in users:
+            _remember_user(user)
+
+    return results
 
 
 def get_all_users():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT telegram_id FROM users")
-    rows = cur.fetchall()
-    conn.close()
+    with reader() as conn:
+        rows = conn.execute("SELECT telegram_id FROM users").fetchall()
     return [row[0] for row in rows]
 
 
-def get_done_tasks_today(telegram_id):
-    conn = get_connection()
-    cur = conn.cursor()
+def get_active_users():
+    with reader() as conn:
+        rows = conn.execute(
+            "SELECT telegram_id FROM users WHERE is_active = 1"
+        ).fetchall()
+    return [row[0] for row in rows]
 
-    cur.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
-    user = cur.fetchone()
-    if not user:
-        conn.close()
-        return [], 0
 
-    user_id = user[0]
+def set_user_active(telegram_id, is_active):
+    with writer() as conn:
+        row = conn.execute(
+            "UPDATE users SET is_active = ? WHERE telegram_id = ? RETURNING *",
+            (int(is_active), telegram_id),
+        ).fetchone()
+        if row:
+            _remember_user(row)
+    return row is not None
 
-    cur.execute(
-        """
-        SELECT title, priority
-        FROM tasks
-        WHERE user_id = ? AND is_done = 1 AND DATE(done_date) = DATE('now')
-    """,
-        (user_id,),
-    )
-    rows = cur.fetchall()
-    conn.close()
+
+def get_done_tasks_today(telegram_id):
+    with reader() as conn:
+        cur = conn.cursor()
+
+        user_id = _get_user_id(cur, telegram_id)
+        if user_id is None:
+            return [], 0
+
+        cur.execute(
+            """
+            SELECT title, priority
+            FROM tasks
+            WHERE user_id = ? AND is_done = 1
+                AND done_date >= DATE('now') AND done_date < DATE('now', '+1 day')
+        """,
+            (user_id,),
+        )
+        rows = cur.fetchall()
 
     tasks = [row[0] for row in rows]
     total_priority = sum([row[1] for row in rows])
@@ -267,58 +759,338 @@ def get_done_tasks_today(telegram_id):
 
 
 def get_user_count():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM users")
-    count = cur.fetchone()[0]
-    conn.close()
-    return count
+    with reader() as conn:
+        return conn.execute("SELECT users FROM stats WHERE id = 1").fetchone()[0]
 
 
 def get_total_done_tasks():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM tasks WHERE is_done = 1")
-    count = cur.fetchone()[0]
-    conn.close()
-    return count
+    with reader() as conn:
+        return conn.execute("SELECT done_tasks FROM stats WHERE id = 1").fetchone()[0]
 
 
-def get_user_done_tasks_today(user_telegram_id):
-    conn = get_connection()
-    cur = conn.cursor()
+def get_stats():
+    # همه‌ی آمار /log با یک ردیف
+    with reader() as conn:
+        row = conn.execute(
+            """
+            SELECT s.users, s.done_tasks, s.pending_tasks,
+                COALESCE(d.tasks_created, 0), COALESCE(d.tasks_done, 0),
+                COALESCE(d.active_users, 0)
+            FROM stats s
+            LEFT JOIN daily_stats d ON d.day = DATE('now')
+            WHERE s.id = 1
+        """
+        ).fetchone()
 
-    today_str = date.today().isoformat()
+    return Stats(*row)
 
-    cur.execute(
+
+def rebuild_stats():
+    # شمارنده‌ها از روی خود جدول‌ها دوباره حساب میشن (برای رفع هر اختلافی)
+    # (کارهای امروزی که بعدا حذف شده‌اند دیگه در tasks_created شمرده نمیشن)
+    with writer() as conn:
+        conn.execute(
+            """
+            UPDATE stats
+            SET users = (SELECT COUNT(*) FROM users),
+                done_tasks = (SELECT COUNT(*) FROM tasks WHERE is_done = 1)
+                    + (SELECT COUNT(*) FROM tasks_archive WHERE is_done = 1),
+                pending_tasks = (
+                    SELECT COUNT(*) FROM tasks WHERE is_done = 0 AND is_expired = 0
+                )
+            WHERE id = 1
         """
-        SELECT title, priority
-        FROM tasks t
-        JOIN users u ON t.user_id = u.id
-        WHERE u.telegram_id = ? AND t.is_done = 1 AND DATE(t.done_date) = ?
-    """,
-        (user_telegram_id, today_str),
-    )
+        )
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO daily_stats
+                (day, tasks_created, tasks_done, active_users)
+            SELECT DATE('now'),
+                (SELECT COUNT(*) FROM tasks
+                    WHERE created_at >= DATE('now')
+                        AND created_at < DATE('now', '+1 day')),
+                (SELECT COUNT(*) FROM tasks
+                    WHERE is_done = 1 AND done_date >= DATE('now')
+                        AND done_date < DATE('now', '+1 day')),
+                (SELECT COUNT(*) FROM users WHERE last_active = DATE('now'))
+        """
+        )
 
-    rows = cur.fetchall()
-    conn.close()
+    return get_stats()
 
-    tasks = [{"title": row[0], "priority": row[1]} for row in rows]
-    return tasks
 
+def get_user_done_tasks_today(user_telegram_id):
+    today = date.today()
+    today_str = today.isoformat()
+    tomorrow_str = (today + timedelta(days=1)).isoformat()
 
-def get_task_by_id(task_id):
-    conn = get_connection()
-    cur = conn.cursor()
+    with reader() as conn:
+        rows = conn.execute(
+            """
+            SELECT title, priority
+            FROM tasks t
+            JOIN users u ON t.user_id = u.id
+            WHERE u.telegram_id = ? AND t.is_done = 1
+                AND t.done_date >= ? AND t.done_date < ?
+        """,
+            (user_telegram_id, today_str, tomorrow_str),
+        ).fetchall()
 
-    cur.execute("SELECT title FROM tasks WHERE id = ?", (task_id,))
-    row = cur.fetchone()
-    conn.close()
+    return [Task(title=title, priority=priority) for title, priority in rows]
+
+
+def iter_done_tasks_between(start, end, after_telegram_id=0, limit=-1, chunk_size=500):
+    # فقط کاربرانی که در این بازه کاری انجام داده‌اند، با یک کوئری گروه‌بندی شده
+    with reader() as conn:
+        cur = conn.execute(
+            """
+            SELECT u.telegram_id, json_group_array(t.title), SUM(t.priority)
+            FROM tasks t
+            JOIN users u ON t.user_id = u.id
+            WHERE t.is_done = 1 AND t.done_date >= ? AND t.done_date < ?
+                AND u.is_active = 1 AND u.telegram_id > ?
+            GROUP BY u.telegram_id
+            ORDER BY u.telegram_id
+            LIMIT ?
+        """,
+            (start, end, after_telegram_id, limit),
+        )
+
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            for telegram_id, titles, total_priority in rows:
+                yield telegram_id, json.loads(titles), total_priority
+
+
+def iter_user_tasks(telegram_id, chunk_size=500):
+    # کل تاریخچه‌ی یک کاربر (آرشیو و بعد tasks) برای /export
+    # هر تکه یک کوئری keyset کوتاه با reader خودشه؛ generator بین تکه‌ها
+    # (وقتی هندلر منتظر نوشتن فایله) هیچ کانکشنی از pool نگه نمیداره
+    with reader() as conn:
+        user_id = _get_user_id(conn.cursor(), telegram_id)
+    if user_id is None:
+        return
+
+    for table in ("tasks_archive", "tasks"):
+        after_id = 0
+        while True:
+            with reader() as conn:
+                rows = conn.execute(
+                    f"""
+                    SELECT id, title, category, priority, created_at,
+                        is_done, done_date, is_expired
+                    FROM {table}
+                    WHERE user_id = ? AND id > ?
+                    ORDER BY id
+                    LIMIT ?
+                """,
+                    (user_id, after_id, chunk_size),
+                ).fetchall()
+
+            if not rows:
+                break
+            for row in rows:
+                yield Task(
+                    row[0],
+                    user_id,
+                    *row[1:],
+                    archived=table == "tasks_archive",
+                )
+            after_id = rows[-1][0]
+
+
+def count_users_done_between(start, end, after_telegram_id=0):
+    with reader() as conn:
+        return conn.execute(
+            """
+            SELECT COUNT(DISTINCT u.telegram_id)
+            FROM tasks t
+            JOIN users u ON t.user_id = u.id
+            WHERE t.is_done = 1 AND t.done_date >= ? AND t.done_date < ?
+                AND u.is_active = 1 AND u.telegram_id > ?
+        """,
+            (start, end, after_telegram_id),
+        ).fetchone()[0]
+
+
+def get_meta(key, default=None):
+    with reader() as conn:
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+
+    if not row:
+        return default
+    return row[0]
+
+
+def set_meta(key, value):
+    with writer() as conn:
+        if value is None:
+            conn.execute("DELETE FROM meta WHERE key = ?", (key,))
+        else:
+            conn.execute(
+                """
+                INSERT INTO meta (key, value) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            """,
+                (key, str(value)),
+            )
+
+
+def expire_stale_tasks(before, limit=500):
+    # تسک‌های انجام نشده‌ای که قبل از before ساخته شدن منقضی میشن
+    # telegram_id صاحب هر تسک برگردونده میشه تا کش صفحه‌هاش پاک بشه
+    with writer() as conn:
+        rows = conn.execute(
+            """
+            UPDATE tasks
+            SET is_expired = 1
+            WHERE id IN (
+                SELECT id FROM tasks
+                WHERE is_done = 0 AND is_expired = 0 AND created_at < ?
+                LIMIT ?
+            )
+            RETURNING (SELECT telegram_id FROM users WHERE users.id = tasks.user_id)
+        """,
+            (before, limit),
+        ).fetchall()
+
+    return [row[0] for row in rows]
+
+
+def archive_tasks(before, limit=500):
+    # یک دسته‌ی کوچک از تسک‌های انجام شده یا منقضی قدیمی به tasks_archive
+    # منتقل میشه؛ تراکنش کوتاهه تا نوشتن‌های بات پشتش منتظر نمونن
+    with writer() as conn:
+        ids = conn.execute(
+            """
+            SELECT json_group_array(id) FROM (
+                SELECT id FROM tasks WHERE is_done = 1 AND done_date < ?
+                UNION ALL
+                SELECT id FROM tasks WHERE is_expired = 1 AND created_at < ?
+                LIMIT ?
+            )
+        """,
+            (before, before, limit),
+        ).fetchone()[0]
+
+        conn.execute(
+            """
+            INSERT INTO tasks_archive (
+                id, user_id, title, category, priority,
+                created_at, is_done, done_date, is_expired
+            )
+            SELECT id, user_id, title, category, priority,
+                created_at, is_done, done_date, is_expired
+            FROM tasks
+            WHERE id IN (SELECT value FROM json_each(?))
+        """,
+            (ids,),
+        )
+        return conn.execute(
+            "DELETE FROM tasks WHERE id IN (SELECT value FROM json_each(?))", (ids,)
+        ).rowcount
+
+
+def optimize_db(vacuum_pages=1000):
+    # آمار query planner با ANALYZE محدود به‌روز میشه و صفحه‌های خالی
+    # (بعد از آرشیو) کم کم به سیستم عامل برگردونده میشن
+    with writer() as conn:
+        conn.execute("PRAGMA analysis_limit=1000")
+        conn.execute("ANALYZE")
+
+        auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if auto_vacuum == 2:
+            conn.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)})")
+
+    return {"auto_vacuum": auto_vacuum, "freelist": freelist}
+
+
+def get_task_by_id(task_id):
+    with reader() as conn:
+        row = conn.execute(
+            "SELECT title FROM tasks WHERE id = ?", (task_id,)
+        ).fetchone()
 
     if not row:
         return None
 
-    return {"title": row[0]}
+    return Task(id=task_id, title=row[0])
+
+
+def get_fsm_record(key, min_updated_at=0):
+    with reader() as conn:
+        return conn.execute(
+            "SELECT state, data FROM fsm WHERE key = ? AND updated_at >= ?",
+            (key, min_updated_at),
+        ).fetchone()
+
+
+def save_fsm_records(records):
+    # records: لیست (key, state, data, updated_at)؛ رکورد خالی یعنی حذف
+    upserts = [r for r in records if r[1] is not None or r[2] != "{}"]
+    deletes = [(r[0],) for r in records if r[1] is None and r[2] == "{}"]
+
+    with writer() as conn:
+        if upserts:
+            conn.executemany(
+                """
+                INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    state = excluded.state,
+                    data = excluded.data,
+                    updated_at = excluded.updated_at
+            """,
+                upserts,
+            )
+        if deletes:
+            conn.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+
+
+def delete_expired_fsm_records(before):
+    with writer() as conn:
+        return conn.execute("DELETE FROM fsm WHERE updated_at < ?", (before,)).rowcount
+
+
+def get_top_users(limit=10):
+    top = leaderboard_cache.get(limit)
+    if top is not None:
+        return top
+
+    with reader() as conn:
+        rows = conn.execute(
+            """
+            SELECT telegram_id, full_name, score
+            FROM users
+            ORDER BY score DESC, id
+            LIMIT ?
+        """,
+            (limit,),
+        ).fetchall()
+
+    top = [
+        User(telegram_id=telegram_id, full_name=full_name, score=score)
+        for telegram_id, full_name, score in rows
+    ]
+
+    leaderboard_cache.set(limit, top)
+    return top
+
+
+def get_user_position(telegram_id):
+    # (رتبه، تعداد کل کاربران)؛ فقط بار اول امتیازها از دیتابیس خونده میشن
+    ttl = get_score_index_ttl()
+    if not score_index.is_fresh(ttl):
+        # زیر قفل writer تا در حین بارگذاری امتیازی تغییر نکنه
+        with writer() as conn:
+            if not score_index.is_fresh(ttl):
+                score_index.load(
+                    conn.execute("SELECT telegram_id, score FROM users").fetchall()
+                )
+
+    return score_index.position(telegram_id), len(score_index)
 
 
 def get_rank(score):
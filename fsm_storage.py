@@ -0,0 +1,117 @@
+import asyncio
+import json
+import time
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+from async_db import delete_expired_fsm_records, get_fsm_record, save_fsm_records
+from cache import TTLCache
+
+STATE_TTL = 24 * 60 * 60
+CACHE_TTL = 60
+CACHE_SIZE = 10000
+FLUSH_INTERVAL = 0.05
+CLEANUP_INTERVAL = 60 * 60
+
+_MISSING = object()
+
+
+class SQLiteStorage(BaseStorage):
+    # state ها در جدول fsm همان otos.db ذخیره میشن
+    # خواندن از کش حافظه است (بیشتر کاربران اصلا state ندارن و همین هم کش میشه)
+    # و نوشتن‌ها هر FLUSH_INTERVAL ثانیه یکجا در یک تراکنش ثبت میشن
+    def __init__(
+        self,
+        key_builder=None,
+        state_ttl=STATE_TTL,
+        cache_ttl=CACHE_TTL,
+        cache_size=CACHE_SIZE,
+        flush_interval=FLUSH_INTERVAL,
+    ):
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        self.state_ttl = state_ttl
+        self.flush_interval = flush_interval
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._pending = {}
+        self._flushing = {}
+        self._flush_task = None
+        self._last_cleanup = time.time()
+
+    async def _load(self, key):
+        record = self._pending.get(key) or self._flushing.get(key)
+        if record is not None:
+            return record
+
+        record = self._cache.get(key, _MISSING)
+        if record is not _MISSING:
+            return record
+
+        row = await get_fsm_record(key, int(time.time()) - self.state_ttl)
+        record = (row[0], json.loads(row[1])) if row else (None, {})
+        self._cache.set(key, record)
+        return record
+
+    def _store(self, key, state, data):
+        record = (state, data)
+        self._cache.set(key, record)
+        self._pending[key] = record
+
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+        now = time.time()
+        if now - self._last_cleanup > CLEANUP_INTERVAL:
+            self._last_cleanup = now
+            await delete_expired_fsm_records(int(now) - self.state_ttl)
+
+    async def flush(self):
+        if not self._pending:
+            return
+
+        self._flushing, self._pending = self._pending, {}
+        now = int(time.time())
+        records = [
+            (key, state, json.dumps(data, ensure_ascii=False), now)
+            for key, (state, data) in self._flushing.items()
+        ]
+
+        try:
+            await save_fsm_records(records)
+        except Exception as e:
+            print(f"Error saving FSM states: {e}")
+            # دفعه‌ی بعد دوباره امتحان میشه، مگر اینکه مقدار جدیدتری نوشته شده باشه
+            for key, record in self._flushing.items():
+                self._pending.setdefault(key, record)
+        finally:
+            self._flushing = {}
+
+    async def set_state(self, key, state=None):
+        key = self.key_builder.build(key)
+        if isinstance(state, State):
+            state = state.state
+
+        _, data = await self._load(key)
+        self._store(key, state, data)
+
+    async def get_state(self, key):
+        state, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key, data):
+        key = self.key_builder.build(key)
+        state, _ = await self._load(key)
+        self._store(key, state, dict(data))
+
+    async def get_data(self, key):
+        _, data = await self._load(self.key_builder.build(key))
+        return dict(data)
+
+    async def close(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        await self.flush()
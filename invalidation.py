@@ -0,0 +1,72 @@
+from collections import defaultdict
+
+from aiohttp import ClientSession, ClientTimeout
+
+INVALIDATE_PATH = "/invalidate"
+TIMEOUT = 5
+
+
+class Invalidator:
+    # با supervisor.py هر worker فقط کش کاربرهای خودش رو داره (update های هر
+    # کاربر همیشه به worker شماره‌ی telegram_id % workers میرسه). وقتی worker
+    # دیگه‌ای داده‌ی یک کاربر رو عوض میکنه (منقضی کردن تسک‌ها در نگهداری،
+    # غیرفعال کردن کاربر در broadcast) به worker صاحبش خبر میده تا صفحه‌ها و
+    # ردیف کش شده‌اش رو دور بریزه. با یک پروسه همه چیز همین‌جا انجام میشه.
+    def __init__(self):
+        self.forget = None
+        self.index = 0
+        self.workers = 1
+        self.base_port = 0
+        self.secret = None
+        self.sent = 0
+        self.errors = 0
+        self._session = None
+
+    def setup(self, forget, index=0, workers=1, base_port=0, secret=None):
+        self.forget = forget
+        self.index = index
+        self.workers = max(1, workers)
+        self.base_port = base_port
+        self.secret = secret
+
+    def owner(self, telegram_id):
+        return telegram_id % self.workers
+
+    async def invalidate(self, telegram_ids):
+        by_owner = defaultdict(list)
+        for telegram_id in telegram_ids:
+            by_owner[self.owner(telegram_id)].append(telegram_id)
+
+        for owner, ids in by_owner.items():
+            if owner == self.index:
+                if self.forget:
+                    self.forget(ids)
+            else:
+                await self._send(owner, ids)
+
+    async def _send(self, owner, ids):
+        if self._session is None:
+            self._session = ClientSession(timeout=ClientTimeout(total=TIMEOUT))
+
+        url = f"http://127.0.0.1:{self.base_port + owner}{INVALIDATE_PATH}"
+        headers = {}
+        if self.secret:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.secret
+        try:
+            async with self._session.post(
+                url, json={"users": ids}, headers=headers
+            ) as response:
+                response.raise_for_status()
+            self.sent += 1
+        except Exception as e:
+            # در بدترین حالت کش اون worker بعد از TTL خودش درست میشه
+            self.errors += 1
+            print(f"Error invalidating users on worker {owner}: {e}")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+invalidator = Invalidator()
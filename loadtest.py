@@ -0,0 +1,507 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+# بات واقعی با همین Dispatcher و هندلرها اجرا میشه، فقط Bot API یک سرور محلی است
+# python loadtest.py --users 500 --rate 200 --duration 30 --json out.json
+# python loadtest.py --baseline out.json   (مقایسه با یک اجرای قبلی)
+# python loadtest.py --serve-only --port 8081   (فقط سرور جعلی Bot API)
+# python loadtest.py --shards 4   (supervisor.py با 4 worker؛ update ها با HTTP)
+
+TOKEN = "123456:LOADTEST"
+REPLY_TIMEOUT = 10
+
+# سهم هر نوع update در ترافیک
+MIX = {
+    "add_task": 30,
+    "tasks": 20,
+    "open": 10,
+    "done": 15,
+    "delete": 5,
+    "today": 10,
+    "profile": 5,
+    "register": 5,
+}
+
+TASK_TITLES = ["کتاب خواندن", "ورزش", "کدنویسی", "خرید", "مدیتیشن", "ایمیل‌ها"]
+
+
+class FakeBotAPI:
+    # جایگزین api.telegram.org؛ فراخوانی‌ها رو میشمره و کیبوردهای inline
+    # فرستاده شده به هر چت رو نگه میداره تا کاربرهای مجازی روی همون‌ها کلیک کنن
+    def __init__(self):
+        self.calls = Counter()
+        self.keyboards = {}
+        self._message_id = 0
+        self._waiters = {}
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        data = await request.post()
+        self.calls[method] += 1
+
+        chat_id = int(data.get("chat_id") or 0)
+
+        if method == "answerCallbackQuery":
+            waiter = self._waiters.pop(
+                ("callback", data.get("callback_query_id")), None
+            )
+        elif method in ("sendMessage", "sendDocument"):
+            waiter = self._waiters.pop(("chat", chat_id), None)
+        else:
+            waiter = None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(time.perf_counter())
+
+        markup = data.get("reply_markup")
+        if markup:
+            buttons = [
+                button["callback_data"]
+                for row in json.loads(markup).get("inline_keyboard", [])
+                for button in row
+            ]
+            if buttons:
+                self.keyboards[chat_id] = buttons
+        elif method == "editMessageText":
+            self.keyboards.pop(chat_id, None)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "otos"}
+        elif method in ("sendMessage", "editMessageText", "sendDocument"):
+            self._message_id += 1
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": data.get("text", ""),
+            }
+        else:
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    def expect_reply(self, raw):
+        # با --shards پردازش در پروسه‌ی دیگه است؛ جواب یک update اولین
+        # answerCallbackQuery همون callback یا sendMessage به همون چت است
+        callback = raw.get("callback_query")
+        if callback:
+            key = ("callback", callback["id"])
+        else:
+            key = ("chat", raw["message"]["chat"]["id"])
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[key] = waiter
+        return waiter
+
+
+class UpdateFactory:
+    def __init__(self, api, seed=1):
+        self.api = api
+        self.random = random.Random(seed)
+        self._update_id = 0
+
+    def _next_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    def message(self, user_id, text):
+        update_id = self._next_id()
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "load"},
+                "text": text,
+            },
+        }
+
+    def callback(self, user_id, data):
+        update_id = self._next_id()
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "from": {"id": user_id, "is_bot": False, "first_name": "load"},
+                "message": {
+                    "message_id": update_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "کارهای انجام نشده 👇",
+                },
+            },
+        }
+
+    def task_text(self):
+        title = self.random.choice(TASK_TITLES)
+        priority = self.random.choice("123")
+        if self.random.random() < 0.5:
+            return f"{title}\n{priority}"
+        return f"{title}\n#{self.random.choice(['کار', 'خانه', 'درس'])}\n{priority}"
+
+    def button(self, user_id, action):
+        buttons = [
+            data
+            for data in self.api.keyboards.get(user_id, [])
+            if data.startswith(f"task_{action}_")
+        ]
+        if not buttons:
+            return None
+        return self.random.choice(buttons)
+
+    def next(self, kind, user_id):
+        # لیست update ها برای یک اقدام کاربر (ثبت نام دو update پشت سر هم است)
+        if kind == "register":
+            return [self.message(user_id, "/register"), self.message(user_id, "Load")]
+        if kind == "add_task":
+            return [self.message(user_id, self.task_text())]
+        if kind == "tasks":
+            return [self.message(user_id, "/tasks")]
+        if kind == "today":
+            return [self.message(user_id, "/today")]
+        if kind == "profile":
+            return [self.message(user_id, "/profile")]
+
+        data = self.button(user_id, kind)
+        if data is None:
+            return [self.message(user_id, "/tasks")]
+        return [self.callback(user_id, data)]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+    }
+
+
+def seed_users(db, users, tasks_per_user, first_id):
+    # کاربرهای از قبل ثبت نام شده با چند تسک قدیمی (که دکمه‌ی انجامشون کار کنه)
+    with db.writer() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (telegram_id, full_name) VALUES (?, ?)",
+            [(first_id + i, f"load{i}") for i in range(users)],
+        )
+        conn.execute(
+            """
+            INSERT INTO tasks (user_id, title, category, priority, created_at)
+            WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+            SELECT u.id, 'seed', 'نامشخص', 1, DATETIME('now', '-1 day')
+            FROM users u, n
+            WHERE u.telegram_id >= ?
+        """,
+            (tasks_per_user, first_id),
+        )
+
+
+def free_port():
+    import socket
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def start_in_process(args, bot_api_url):
+    # همون Dispatcher و هندلرها در همین پروسه؛ زمان دیتابیس هم اندازه‌گیری میشه
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.types import Update
+
+    import async_db
+    import bot as otos
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(bot_api_url))
+    bot = Bot(TOKEN, session=session)
+    otos.register_handlers(otos.dp)
+
+    async def deliver(raw, db_times):
+        update = Update.model_validate(raw, context={"bot": bot})
+        timer = [0.0]
+        token = async_db.db_timer.set(timer)
+        try:
+            await otos.dp.feed_update(bot, update)
+        finally:
+            db_times.append(timer[0])
+            async_db.db_timer.reset(token)
+
+    async def stop():
+        await otos.dp.storage.close()
+        await bot.session.close()
+        async_db.shutdown()
+        return async_db.write_queue.stats()
+
+    return deliver, stop
+
+
+async def start_sharded(args, api, bot_api_url, db_name):
+    # supervisor.py با N پروسه‌ی bot.py؛ update ها با HTTP به پروسه‌ی جلو میرسن
+    from aiohttp import ClientSession
+
+    from supervisor import Supervisor
+
+    port = free_port()
+    supervisor = Supervisor(
+        workers=args.shards,
+        base_port=args.base_port,
+        mode="webhook",
+        token=TOKEN,
+        webhook={"host": "127.0.0.1", "port": port, "path": "/webhook"},
+        worker_env={
+            "API_KEY": TOKEN,
+            "ADMIN": "1",
+            "BOT_API_URL": bot_api_url,
+            "DB_NAME": db_name,
+            "DAILY_REPORT": "off",
+            "MAINTENANCE": "off",
+            "THROTTLE": "off",
+        },
+    )
+    ready = asyncio.Event()
+    supervisor_task = asyncio.create_task(supervisor.run(ready))
+    await ready.wait()
+
+    http = ClientSession()
+    url = f"http://127.0.0.1:{port}/webhook"
+
+    async def deliver(raw, db_times):
+        reply = api.expect_reply(raw)
+        async with http.post(url, json=raw) as response:
+            response.raise_for_status()
+        await asyncio.wait_for(reply, REPLY_TIMEOUT)
+
+    async def stop():
+        await http.close()
+        supervisor.stopping.set()
+        await supervisor_task
+        return None
+
+    return deliver, stop
+
+
+async def run(args):
+    import db
+
+    workdir = tempfile.mkdtemp(prefix="otos-load-")
+    db.DB_NAME = args.db or os.path.join(workdir, "otos.db")
+
+    os.environ.setdefault("API_KEY", TOKEN)
+    os.environ.setdefault("ADMIN", "1")
+    os.environ["DAILY_REPORT"] = "off"
+
+    api = FakeBotAPI()
+    base_url = await api.start()
+
+    first_id = 10_000_000
+    db.init_db()
+    seed_users(db, args.users, args.seed_tasks, first_id)
+
+    if args.shards:
+        db.close()
+        deliver, stop = await start_sharded(args, api, base_url, db.DB_NAME)
+    else:
+        deliver, stop = await start_in_process(args, base_url)
+
+    factory = UpdateFactory(api, seed=args.seed)
+    kinds = list(MIX)
+    weights = [MIX[kind] for kind in kinds]
+    locks = defaultdict(asyncio.Lock)
+    next_new_user = first_id + args.users
+
+    latencies = defaultdict(list)
+    db_times = []
+    errors = Counter()
+    in_flight = 0
+    max_in_flight = 0
+
+    async def act(kind, user_id):
+        nonlocal in_flight, max_in_flight
+        # ترتیب update های هر کاربر مثل تلگرام حفظ میشه
+        async with locks[user_id]:
+            for raw in factory.next(kind, user_id):
+                in_flight += 1
+                max_in_flight = max(max_in_flight, in_flight)
+                started = time.perf_counter()
+                try:
+                    await deliver(raw, db_times)
+                except Exception as e:
+                    errors[type(e).__name__] += 1
+                finally:
+                    latencies[kind].append(time.perf_counter() - started)
+                    in_flight -= 1
+
+    rng = random.Random(args.seed)
+    interval = 1 / args.rate
+    pending = set()
+    started = time.perf_counter()
+    deadline = started + args.duration
+    tick = started
+
+    while tick < deadline:
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "register":
+            user_id = next_new_user
+            next_new_user += 1
+        else:
+            user_id = first_id + rng.randrange(args.users)
+
+        task = asyncio.create_task(act(kind, user_id))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+        tick += interval
+        delay = tick - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    if pending:
+        await asyncio.gather(*pending)
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    report = {
+        "config": {
+            "users": args.users,
+            "rate": args.rate,
+            "duration": args.duration,
+            "seed": args.seed,
+            "shards": args.shards,
+        },
+        "updates": len(all_latencies),
+        "throughput": len(all_latencies) / elapsed,
+        "max_in_flight": max_in_flight,
+        "latency": summarize(all_latencies),
+        "db_time": summarize(db_times),
+        "by_kind": {kind: summarize(values) for kind, values in latencies.items()},
+        "api_calls": dict(api.calls),
+        "errors": dict(errors),
+    }
+
+    report["write_queue"] = await stop()
+    await api.stop()
+    return report
+
+
+def print_report(report, baseline=None):
+    def delta(path):
+        if baseline is None:
+            return ""
+        old = baseline
+        new = report
+        for key in path:
+            old = old.get(key, {}) if isinstance(old, dict) else None
+            new = new.get(key, {}) if isinstance(new, dict) else None
+        if not old or not isinstance(old, (int, float)):
+            return ""
+        return f" ({(new - old) / old * 100:+.1f}%)"
+
+    print(
+        f"updates: {report['updates']}  "
+        f"throughput: {report['throughput']:.1f}/s{delta(['throughput'])}  "
+        f"max in flight: {report['max_in_flight']}"
+    )
+    print(f"{'':<10} {'count':>7} {'p50 ms':>16} {'p95 ms':>16} {'p99 ms':>16}")
+
+    rows = [("all", ["latency"]), ("db", ["db_time"])]
+    rows += [(kind, ["by_kind", kind]) for kind in sorted(report["by_kind"])]
+    for name, path in rows:
+        stats = report
+        for key in path:
+            stats = stats[key]
+        cells = [
+            f"{stats[p]:.2f}{delta(path + [p])}" for p in ("p50_ms", "p95_ms", "p99_ms")
+        ]
+        print(f"{name:<10} {stats['count']:>7} " + " ".join(f"{c:>16}" for c in cells))
+
+    print("api calls:", report["api_calls"])
+    if report.get("write_queue"):
+        print("write queue:", report["write_queue"])
+    if report["errors"]:
+        print("errors:", report["errors"])
+
+
+async def serve(args):
+    api = FakeBotAPI()
+    url = await api.start(port=args.port)
+    print(f"Fake Bot API listening on {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OTOS end-to-end load test")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=100, help="updates per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--seed-tasks", type=int, default=5)
+    parser.add_argument("--db", help="database file (default: a temp file)")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--baseline", help="compare with a previous --json report")
+    parser.add_argument(
+        "--shards", type=int, default=0, help="run supervisor.py with N workers"
+    )
+    parser.add_argument("--base-port", type=int, default=8100)
+    parser.add_argument("--serve-only", action="store_true")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+
+    if args.serve_only:
+        asyncio.run(serve(args))
+        return
+
+    report = asyncio.run(run(args))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print_report(report, baseline)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
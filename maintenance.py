@@ -0,0 +1,112 @@
+import asyncio
+from datetime import datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from async_db import archive_tasks, expire_stale_tasks, get_meta, optimize_db, set_meta
+from utils import utc_str
+
+EXPIRE_DAYS = 30
+ARCHIVE_DAYS = 90
+BATCH_SIZE = 500
+BATCH_PAUSE = 0.2
+INTERVAL = 10 * 60
+QUIET_HOURS = "03:00-05:00"
+QUIET_TZ = "Asia/Tehran"
+VACUUM_PAGES = 1000
+
+OPTIMIZE_KEY = "maintenance_optimize_last"
+
+
+class Maintenance:
+    # هر INTERVAL ثانیه: منقضی کردن تسک‌های کهنه و آرشیو تسک‌های قدیمی در
+    # دسته‌های کوچک (با مکث بین دسته‌ها)، و روزی یک بار در ساعت‌های خلوت
+    # ANALYZE و incremental vacuum
+    def __init__(
+        self,
+        expire_days=EXPIRE_DAYS,
+        archive_days=ARCHIVE_DAYS,
+        batch_size=BATCH_SIZE,
+        interval=INTERVAL,
+        quiet_hours=QUIET_HOURS,
+        tz=QUIET_TZ,
+        on_expired=None,
+    ):
+        self.expire_days = expire_days
+        self.archive_days = archive_days
+        self.batch_size = batch_size
+        self.interval = interval
+        start, end = quiet_hours.split("-")
+        self.quiet_start = time.fromisoformat(start)
+        self.quiet_end = time.fromisoformat(end)
+        self.tz = ZoneInfo(tz)
+        self.on_expired = on_expired
+
+    def in_quiet_hours(self, now):
+        current = now.time()
+        if self.quiet_start <= self.quiet_end:
+            return self.quiet_start <= current < self.quiet_end
+        # مثلا 23:00-02:00
+        return current >= self.quiet_start or current < self.quiet_end
+
+    async def expire(self):
+        # expire_days=0 یعنی تسک‌ها هیچ وقت منقضی نمیشن
+        if not self.expire_days:
+            return 0
+
+        before = utc_str(datetime.now(timezone.utc) - timedelta(days=self.expire_days))
+        total = 0
+        while True:
+            owners = await expire_stale_tasks(before, self.batch_size)
+            total += len(owners)
+            if owners and self.on_expired:
+                await self.on_expired(set(owners))
+            if len(owners) < self.batch_size:
+                return total
+            await asyncio.sleep(BATCH_PAUSE)
+
+    async def archive(self):
+        if not self.archive_days:
+            return 0
+
+        before = utc_str(datetime.now(timezone.utc) - timedelta(days=self.archive_days))
+        total = 0
+        while True:
+            moved = await archive_tasks(before, self.batch_size)
+            total += moved
+            if moved < self.batch_size:
+                return total
+            await asyncio.sleep(BATCH_PAUSE)
+
+    async def optimize(self):
+        now = datetime.now(self.tz)
+        today = now.date().isoformat()
+        if not self.in_quiet_hours(now) or await get_meta(OPTIMIZE_KEY) == today:
+            return None
+
+        result = await optimize_db(VACUUM_PAGES)
+        await set_meta(OPTIMIZE_KEY, today)
+        # None یعنی backend حافظه (DB_BACKEND=memory)
+        if result["auto_vacuum"] not in (2, None):
+            print(
+                "Database is not in incremental auto_vacuum mode; "
+                "run VACUUM once to reclaim archived pages"
+            )
+        return result
+
+    async def run_once(self):
+        expired = await self.expire()
+        archived = await self.archive()
+        optimized = await self.optimize()
+        if expired or archived or optimized:
+            print(
+                f"Maintenance: expired {expired}, archived {archived}, "
+                f"optimized {optimized}"
+            )
+
+    async def run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Error in maintenance: {e}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,590 @@
+import heapq
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta, timezone
+
+from db import TASK_ALREADY_DONE, TASK_DONE, TASK_EXPIRED, TASK_NOT_FOUND
+from db import TASK_TOO_NEW
+from models import Stats, Task, User
+from ranking import ScoreIndex
+
+# DB_BACKEND=memory: همون توابع db.py ولی همه چیز در dict ها و ایندکس‌هایی که
+# کوئری‌های db.py لازم دارن. برای تست‌ها، بنچمارک‌ها و اجرای بدون دیسک
+# (با ریستارت همه چیز از بین میره و بین چند پروسه هم مشترک نیست).
+# همه‌ی توابع زیر یک قفل اجرا میشن چون async_db اونها رو روی ترد صدا میزنه.
+
+DONE_DELAY = timedelta(minutes=30)
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_lock = threading.RLock()
+
+
+class _Store:
+    def __init__(self):
+        self.users = {}  # telegram_id -> User
+        self.users_by_id = {}  # id -> User
+        self.tasks = {}  # id -> Task
+        self.user_tasks = {}  # user_id -> {id: Task} به ترتیب id
+        self.pending = {}  # id -> Task (انجام نشده و منقضی نشده)
+        self.user_pending = {}  # user_id -> {id: Task}
+        self.done_on = {}  # روز done_date -> {id: Task}
+        self.archive = {}  # id -> Task
+        self.user_archive = {}  # user_id -> {id: Task}
+        self.meta = {}
+        self.fsm = {}  # key -> (state, data, updated_at)
+        self.counters = {"users": 0, "done_tasks": 0, "pending_tasks": 0}
+        self.daily = {}  # روز -> [tasks_created, tasks_done, active_users]
+        self.last_user_id = 0
+        self.last_task_id = 0
+        self.score_index = ScoreIndex()
+        self.score_index.load([])
+
+
+_store = _Store()
+
+
+def _now():
+    # مثل CURRENT_TIMESTAMP در SQLite به UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _now_str():
+    return _now().strftime(TIME_FORMAT)
+
+
+def _today_str():
+    return _now().date().isoformat()
+
+
+def reset():
+    global _store
+    with _lock:
+        _store = _Store()
+
+
+def get_pool_size():
+    return 1
+
+
+def init_db():
+    pass
+
+
+def close():
+    # چیزی برای بستن نیست؛ داده‌ها تا پایان پروسه میمونن
+    pass
+
+
+def get_user_cache_stats():
+    return None
+
+
+def forget_users(telegram_ids):
+    pass
+
+
+def _daily(day):
+    row = _store.daily.get(day)
+    if row is None:
+        row = _store.daily[day] = [0, 0, 0]
+    return row
+
+
+def _save_user(user):
+    _store.users[user.telegram_id] = user
+    _store.users_by_id[user.id] = user
+    _store.score_index.update(user.telegram_id, user.score)
+    return user
+
+
+def _touch(user_id):
+    # مثل trigger های db.py: اولین تغییر کاربر در روز
+    user = _store.users_by_id.get(user_id)
+    today = _today_str()
+    if user is None or user.last_active == today:
+        return
+    _save_user(user.replace(last_active=today))
+    _daily(today)[2] += 1
+
+
+def _get_user_id(telegram_id):
+    user = _store.users.get(telegram_id)
+    if user is None:
+        return None
+    return user.id
+
+
+def _is_pending(task):
+    return not task.is_done and not task.is_expired
+
+
+def _unindex(task):
+    _store.tasks.pop(task.id, None)
+    _store.user_tasks.get(task.user_id, {}).pop(task.id, None)
+    _store.pending.pop(task.id, None)
+    _store.user_pending.get(task.user_id, {}).pop(task.id, None)
+    if task.done_date:
+        _store.done_on.get(task.done_date[:10], {}).pop(task.id, None)
+
+
+def _update_task(task, **changes):
+    # کلید dict ها عوض نمیشه پس ترتیب id در user_tasks سر جاش میمونه
+    task = task.replace(**changes)
+    _store.tasks[task.id] = task
+    _store.user_tasks[task.user_id][task.id] = task
+    if _is_pending(task):
+        _store.pending[task.id] = task
+        _store.user_pending[task.user_id][task.id] = task
+    else:
+        _store.pending.pop(task.id, None)
+        _store.user_pending.get(task.user_id, {}).pop(task.id, None)
+    if task.done_date:
+        _store.done_on.setdefault(task.done_date[:10], {})[task.id] = task
+    return task
+
+
+def get_user_by_telegram_id(telegram_id):
+    with _lock:
+        return _store.users.get(telegram_id)
+
+
+def add_user(telegram_id, full_name):
+    with _lock:
+        if telegram_id in _store.users:
+            # همون خطای UNIQUE در db.py
+            raise sqlite3.IntegrityError("UNIQUE constraint failed: users.telegram_id")
+
+        _store.last_user_id += 1
+        user = User(
+            _store.last_user_id,
+            telegram_id,
+            full_name,
+            0,
+            _now_str(),
+            1,
+            None,
+        )
+        _store.counters["users"] += 1
+        return _save_user(user)
+
+
+def _add_task(user_telegram_id, title, category, priority):
+    user_id = _get_user_id(user_telegram_id)
+    if user_id is None:
+        return False
+
+    # تبدیل‌ها قبل از هر تغییری؛ rollback نداریم و خطا نباید نصفه کاره بمونه
+    priority = int(priority)
+    _store.last_task_id += 1
+    task = Task(
+        _store.last_task_id,
+        user_id,
+        title,
+        category,
+        priority,
+        _now_str(),
+        0,
+        None,
+        0,
+    )
+    _store.tasks[task.id] = task
+    _store.user_tasks.setdefault(user_id, {})[task.id] = task
+    _store.pending[task.id] = task
+    _store.user_pending.setdefault(user_id, {})[task.id] = task
+
+    _store.counters["pending_tasks"] += 1
+    _daily(_today_str())[0] += 1
+    _touch(user_id)
+    return task.id
+
+
+def add_task(user_telegram_id, title, category, priority):
+    with _lock:
+        return _add_task(user_telegram_id, title, category, priority)
+
+
+def _add_tasks(user_telegram_id, tasks):
+    if _get_user_id(user_telegram_id) is None:
+        return False
+
+    # مثل savepoint در db.py: یا همه ثبت میشن یا هیچ‌کدوم
+    rows = [(title, category, int(priority)) for title, category, priority in tasks]
+    for title, category, priority in rows:
+        _add_task(user_telegram_id, title, category, priority)
+    return len(rows)
+
+
+def add_tasks(user_telegram_id, tasks):
+    with _lock:
+        return _add_tasks(user_telegram_id, tasks)
+
+
+def get_user_tasks(telegram_id, only_pending=True, after_id=0, limit=None):
+    with _lock:
+        user_id = _get_user_id(telegram_id)
+        if user_id is None:
+            return []
+
+        if only_pending:
+            tasks = _store.user_pending.get(user_id, {}).values()
+        else:
+            tasks = _store.user_tasks.get(user_id, {}).values()
+
+        result = []
+        for task in tasks:
+            if limit is not None and 0 <= limit <= len(result):
+                break
+            if task.id <= after_id or task.is_expired:
+                continue
+            result.append(
+                Task(
+                    id=task.id,
+                    title=task.title,
+                    category=task.category,
+                    priority=task.priority,
+                )
+            )
+        return result
+
+
+def get_prev_tasks_cursor(telegram_id, before_id, limit):
+    with _lock:
+        user_id = _get_user_id(telegram_id)
+        if user_id is None:
+            return 0
+
+        ids = [
+            task_id
+            for task_id in _store.user_pending.get(user_id, {})
+            if task_id <= before_id
+        ]
+
+    ids.reverse()
+    if len(ids) <= limit:
+        return 0
+    return ids[limit]
+
+
+def _delete_task(task_id, telegram_id):
+    user_id = _get_user_id(telegram_id)
+    task = _store.tasks.get(task_id)
+    if user_id is None or task is None or task.user_id != user_id:
+        return False
+
+    _unindex(task)
+    _store.counters["done_tasks"] -= task.is_done
+    _store.counters["pending_tasks"] -= _is_pending(task)
+    _touch(user_id)
+
+    user = _store.users_by_id[user_id]
+    _save_user(user.replace(score=user.score - 2))
+    return True
+
+
+def delete_task(task_id, telegram_id):
+    with _lock:
+        return _delete_task(task_id, telegram_id)
+
+
+def _mark_task_done(task_id, telegram_id):
+    user_id = _get_user_id(telegram_id)
+    task = _store.tasks.get(task_id)
+    if user_id is None or task is None or task.user_id != user_id:
+        return False, TASK_NOT_FOUND
+    if task.is_done:
+        return False, TASK_ALREADY_DONE
+    if task.is_expired:
+        return False, TASK_EXPIRED
+
+    now = _now()
+    ready_at = datetime.strptime(task.created_at, TIME_FORMAT) + DONE_DELAY
+    if ready_at > now:
+        return False, TASK_TOO_NEW.format(int((ready_at - now).total_seconds() / 60))
+
+    task = _update_task(task, is_done=1, done_date=now.strftime(TIME_FORMAT))
+    _store.counters["done_tasks"] += 1
+    _store.counters["pending_tasks"] -= 1
+    _daily(_today_str())[1] += 1
+    _touch(user_id)
+
+    user = _store.users_by_id[user_id]
+    _save_user(user.replace(score=user.score + task.priority))
+    return True, TASK_DONE.format(task.priority)
+
+
+def mark_task_done(task_id, telegram_id):
+    with _lock:
+        return _mark_task_done(task_id, telegram_id)
+
+
+WRITE_OPS = {
+    "add_task": _add_task,
+    "add_tasks": _add_tasks,
+    "delete_task": _delete_task,
+    "mark_task_done": _mark_task_done,
+}
+
+
+def apply_writes(ops):
+    # مثل db.apply_writes: (True, نتیجه) یا (False, exception) برای هر عملیات
+    # عملیات‌ها همه چیز رو قبل از تغییر دادن داده‌ها چک میکنن، پس عملیاتی که
+    # خطا داده چیزی از خودش باقی نمیذاره
+    results = []
+    with _lock:
+        for name, args in ops:
+            try:
+                results.append((True, WRITE_OPS[name](*args)))
+            except Exception as e:
+                results.append((False, e))
+    return results
+
+
+def get_all_users():
+    with _lock:
+        return list(_store.users)
+
+
+def get_active_users():
+    with _lock:
+        return [user.telegram_id for user in _store.users.values() if user.is_active]
+
+
+def set_user_active(telegram_id, is_active):
+    with _lock:
+        user = _store.users.get(telegram_id)
+        if user is None:
+            return False
+        _save_user(user.replace(is_active=int(is_active)))
+        return True
+
+
+def get_done_tasks_today(telegram_id):
+    with _lock:
+        user_id = _get_user_id(telegram_id)
+        if user_id is None:
+            return [], 0
+
+        tasks = [
+            task
+            for task in _store.done_on.get(_today_str(), {}).values()
+            if task.user_id == user_id
+        ]
+
+    return [task.title for task in tasks], sum(task.priority for task in tasks)
+
+
+def get_user_count():
+    with _lock:
+        return _store.counters["users"]
+
+
+def get_total_done_tasks():
+    with _lock:
+        return _store.counters["done_tasks"]
+
+
+def get_stats():
+    with _lock:
+        counters = _store.counters
+        daily = _store.daily.get(_today_str(), [0, 0, 0])
+        return Stats(
+            counters["users"],
+            counters["done_tasks"],
+            counters["pending_tasks"],
+            *daily,
+        )
+
+
+def rebuild_stats():
+    with _lock:
+        today = _today_str()
+        tasks = _store.tasks.values()
+        _store.counters = {
+            "users": len(_store.users),
+            "done_tasks": sum(task.is_done for task in tasks)
+            + sum(task.is_done for task in _store.archive.values()),
+            "pending_tasks": len(_store.pending),
+        }
+        _store.daily[today] = [
+            sum(task.created_at[:10] == today for task in tasks),
+            len(_store.done_on.get(today, {})),
+            sum(user.last_active == today for user in _store.users.values()),
+        ]
+
+    return get_stats()
+
+
+def _done_between(start, end):
+    # (user_id, task) های انجام شده در بازه؛ فقط روزهای داخل بازه خونده میشن
+    for day in sorted(_store.done_on):
+        if day < start[:10] or day > end[:10]:
+            continue
+        for task in _store.done_on[day].values():
+            if start <= task.done_date < end:
+                yield task
+
+
+def get_user_done_tasks_today(user_telegram_id):
+    # مثل db.py بر اساس تاریخ محلی
+    today = date.today()
+    start = today.isoformat()
+    end = (today + timedelta(days=1)).isoformat()
+
+    with _lock:
+        user_id = _get_user_id(user_telegram_id)
+        return [
+            Task(title=task.title, priority=task.priority)
+            for task in _done_between(start, end)
+            if task.user_id == user_id
+        ]
+
+
+def _done_by_user(start, end, after_telegram_id):
+    users = {}
+    for task in _done_between(start, end):
+        user = _store.users_by_id[task.user_id]
+        if not user.is_active or user.telegram_id <= after_telegram_id:
+            continue
+        titles, total = users.get(user.telegram_id, ([], 0))
+        titles.append(task.title)
+        users[user.telegram_id] = (titles, total + task.priority)
+    return users
+
+
+def iter_done_tasks_between(start, end, after_telegram_id=0, limit=-1, chunk_size=500):
+    with _lock:
+        users = _done_by_user(start, end, after_telegram_id)
+
+    telegram_ids = sorted(users)
+    if limit >= 0:
+        telegram_ids = telegram_ids[:limit]
+    for telegram_id in telegram_ids:
+        titles, total_priority = users[telegram_id]
+        yield telegram_id, titles, total_priority
+
+
+def count_users_done_between(start, end, after_telegram_id=0):
+    with _lock:
+        return len(_done_by_user(start, end, after_telegram_id))
+
+
+def iter_user_tasks(telegram_id, chunk_size=500):
+    with _lock:
+        user_id = _get_user_id(telegram_id)
+        if user_id is None:
+            return
+
+        archived = sorted(
+            _store.user_archive.get(user_id, {}).values(), key=lambda task: task.id
+        )
+        tasks = [task.replace(archived=True) for task in archived] + [
+            task.replace(archived=False)
+            for task in _store.user_tasks.get(user_id, {}).values()
+        ]
+
+    yield from tasks
+
+
+def get_meta(key, default=None):
+    with _lock:
+        return _store.meta.get(key, default)
+
+
+def set_meta(key, value):
+    with _lock:
+        if value is None:
+            _store.meta.pop(key, None)
+        else:
+            _store.meta[key] = str(value)
+
+
+def expire_stale_tasks(before, limit=500):
+    with _lock:
+        stale = []
+        for task in _store.pending.values():
+            if len(stale) >= limit:
+                break
+            if task.created_at < before:
+                stale.append(task)
+
+        owners = []
+        for task in stale:
+            _update_task(task, is_expired=1)
+            _store.counters["pending_tasks"] -= 1
+            owners.append(_store.users_by_id[task.user_id].telegram_id)
+
+    return owners
+
+
+def archive_tasks(before, limit=500):
+    with _lock:
+        old = []
+        for task in _store.tasks.values():
+            if len(old) >= limit:
+                break
+            if (task.is_done and task.done_date < before) or (
+                task.is_expired and task.created_at < before
+            ):
+                old.append(task)
+
+        # آمار تغییر نمیکنه، مثل trigger در db.py
+        for task in old:
+            _unindex(task)
+            _store.archive[task.id] = task
+            _store.user_archive.setdefault(task.user_id, {})[task.id] = task
+
+    return len(old)
+
+
+def optimize_db(vacuum_pages=1000):
+    return {"auto_vacuum": None, "freelist": 0}
+
+
+def get_task_by_id(task_id):
+    with _lock:
+        task = _store.tasks.get(task_id)
+    if task is None:
+        return None
+    return Task(id=task.id, title=task.title)
+
+
+def get_fsm_record(key, min_updated_at=0):
+    with _lock:
+        record = _store.fsm.get(key)
+    if record is None or record[2] < min_updated_at:
+        return None
+    return record[0], record[1]
+
+
+def save_fsm_records(records):
+    with _lock:
+        for key, state, data, updated_at in records:
+            if state is None and data == "{}":
+                _store.fsm.pop(key, None)
+            else:
+                _store.fsm[key] = (state, data, updated_at)
+
+
+def delete_expired_fsm_records(before):
+    with _lock:
+        expired = [key for key, record in _store.fsm.items() if record[2] < before]
+        for key in expired:
+            del _store.fsm[key]
+    return len(expired)
+
+
+def get_top_users(limit=10):
+    with _lock:
+        top = heapq.nsmallest(
+            limit, _store.users.values(), key=lambda user: (-user.score, user.id)
+        )
+    return [
+        User(telegram_id=user.telegram_id, full_name=user.full_name, score=user.score)
+        for user in top
+    ]
+
+
+def get_user_position(telegram_id):
+    with _lock:
+        index = _store.score_index
+        return index.position(telegram_id), len(index)
@@ -0,0 +1,235 @@
+import time
+from bisect import bisect_left
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+# مرز bucket های هیستوگرام به ثانیه (مثل پیش‌فرض‌های Prometheus)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    # فقط شمارنده‌ی هر bucket نگه داشته میشه؛ تجمعی کردن موقع خروجی گرفتن
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # تخمین از روی مرز بالای bucket
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    # همه چیز روی ترد event loop به‌روز میشه، پس قفل لازم نیست
+    def __init__(self):
+        self.handlers = {}
+        self.handler_errors = {}
+        self.api = {}
+        self.api_errors = {}
+        self.retry_after = 0
+        self.started_at = time.time()
+
+    def observe_handler(self, event_type, handler, seconds, error=False):
+        key = (event_type, handler)
+        histogram = self.handlers.get(key)
+        if histogram is None:
+            histogram = self.handlers[key] = Histogram()
+        histogram.observe(seconds)
+        if error:
+            self.handler_errors[key] = self.handler_errors.get(key, 0) + 1
+
+    def observe_api(self, method, seconds, error=None):
+        histogram = self.api.get(method)
+        if histogram is None:
+            histogram = self.api[method] = Histogram()
+        histogram.observe(seconds)
+        if error is not None:
+            key = (method, error)
+            self.api_errors[key] = self.api_errors.get(key, 0) + 1
+
+    def handler_stats(self):
+        return sorted(
+            (
+                {
+                    "event": event_type,
+                    "handler": handler,
+                    "count": histogram.count,
+                    "errors": self.handler_errors.get((event_type, handler), 0),
+                    "avg_ms": histogram.sum / histogram.count * 1000,
+                    "p95_ms": histogram.quantile(0.95) * 1000,
+                }
+                for (event_type, handler), histogram in self.handlers.items()
+            ),
+            key=lambda stats: stats["count"],
+            reverse=True,
+        )
+
+    def api_stats(self):
+        count = sum(histogram.count for histogram in self.api.values())
+        total = sum(histogram.sum for histogram in self.api.values())
+        return {
+            "calls": count,
+            "errors": sum(self.api_errors.values()),
+            "retry_after": self.retry_after,
+            "avg_ms": total / count * 1000 if count else 0,
+        }
+
+    def render(self):
+        # Prometheus text format (version 0.0.4)
+        lines = [
+            "# HELP otos_handler_seconds Handler latency",
+            "# TYPE otos_handler_seconds histogram",
+        ]
+        for (event_type, handler), histogram in self.handlers.items():
+            labels = f'event="{event_type}",handler="{handler}"'
+            lines += _histogram_lines("otos_handler_seconds", labels, histogram)
+
+        lines += [
+            "# HELP otos_handler_errors_total Handler exceptions",
+            "# TYPE otos_handler_errors_total counter",
+        ]
+        for (event_type, handler), count in self.handler_errors.items():
+            lines.append(
+                f'otos_handler_errors_total{{event="{event_type}",'
+                f'handler="{handler}"}} {count}'
+            )
+
+        lines += [
+            "# HELP otos_bot_api_seconds Bot API request latency",
+            "# TYPE otos_bot_api_seconds histogram",
+        ]
+        for method, histogram in self.api.items():
+            lines += _histogram_lines(
+                "otos_bot_api_seconds", f'method="{method}"', histogram
+            )
+
+        lines += [
+            "# HELP otos_bot_api_errors_total Failed Bot API requests",
+            "# TYPE otos_bot_api_errors_total counter",
+        ]
+        for (method, error), count in self.api_errors.items():
+            lines.append(
+                f'otos_bot_api_errors_total{{method="{method}",error="{error}"}} {count}'
+            )
+
+        lines += [
+            "# HELP otos_bot_api_retry_after_total 429 responses from Telegram",
+            "# TYPE otos_bot_api_retry_after_total counter",
+            f"otos_bot_api_retry_after_total {self.retry_after}",
+            "# TYPE otos_start_time_seconds gauge",
+            f"otos_start_time_seconds {self.started_at}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(name, labels, histogram):
+    for bound, total in histogram.cumulative():
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        yield f'{name}_bucket{{{labels},le="{le}"}} {total}'
+    yield f"{name}_sum{{{labels}}} {histogram.sum}"
+    yield f"{name}_count{{{labels}}} {histogram.count}"
+
+
+registry = Metrics()
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # outer middleware: کل زمان update شامل فیلترها و هندلر
+    # اسم هندلری که اجرا شد رو HandlerNameMiddleware (inner) داخل slot مینویسه
+    def __init__(self, event_type, registry=registry):
+        self.event_type = event_type
+        self.registry = registry
+
+    async def __call__(self, handler, event, data):
+        slot = data["metrics_handler"] = ["unhandled"]
+        started = time.perf_counter()
+        try:
+            result = await handler(event, data)
+        except Exception:
+            self.registry.observe_handler(
+                self.event_type, slot[0], time.perf_counter() - started, error=True
+            )
+            raise
+        self.registry.observe_handler(
+            self.event_type, slot[0], time.perf_counter() - started
+        )
+        return result
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        slot = data.get("metrics_handler")
+        if slot is not None:
+            slot[0] = data["handler"].callback.__name__
+        return await handler(event, data)
+
+
+class BotAPIMetricsMiddleware(BaseRequestMiddleware):
+    def __init__(self, registry=registry):
+        self.registry = registry
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            response = await make_request(bot, method)
+        except TelegramRetryAfter:
+            self.registry.retry_after += 1
+            self.registry.observe_api(
+                name, time.perf_counter() - started, error="retry_after"
+            )
+            raise
+        except Exception as e:
+            self.registry.observe_api(
+                name, time.perf_counter() - started, error=type(e).__name__
+            )
+            raise
+        self.registry.observe_api(name, time.perf_counter() - started)
+        return response
+
+
+def setup(dp, bot, registry=registry):
+    for event_type in ("message", "callback_query"):
+        observer = dp.observers[event_type]
+        observer.outer_middleware(HandlerMetricsMiddleware(event_type, registry))
+        observer.middleware(HandlerNameMiddleware())
+    bot.session.middleware(BotAPIMetricsMiddleware(registry))
+
+
+async def start_server(host="127.0.0.1", port=9100, registry=registry):
+    async def handle(request):
+        return web.Response(
+            text=registry.render(), content_type="text/plain", charset="utf-8"
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Metrics server listening on {host}:{port}/metrics")
+    return runner
@@ -0,0 +1,69 @@
+# رکوردهایی که backend های دیتابیس (db.py و memory_db.py) برمیگردونن
+# ترتیب فیلدها همون ترتیب ستون‌های جدول است تا User(*row) کار کنه
+# فیلدهایی که کوئری نخونده None میمونن
+
+
+class Record:
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def replace(self, **kwargs):
+        return type(self)(**{**self.as_dict(), **kwargs})
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class User(Record):
+    __slots__ = (
+        "id",
+        "telegram_id",
+        "full_name",
+        "score",
+        "join_date",
+        "is_active",
+        "last_active",
+    )
+
+
+class Task(Record):
+    # archived: از tasks_archive خونده شده (فقط در iter_user_tasks)
+    __slots__ = (
+        "id",
+        "user_id",
+        "title",
+        "category",
+        "priority",
+        "created_at",
+        "is_done",
+        "done_date",
+        "is_expired",
+        "archived",
+    )
+
+
+class Stats(Record):
+    __slots__ = (
+        "users",
+        "done_tasks",
+        "pending_tasks",
+        "tasks_created_today",
+        "tasks_done_today",
+        "active_users_today",
+    )
@@ -0,0 +1,186 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+
+SLOW_MS = 100
+SLOW_LOG_SIZE = 50
+
+_SPACES = re.compile(r"\s+")
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def normalize(sql):
+    # کوئری‌هایی که فقط در مقدارها فرق دارن یکی حساب میشن
+    sql = _STRINGS.sub("?", sql)
+    sql = _NUMBERS.sub("?", sql)
+    sql = _IN_LISTS.sub("IN (...)", sql)
+    return _SPACES.sub(" ", sql).strip()
+
+
+class QueryProfiler:
+    # زمان هر statement (execute به اضافه‌ی fetch ها) به تفکیک SQL نرمال شده
+    def __init__(self, slow_ms=SLOW_MS):
+        self.enabled = False
+        self.slow_ms = slow_ms
+        self.started_at = time.time()
+        self.slow = deque(maxlen=SLOW_LOG_SIZE)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, sql, seconds, new_statement):
+        key = normalize(sql)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = [0, 0.0, 0.0, 0]
+            if new_statement:
+                stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def record_slow(self, conn, sql, params, seconds):
+        with self._lock:
+            self._stats[normalize(sql)][3] += 1
+
+        try:
+            # روی کلاس پایه تا خود EXPLAIN دوباره پروفایل نشه
+            plan = [
+                row[-1]
+                for row in sqlite3.Connection.execute(
+                    conn, "EXPLAIN QUERY PLAN " + sql, params
+                )
+            ]
+        except sqlite3.Error:
+            plan = []
+
+        entry = {
+            "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "ms": round(seconds * 1000, 3),
+            "sql": normalize(sql),
+            "plan": plan,
+        }
+        self.slow.append(entry)
+        print(f"Slow query ({entry['ms']}ms): {entry['sql']}")
+        for step in plan:
+            print(f"    {step}")
+
+    def top(self, limit=10, key="total"):
+        index = {"count": 0, "total": 1, "max": 2}[key]
+        with self._lock:
+            items = sorted(
+                self._stats.items(), key=lambda item: item[1][index], reverse=True
+            )
+        return [
+            {
+                "sql": sql,
+                "count": count,
+                "total_ms": total * 1000,
+                "avg_ms": total / count * 1000 if count else 0,
+                "max_ms": max_ * 1000,
+                "slow": slow,
+            }
+            for sql, (count, total, max_, slow) in items[:limit]
+        ]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.slow.clear()
+            self.started_at = time.time()
+
+    def dump(self, path):
+        report = {
+            "since": time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(self.started_at)
+            ),
+            "slow_ms": self.slow_ms,
+            "queries": self.top(limit=len(self._stats)),
+            "slow": list(self.slow),
+        }
+        with open(path, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        return path
+
+
+profiler = QueryProfiler()
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    _sql = None
+    _params = ()
+    _elapsed = 0.0
+    _logged = False
+
+    def _timed(self, func, *args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self._add(time.perf_counter() - started, new_statement=False)
+
+    def _add(self, seconds, new_statement):
+        if self._sql is None:
+            return
+        self._elapsed += seconds
+        profiler.record(self._sql, seconds, new_statement)
+        if not self._logged and self._elapsed * 1000 >= profiler.slow_ms:
+            self._logged = True
+            profiler.record_slow(
+                self.connection, self._sql, self._params, self._elapsed
+            )
+
+    def _start(self, sql, params):
+        self._sql = sql
+        self._params = params
+        self._elapsed = 0.0
+        self._logged = False
+
+    def execute(self, sql, params=()):
+        self._start(sql, params)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._add(time.perf_counter() - started, new_statement=True)
+
+    def executemany(self, sql, seq_of_params):
+        # پارامترها ممکنه generator باشن، پس برای EXPLAIN پارامتری نگه نمیداریم
+        self._start(sql, ())
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            self._add(time.perf_counter() - started, new_statement=True)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return self._timed(super().fetchmany)
+        return self._timed(super().fetchmany, size)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+    def __next__(self):
+        return self._timed(super().__next__)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    # Connection.execute کرسر خودش رو میسازه و cursor() رو صدا نمیزنه
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
@@ -0,0 +1,51 @@
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+
+
+class ScoreIndex:
+    # امتیاز همه‌ی کاربران به صورت مرتب نگه داشته میشه تا رتبه‌ی هر کاربر
+    # با یک جستجوی دودویی پیدا بشه، نه با COUNT روی کل جدول users
+    def __init__(self):
+        self.loaded = False
+        self.loaded_at = 0.0
+        self._scores = []
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    def load(self, rows):
+        with self._lock:
+            self._by_user = {telegram_id: score for telegram_id, score in rows}
+            self._scores = sorted(self._by_user.values())
+            self.loaded = True
+            self.loaded_at = time.monotonic()
+
+    def is_fresh(self, ttl=0):
+        if not self.loaded:
+            return False
+        return not ttl or time.monotonic() - self.loaded_at < ttl
+
+    def update(self, telegram_id, score):
+        with self._lock:
+            if not self.loaded:
+                return
+
+            old = self._by_user.get(telegram_id)
+            if old == score:
+                return
+            if old is not None:
+                del self._scores[bisect_left(self._scores, old)]
+
+            insort(self._scores, score)
+            self._by_user[telegram_id] = score
+
+    def position(self, telegram_id):
+        # رتبه = تعداد امتیازهای بیشتر + 1 (امتیاز برابر یعنی رتبه‌ی برابر)
+        with self._lock:
+            score = self._by_user.get(telegram_id)
+            if score is None:
+                return None
+            return len(self._scores) - bisect_right(self._scores, score) + 1
+
+    def __len__(self):
+        return len(self._scores)
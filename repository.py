@@ -0,0 +1,79 @@
+import os
+
+import db
+import memory_db
+
+# backend دیتابیس با DB_BACKEND انتخاب میشه: sqlite (پیش‌فرض، db.py) یا
+# memory (memory_db.py). async_db.py همه‌ی توابع رو از backend انتخاب شده
+# صدا میزنه و test.py همین قرارداد رو روی هر دو اجرا میکنه.
+BACKENDS = {"sqlite": db, "memory": memory_db}
+
+# توابعی که هر backend باید با رفتار یکسان داشته باشه
+# (رکوردها از models.py: User، Task و Stats)
+OPERATIONS = (
+    "get_pool_size",
+    "init_db",
+    "close",
+    "get_user_cache_stats",
+    "forget_users",
+    "apply_writes",
+    # users
+    "get_user_by_telegram_id",
+    "add_user",
+    "get_all_users",
+    "get_active_users",
+    "set_user_active",
+    "get_top_users",
+    "get_user_position",
+    # tasks
+    "add_task",
+    "add_tasks",
+    "get_user_tasks",
+    "get_prev_tasks_cursor",
+    "delete_task",
+    "mark_task_done",
+    "get_task_by_id",
+    "get_done_tasks_today",
+    "get_user_done_tasks_today",
+    "iter_done_tasks_between",
+    "count_users_done_between",
+    "iter_user_tasks",
+    "expire_stale_tasks",
+    "archive_tasks",
+    "optimize_db",
+    # stats
+    "get_user_count",
+    "get_total_done_tasks",
+    "get_stats",
+    "rebuild_stats",
+    # meta و FSM
+    "get_meta",
+    "set_meta",
+    "get_fsm_record",
+    "save_fsm_records",
+    "delete_expired_fsm_records",
+)
+
+_backend = None
+
+
+def use(name):
+    global _backend
+
+    backend = BACKENDS.get(name)
+    if backend is None:
+        raise ValueError(f"Unknown DB_BACKEND: {name}")
+
+    missing = [op for op in OPERATIONS if not hasattr(backend, op)]
+    if missing:
+        raise TypeError(f"DB backend {name} is missing {', '.join(missing)}")
+
+    _backend = backend
+    return backend
+
+
+def get_backend():
+    # اولین بار از env خونده میشه (بعد از load_dotenv در bot.py)
+    if _backend is None:
+        return use(os.getenv("DB_BACKEND", "sqlite"))
+    return _backend
@@ -0,0 +1,128 @@
+import asyncio
+import math
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+from async_db import count_users_done_between, get_meta, iterate, set_meta
+from async_db import iter_done_tasks_between
+from broadcast import Broadcaster
+from utils import daily_report_text, utc_str
+
+REPORT_TIME = "23:30"
+REPORT_TZ = "Asia/Tehran"
+REPORT_WINDOW = 30 * 60
+REPORT_BATCH = 200
+
+LAST_RUN_KEY = "daily_report_last"
+CURSOR_KEY = "daily_report_cursor"
+
+
+class DailyReportScheduler:
+    def __init__(
+        self,
+        bot,
+        at=REPORT_TIME,
+        tz=REPORT_TZ,
+        window=REPORT_WINDOW,
+        batch_size=REPORT_BATCH,
+    ):
+        self.bot = bot
+        self.at = time.fromisoformat(at)
+        self.tz = ZoneInfo(tz)
+        self.window = window
+        self.batch_size = batch_size
+
+    def scheduled_at(self, day):
+        return datetime.combine(day, self.at, self.tz)
+
+    def day_bounds(self, day):
+        start = datetime.combine(day, time(0), self.tz)
+        end = datetime.combine(day + timedelta(days=1), time(0), self.tz)
+        return utc_str(start), utc_str(end)
+
+    async def next_run(self):
+        now = datetime.now(self.tz)
+        today = now.date()
+
+        last = await get_meta(LAST_RUN_KEY)
+        last = datetime.fromisoformat(last).date() if last else None
+
+        # اگه بات موقع اجرای دیروز یا امروز خاموش بوده، همین الان جبران کن
+        yesterday = today - timedelta(days=1)
+        if last is not None and last < yesterday:
+            return yesterday, now
+        if (last is None or last < today) and self.scheduled_at(today) <= now:
+            return today, now
+
+        if last is None or last < today:
+            return today, self.scheduled_at(today)
+
+        tomorrow = today + timedelta(days=1)
+        return tomorrow, self.scheduled_at(tomorrow)
+
+    async def run(self):
+        while True:
+            day, run_at = await self.next_run()
+            delay = (run_at - datetime.now(self.tz)).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            try:
+                await self.send_report(day)
+            except Exception as e:
+                print(f"Error in daily report for {day}: {e}")
+                await asyncio.sleep(60)
+
+    async def send_report(self, day):
+        day_str = day.isoformat()
+        start, end = self.day_bounds(day)
+
+        # اگه وسط ارسال ریستارت شده باشیم، از آخرین دسته‌ی کامل شده ادامه میدیم
+        after_id = 0
+        cursor = await get_meta(CURSOR_KEY)
+        if cursor:
+            cursor_day, cursor_id = cursor.split(":")
+            if cursor_day == day_str:
+                after_id = int(cursor_id)
+
+        count = await count_users_done_between(start, end, after_id)
+        batches = max(1, math.ceil(count / self.batch_size))
+        interval = self.window / batches
+
+        loop = asyncio.get_running_loop()
+        broadcaster = Broadcaster(self.bot)
+        sent = failed = blocked = 0
+
+        while True:
+            # هر دسته یک کوئری کوتاه جداست تا کانکشن reader در طول پنجره نگه داشته نشه
+            started = loop.time()
+            batch = [
+                (telegram_id, daily_report_text(day_str, titles, total_smiles))
+                async for telegram_id, titles, total_smiles in iterate(
+                    iter_done_tasks_between,
+                    start,
+                    end,
+                    after_id,
+                    limit=self.batch_size,
+                )
+            ]
+            if not batch:
+                break
+
+            result = await broadcaster.run(batch)
+            sent += result.sent
+            failed += result.failed
+            blocked += result.blocked
+
+            after_id = batch[-1][0]
+            await set_meta(CURSOR_KEY, f"{day_str}:{after_id}")
+
+            rest = interval - (loop.time() - started)
+            if rest > 0 and len(batch) == self.batch_size:
+                await asyncio.sleep(rest)
+
+        await set_meta(LAST_RUN_KEY, day_str)
+        await set_meta(CURSOR_KEY, None)
+        print(
+            f"Daily report {day_str}: sent {sent}, failed {failed}, blocked {blocked}"
+        )
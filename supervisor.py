@@ -0,0 +1,386 @@
+import argparse
+import asyncio
+import json
+import os
+import secrets
+import signal
+import sys
+
+from aiohttp import ClientSession, ClientTimeout, web
+from dotenv import load_dotenv
+
+import db
+from repository import get_backend
+
+# python supervisor.py --workers 4                (polling در پروسه‌ی جلو)
+# RUN_MODE=webhook python supervisor.py --workers 4
+#
+# پروسه‌ی جلو update ها رو میگیره و بر اساس from_user.id به یکی از N پروسه‌ی
+# bot.py میفرسته، پس همه‌ی update های یک کاربر همیشه به ترتیب به همون worker
+# میرسن (کش‌های کاربر، FSM و محدودیت‌ها هم فقط همون‌جا هستن).
+# worker ها هر کدوم یک سرور webhook روی 127.0.0.1 هستن و همه از همون otos.db
+# (WAL) استفاده میکنن.
+
+WORKERS = 2
+WORKER_BASE_PORT = 8100
+WORKER_PATH = "/update"
+QUEUE_SIZE = 10000
+HEALTH_INTERVAL = 5
+HEALTH_FAILURES = 3
+STARTUP_TIMEOUT = 30
+SHUTDOWN_TIMEOUT = 15
+SCORE_INDEX_TTL = 60
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def update_user_id(update):
+    # کاربر update از روی from (یا chat) همان شیء داخل update
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user") or value.get("chat")
+        if user:
+            return user.get("id", 0)
+        message = value.get("message")
+        if message:
+            return message.get("chat", {}).get("id", 0)
+    return 0
+
+
+class Worker:
+    def __init__(self, index, port, secret, env):
+        self.index = index
+        self.port = port
+        self.secret = secret
+        self.env = env
+        self.url = f"http://127.0.0.1:{port}"
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.process = None
+        self.failures = 0
+        self.forwarded = 0
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            os.path.join(BASE_DIR, "bot.py"),
+            env=self.env,
+            cwd=BASE_DIR,
+            # Ctrl+C فقط به supervisor میرسه تا خاموش شدن به ترتیب انجام بشه
+            start_new_session=True,
+        )
+        self.failures = 0
+        print(f"Worker {self.index} started (pid {self.process.pid}, port {self.port})")
+
+    async def wait_ready(self, session, timeout=STARTUP_TIMEOUT):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            if self.process.returncode is not None:
+                raise RuntimeError(f"Worker {self.index} exited during startup")
+            if await self.healthy(session):
+                return
+            await asyncio.sleep(0.2)
+        raise RuntimeError(f"Worker {self.index} did not become ready")
+
+    async def healthy(self, session):
+        try:
+            async with session.get(
+                self.url + "/health", timeout=ClientTimeout(total=2)
+            ) as response:
+                return response.status == 200
+        except Exception:
+            return False
+
+    async def stop(self, timeout=SHUTDOWN_TIMEOUT):
+        if self.process is None or self.process.returncode is not None:
+            return
+        # SIGINT یعنی KeyboardInterrupt در bot.py و اجرای finally های main()
+        self.process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Worker {self.index} did not stop in time, killing it")
+            self.process.kill()
+            await self.process.wait()
+
+    async def forward(self, session):
+        # update ها یکی یکی و به ترتیب فرستاده میشن؛ اگه worker در دسترس
+        # نباشه همون update دوباره امتحان میشه تا ترتیب به هم نخوره
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret}
+        while True:
+            update = await self.queue.get()
+            delay = 0.2
+            try:
+                while True:
+                    try:
+                        async with session.post(
+                            self.url + WORKER_PATH, json=update, headers=headers
+                        ) as response:
+                            if response.status == 200:
+                                break
+                            print(f"Worker {self.index} answered {response.status}")
+                    except Exception as e:
+                        print(f"Error forwarding to worker {self.index}: {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 5)
+                self.forwarded += 1
+            finally:
+                self.queue.task_done()
+
+
+class Supervisor:
+    def __init__(
+        self,
+        workers=WORKERS,
+        base_port=WORKER_BASE_PORT,
+        mode="polling",
+        token=None,
+        api_url=None,
+        webhook=None,
+        worker_env=None,
+    ):
+        self.mode = mode
+        self.token = token
+        self.api_url = api_url
+        self.webhook = webhook or {}
+        self.secret = secrets.token_urlsafe(16)
+        self.stopping = asyncio.Event()
+        self.received = 0
+
+        metrics_port = int(os.getenv("METRICS_PORT", 0))
+        self.workers = []
+        for index in range(workers):
+            env = dict(os.environ)
+            env.update(
+                {
+                    "RUN_MODE": "webhook",
+                    "WEBHOOK_HOST": "127.0.0.1",
+                    "WEBHOOK_PORT": str(base_port + index),
+                    "WEBHOOK_PATH": WORKER_PATH,
+                    "WEBHOOK_SECRET": self.secret,
+                    "WEBHOOK_URL": "",
+                    # همون فایلی که supervisor مایگریتش کرده، مستقل از cwd
+                    "DB_NAME": os.path.abspath(db.DB_NAME),
+                    "SCORE_INDEX_TTL": os.getenv(
+                        "SCORE_INDEX_TTL", str(SCORE_INDEX_TTL)
+                    ),
+                    "METRICS_PORT": str(metrics_port + index) if metrics_port else "0",
+                    # برای فرستادن invalidation به worker صاحب هر کاربر
+                    "WORKER_INDEX": str(index),
+                    "WORKERS": str(workers),
+                    "WORKER_BASE_PORT": str(base_port),
+                }
+            )
+            # کارهای زمان‌بندی شده فقط در worker صفر
+            if index:
+                env["DAILY_REPORT"] = "off"
+                env["MAINTENANCE"] = "off"
+            env.update(worker_env or {})
+            self.workers.append(Worker(index, base_port + index, self.secret, env))
+
+    def route(self, update):
+        worker = self.workers[update_user_id(update) % len(self.workers)]
+        return worker.queue.put(update)
+
+    async def start_workers(self, session):
+        # worker ها فقط از طریق فایل دیتابیس داده‌ی مشترک دارن
+        if get_backend() is not db:
+            raise RuntimeError("Sharded mode needs DB_BACKEND=sqlite")
+
+        # مایگریشن‌ها یک بار اینجا، قبل از اینکه worker ها همزمان سراغش برن
+        db.init_db()
+        db.close()
+
+        for worker in self.workers:
+            await worker.start()
+        await asyncio.gather(*(worker.wait_ready(session) for worker in self.workers))
+
+    async def health_loop(self, session):
+        while not self.stopping.is_set():
+            await asyncio.sleep(HEALTH_INTERVAL)
+            for worker in self.workers:
+                if self.stopping.is_set():
+                    return
+                if worker.process.returncode is None:
+                    if await worker.healthy(session):
+                        worker.failures = 0
+                        continue
+                    worker.failures += 1
+                    if worker.failures < HEALTH_FAILURES:
+                        continue
+                    print(f"Worker {worker.index} is not responding, restarting")
+                    await worker.stop(timeout=5)
+                else:
+                    print(
+                        f"Worker {worker.index} exited "
+                        f"({worker.process.returncode}), restarting"
+                    )
+
+                try:
+                    await worker.start()
+                    await worker.wait_ready(session)
+                except Exception as e:
+                    print(f"Error restarting worker {worker.index}: {e}")
+
+    async def poll(self):
+        from aiogram import Bot
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+
+        session = None
+        if self.api_url:
+            session = AiohttpSession(api=TelegramAPIServer.from_base(self.api_url))
+        bot = Bot(self.token, session=session)
+
+        offset = None
+        try:
+            await bot.delete_webhook()
+            while not self.stopping.is_set():
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=25)
+                except Exception as e:
+                    print(f"Error getting updates: {e}")
+                    await asyncio.sleep(1)
+                    continue
+
+                for update in updates:
+                    offset = update.update_id + 1
+                    self.received += 1
+                    await self.route(
+                        update.model_dump(mode="json", by_alias=True, exclude_none=True)
+                    )
+        finally:
+            await bot.session.close()
+
+    async def start_webhook(self):
+        path = self.webhook.get("path", "/webhook")
+        secret = self.webhook.get("secret")
+
+        async def handle(request):
+            if secret and (
+                request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret
+            ):
+                return web.Response(status=401)
+            self.received += 1
+            await self.route(await request.json())
+            return web.Response()
+
+        async def health(request):
+            return web.json_response(self.stats())
+
+        app = web.Application()
+        app.router.add_post(path, handle)
+        app.router.add_get("/health", health)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        host = self.webhook.get("host", "0.0.0.0")
+        port = self.webhook.get("port", 8080)
+        await web.TCPSite(runner, host, port).start()
+        print(f"Supervisor webhook listening on {host}:{port}{path}")
+
+        url = self.webhook.get("url")
+        if url:
+            from aiogram import Bot
+
+            async with Bot(self.token) as bot:
+                await bot.set_webhook(url.rstrip("/") + path, secret_token=secret)
+        return runner
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "workers": [
+                {
+                    "index": worker.index,
+                    "pid": worker.process.pid if worker.process else None,
+                    "alive": bool(worker.process) and worker.process.returncode is None,
+                    "queued": worker.queue.qsize(),
+                    "forwarded": worker.forwarded,
+                }
+                for worker in self.workers
+            ],
+        }
+
+    async def run(self, ready=None):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stopping.set)
+
+        async with ClientSession() as session:
+            await self.start_workers(session)
+            forwarders = [
+                asyncio.create_task(worker.forward(session)) for worker in self.workers
+            ]
+            health = asyncio.create_task(self.health_loop(session))
+            # ready فقط وقتی که سرور جلو واقعا گوش میده
+            if self.mode == "webhook":
+                runner = await self.start_webhook()
+                front = asyncio.create_task(self.stopping.wait())
+            else:
+                runner = None
+                front = asyncio.create_task(self.poll())
+            print(f"Supervisor running {len(self.workers)} workers ({self.mode})")
+            if ready is not None:
+                ready.set()
+
+            try:
+                await self.stopping.wait()
+            finally:
+                # اول دریافت update متوقف میشه، بعد صف‌ها خالی میشن و بعد worker ها
+                front.cancel()
+                health.cancel()
+                await asyncio.gather(front, health, return_exceptions=True)
+                if runner is not None:
+                    await runner.cleanup()
+
+                try:
+                    await asyncio.wait_for(
+                        asyncio.gather(*(w.queue.join() for w in self.workers)),
+                        SHUTDOWN_TIMEOUT,
+                    )
+                except asyncio.TimeoutError:
+                    print("Some updates were not delivered before shutdown")
+
+                for task in forwarders:
+                    task.cancel()
+                await asyncio.gather(*forwarders, return_exceptions=True)
+                await asyncio.gather(*(worker.stop() for worker in self.workers))
+                print(json.dumps(self.stats()))
+
+
+def main():
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Run OTOS as N worker processes")
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("WORKERS", WORKERS))
+    )
+    parser.add_argument(
+        "--base-port",
+        type=int,
+        default=int(os.getenv("WORKER_BASE_PORT", WORKER_BASE_PORT)),
+    )
+    parser.add_argument("--mode", default=os.getenv("RUN_MODE", "polling"))
+    args = parser.parse_args()
+
+    supervisor = Supervisor(
+        workers=args.workers,
+        base_port=args.base_port,
+        mode=args.mode,
+        token=os.getenv("API_KEY"),
+        api_url=os.getenv("BOT_API_URL"),
+        webhook={
+            "url": os.getenv("WEBHOOK_URL"),
+            "path": os.getenv("WEBHOOK_PATH", "/webhook"),
+            "secret": os.getenv("WEBHOOK_SECRET"),
+            "host": os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+            "port": int(os.getenv("WEBHOOK_PORT", 8080)),
+        },
+    )
+    asyncio.run(supervisor.run())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
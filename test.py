@@ -0,0 +1,1006 @@
+import asyncio
+import time
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramForbiddenError, TelegramNetworkError
+from aiogram.exceptions import TelegramRetryAfter, TelegramServerError
+from aiogram.fsm.storage.base import DefaultKeyBuilder, StorageKey
+from aiogram.methods import SendMessage
+from aiogram.types import CallbackQuery
+from aiogram.types import User as TgUser
+from aiohttp import web
+
+import async_db
+import broadcast
+import db
+import memory_db
+import repository
+import scheduler
+import throttling
+from broadcast import Broadcaster
+from fsm_storage import SQLiteStorage
+from invalidation import INVALIDATE_PATH, Invalidator
+from models import Stats, Task, User
+from ranking import ScoreIndex
+from repository import BACKENDS, OPERATIONS
+from scheduler import CURSOR_KEY, LAST_RUN_KEY, DailyReportScheduler
+from throttling import THROTTLED_TEXT, ThrottlingMiddleware
+from utils import TASK_ERROR_REASONS, parse_task, split_task_blocks
+from utils import bulk_task_text, parse_task_blocks
+from utils import TASKS_PAGE_SIZE, TaskPagesCache, tasks_keyboard
+from utils import daily_report_text
+from webhook import create_app
+
+# قرارداد مشترک backend های دیتابیس (هر تست با fixture ی backend روی sqlite و
+# memory اجرا میشه) و رفتار صف نوشتن، کش صفحه‌ها، invalidation و throttling
+# python -m pytest -q test.py
+
+FAR_FUTURE = "9999-12-31 00:00:00"
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def backend(request, tmp_path):
+    # async_db هم از همین backend استفاده کنه
+    repository.use(request.param)
+    if request.param == "memory":
+        memory_db.reset()
+        yield memory_db
+        memory_db.reset()
+        return
+
+    db.close()
+    db.DB_NAME = str(tmp_path / "otos.db")
+    db.user_cache.clear()
+    db.leaderboard_cache.clear()
+    db.score_index = ScoreIndex()
+    db.init_db()
+    yield db
+    db.close()
+
+
+def age_tasks(backend, minutes=60):
+    # کار باید نیم ساعت عمر داشته باشه تا بشه انجامش داد
+    if backend is db:
+        with db.writer() as conn:
+            conn.execute(
+                "UPDATE tasks SET created_at = DATETIME('now', ?)",
+                (f"-{minutes} minutes",),
+            )
+        return
+
+    for task in list(memory_db._store.tasks.values()):
+        created_at = datetime.strptime(task.created_at, memory_db.TIME_FORMAT)
+        created_at -= memory_db.timedelta(minutes=minutes)
+        memory_db._update_task(
+            task, created_at=created_at.strftime(memory_db.TIME_FORMAT)
+        )
+
+
+def test_backends_implement_operations():
+    for backend in BACKENDS.values():
+        for name in OPERATIONS:
+            assert callable(getattr(backend, name)), name
+
+
+def test_add_user(backend):
+    assert backend.get_user_by_telegram_id(10) is None
+
+    user = backend.add_user(10, "Ali")
+    assert isinstance(user, User)
+    assert (user.telegram_id, user.full_name, user.score) == (10, "Ali", 0)
+    assert user.is_active
+    datetime.strptime(user.join_date, "%Y-%m-%d %H:%M:%S")
+
+    assert backend.get_user_by_telegram_id(10) == user
+    assert backend.get_user_count() == 1
+    assert backend.get_all_users() == [10]
+
+
+def test_set_user_active(backend):
+    backend.add_user(10, "Ali")
+
+    assert backend.set_user_active(10, False)
+    assert not backend.get_user_by_telegram_id(10).is_active
+    assert backend.get_active_users() == []
+
+    assert backend.set_user_active(10, True)
+    assert backend.get_active_users() == [10]
+    assert not backend.set_user_active(11, True)
+
+
+def test_forget_users(backend):
+    backend.add_user(10, "Ali")
+    assert backend.get_user_by_telegram_id(10).is_active
+
+    # پروسه‌ی دیگه‌ای (worker دیگه‌ی supervisor.py) کاربر رو غیرفعال کرده
+    if backend is db:
+        with db.writer() as conn:
+            conn.execute("UPDATE users SET is_active = 0 WHERE telegram_id = 10")
+    else:
+        backend.set_user_active(10, False)
+
+    backend.forget_users([10, 11])
+    assert not backend.get_user_by_telegram_id(10).is_active
+
+
+def test_tasks_need_a_user(backend):
+    assert backend.add_task(10, "title", "work", 1) is False
+    assert backend.add_tasks(10, [("title", "work", 1)]) is False
+    assert backend.get_user_tasks(10) == []
+
+
+def test_user_tasks_pages(backend):
+    backend.add_user(10, "Ali")
+    ids = [backend.add_task(10, f"task {i}", "work", 1) for i in range(5)]
+    assert backend.add_tasks(10, [("bulk 1", "home", "2"), ("bulk 2", None, 3)]) == 2
+
+    tasks = backend.get_user_tasks(10)
+    assert all(isinstance(task, Task) for task in tasks)
+    assert [task.title for task in tasks] == [
+        "task 0",
+        "task 1",
+        "task 2",
+        "task 3",
+        "task 4",
+        "bulk 1",
+        "bulk 2",
+    ]
+    assert (tasks[5].category, tasks[5].priority) == ("home", 2)
+
+    page = backend.get_user_tasks(10, after_id=ids[1], limit=2)
+    assert [task.id for task in page] == ids[2:4]
+    assert backend.get_prev_tasks_cursor(10, ids[3], 2) == ids[1]
+    assert backend.get_prev_tasks_cursor(10, ids[1], 2) == 0
+
+    assert backend.get_task_by_id(ids[0]).title == "task 0"
+    assert backend.get_task_by_id(ids[-1] + 100) is None
+
+
+def test_mark_task_done(backend):
+    backend.add_user(10, "Ali")
+    task_id = backend.add_task(10, "read", "study", 3)
+
+    success, msg = backend.mark_task_done(task_id, 10)
+    assert not success
+    assert msg.startswith("⚠️")
+
+    age_tasks(backend)
+    assert backend.mark_task_done(task_id, 11) == (False, db.TASK_NOT_FOUND)
+    assert backend.mark_task_done(task_id, 10) == (True, db.TASK_DONE.format(3))
+    assert backend.mark_task_done(task_id, 10) == (False, db.TASK_ALREADY_DONE)
+
+    assert backend.get_user_by_telegram_id(10).score == 3
+    assert backend.get_user_tasks(10) == []
+    assert [task.id for task in backend.get_user_tasks(10, only_pending=False)] == [
+        task_id
+    ]
+    assert backend.get_done_tasks_today(10) == (["read"], 3)
+    assert backend.get_total_done_tasks() == 1
+
+
+def test_delete_task(backend):
+    backend.add_user(10, "Ali")
+    backend.add_user(11, "Sara")
+    task_id = backend.add_task(10, "read", "study", 1)
+
+    assert not backend.delete_task(task_id, 11)
+    assert backend.delete_task(task_id, 10)
+    assert not backend.delete_task(task_id, 10)
+
+    assert backend.get_user_by_telegram_id(10).score == -2
+    assert backend.get_task_by_id(task_id) is None
+    assert backend.get_stats().pending_tasks == 0
+
+
+def test_apply_writes(backend):
+    backend.add_user(10, "Ali")
+
+    results = backend.apply_writes(
+        [
+            ("add_task", (10, "one", "work", 1)),
+            ("add_task", (11, "two", "work", 1)),
+            ("add_tasks", (10, [("three", "work", 2), ("four", "work", 3)])),
+        ]
+    )
+    assert [ok for ok, _ in results] == [True, True, True]
+    assert results[1][1] is False
+    assert results[2][1] == 2
+
+    task_id = results[0][1]
+    results = backend.apply_writes(
+        [("delete_task", (task_id, 10)), ("mark_task_done", (task_id, 10))]
+    )
+    assert results == [(True, True), (True, (False, db.TASK_NOT_FOUND))]
+    assert len(backend.get_user_tasks(10)) == 2
+
+    # عملیاتی که خطا میده هیچ اثری نمیذاره، بقیه‌ی دسته ثبت میشن
+    results = backend.apply_writes(
+        [
+            ("add_tasks", (10, [("a", "work", 1), ("b", "work", "x")])),
+            ("add_task", (10, "c", "work", "y")),
+            ("add_task", (10, "d", "work", 2)),
+        ]
+    )
+    assert [ok for ok, _ in results] == [False, False, True]
+    assert isinstance(results[0][1], ValueError)
+    assert [task.title for task in backend.get_user_tasks(10)] == ["three", "four", "d"]
+    assert backend.get_stats().pending_tasks == 3
+    assert backend.get_stats().tasks_created_today == 4
+
+
+def test_stats(backend):
+    backend.add_user(10, "Ali")
+    backend.add_user(11, "Sara")
+    backend.add_tasks(10, [("one", "work", 1), ("two", "work", 2)])
+    task_id = backend.add_task(11, "three", "work", 3)
+    age_tasks(backend)
+    backend.mark_task_done(task_id, 11)
+
+    stats = backend.get_stats()
+    assert isinstance(stats, Stats)
+    assert stats == Stats(
+        users=2,
+        done_tasks=1,
+        pending_tasks=2,
+        tasks_created_today=3,
+        tasks_done_today=1,
+        active_users_today=2,
+    )
+    assert backend.rebuild_stats() == stats
+
+
+def test_top_users_and_position(backend):
+    backend.add_user(10, "Ali")
+    backend.add_user(11, "Sara")
+    backend.add_user(12, "Reza")
+    assert backend.get_user_position(10) == (1, 3)
+
+    backend.delete_task(backend.add_task(10, "one", "work", 1), 10)
+    done_id = backend.add_task(11, "two", "work", 3)
+    age_tasks(backend)
+    backend.mark_task_done(done_id, 11)
+
+    top = backend.get_top_users(2)
+    assert [(user.full_name, user.score) for user in top] == [
+        ("Sara", 3),
+        ("Reza", 0),
+    ]
+    assert backend.get_user_position(11) == (1, 3)
+    assert backend.get_user_position(10) == (3, 3)
+    assert backend.get_user_position(13)[0] is None
+
+
+def test_done_tasks_report(backend):
+    for telegram_id in (10, 11, 12):
+        backend.add_user(telegram_id, str(telegram_id))
+        backend.add_tasks(telegram_id, [("a", "work", 1), ("b", "work", 2)])
+    age_tasks(backend)
+    for task in backend.get_user_tasks(10):
+        backend.mark_task_done(task.id, 10)
+    backend.mark_task_done(backend.get_user_tasks(12)[0].id, 12)
+    backend.set_user_active(12, False)
+
+    report = list(backend.iter_done_tasks_between("0000", FAR_FUTURE))
+    assert [
+        (telegram_id, sorted(titles), total) for telegram_id, titles, total in report
+    ] == [(10, ["a", "b"], 3)]
+    assert backend.count_users_done_between("0000", FAR_FUTURE) == 1
+    assert backend.count_users_done_between("0000", FAR_FUTURE, 10) == 0
+
+
+def test_expire_and_archive(backend):
+    backend.add_user(10, "Ali")
+    backend.add_tasks(10, [("old", "work", 1), ("done", "work", 2)])
+    age_tasks(backend)
+    done_id = backend.get_user_tasks(10)[1].id
+    backend.mark_task_done(done_id, 10)
+
+    assert backend.expire_stale_tasks(FAR_FUTURE) == [10]
+    assert backend.expire_stale_tasks(FAR_FUTURE) == []
+    assert backend.get_user_tasks(10) == []
+    assert backend.get_stats().pending_tasks == 0
+
+    expired_id = done_id - 1
+    assert backend.mark_task_done(expired_id, 10) == (False, db.TASK_EXPIRED)
+
+    assert backend.archive_tasks(FAR_FUTURE) == 2
+    assert backend.archive_tasks(FAR_FUTURE) == 0
+    assert backend.get_stats().done_tasks == 1
+    assert backend.rebuild_stats().done_tasks == 1
+
+    history = list(backend.iter_user_tasks(10))
+    assert [
+        (task.title, task.is_done, task.is_expired, task.archived) for task in history
+    ] == [
+        ("old", 0, 1, True),
+        ("done", 1, 0, True),
+    ]
+    backend.optimize_db()
+
+
+def test_export_history(backend):
+    backend.add_user(10, "Ali")
+    task_id = backend.add_task(10, "read", "study", 2)
+
+    (task,) = backend.iter_user_tasks(10)
+    assert (task.id, task.title, task.category, task.priority) == (
+        task_id,
+        "read",
+        "study",
+        2,
+    )
+    assert (task.is_done, task.done_date, task.is_expired, task.archived) == (
+        0,
+        None,
+        0,
+        False,
+    )
+    assert list(backend.iter_user_tasks(11)) == []
+
+
+def run_async(coro):
+    # هر تست event loop خودش رو داره، پس صف نوشتن هم باید تازه باشه
+    async_db.write_queue = async_db.WriteQueue()
+    try:
+        return asyncio.run(coro)
+    finally:
+        async_db.shutdown()
+
+
+def test_concurrent_exports(backend):
+    # export ها نباید reader های pool رو بین تکه‌ها نگه دارن؛ وگرنه با 4 export
+    # نیمه‌کاره، 5 خواندن همه‌ی تردهای executor رو منتظر reader نگه میدارن و
+    # هیچ چیز (حتی نوشتن‌ها) جلو نمیره
+    backend.add_user(10, "Ali")
+    backend.add_tasks(10, [(f"task {i}", "work", 1) for i in range(1200)])
+
+    started = []
+    all_started = asyncio.Event()
+
+    async def export():
+        count = 0
+        async for _ in async_db.iterate(async_db.iter_user_tasks, 10):
+            count += 1
+            if count == 1:
+                started.append(1)
+                if len(started) == 4:
+                    all_started.set()
+                await all_started.wait()
+        return count
+
+    async def main():
+        exports = [asyncio.create_task(export()) for _ in range(4)]
+        await all_started.wait()
+        reads = [async_db.get_user_tasks(10, limit=1) for _ in range(5)]
+        reads.append(async_db.add_task(10, "new", "work", 1))
+        return await asyncio.wait_for(asyncio.gather(*exports, *reads), 20)
+
+    results = run_async(main())
+    assert all(count in (1200, 1201) for count in results[:4])
+    assert results[-1]
+
+
+def test_write_queue_batch(backend):
+    backend.add_user(10, "Ali")
+
+    async def scenario():
+        # همه در یک دسته؛ نتیجه و خطای هر عملیات به درخواست خودش میرسه
+        async_db.write_queue.max_delay = 0.05
+        return await asyncio.gather(
+            async_db.add_task(10, "one", "work", 1),
+            async_db.add_task(11, "two", "work", 1),
+            async_db.add_task(10, "bad", "work", "x"),
+            async_db.add_tasks(10, [("three", "work", 2), ("four", "home", 3)]),
+            async_db.mark_task_done(999, 10),
+            return_exceptions=True,
+        )
+
+    task_id, no_user, error, added, done = run_async(scenario())
+    assert isinstance(task_id, int)
+    assert no_user is False
+    assert isinstance(error, ValueError)
+    assert added == 2
+    assert done == (False, db.TASK_NOT_FOUND)
+    assert [task.title for task in backend.get_user_tasks(10)] == [
+        "one",
+        "three",
+        "four",
+    ]
+
+
+def test_write_queue_stats(backend):
+    backend.add_user(10, "Ali")
+
+    async def scenario():
+        queue = async_db.write_queue = async_db.WriteQueue(max_batch=2)
+        await asyncio.gather(
+            *(async_db.add_task(10, f"task {i}", "work", 1) for i in range(5))
+        )
+        return queue.stats()
+
+    stats = run_async(scenario())
+    assert (stats["batches"], stats["ops"], stats["max_batch"]) == (3, 5, 2)
+    assert stats["avg_batch"] == 5 / 3
+    assert 0 <= stats["avg_wait_ms"] <= stats["max_wait_ms"]
+    assert len(backend.get_user_tasks(10)) == 5
+
+
+def test_write_queue_commit_error(backend, monkeypatch):
+    backend.add_user(10, "Ali")
+
+    def apply_writes(ops):
+        raise RuntimeError("disk I/O error")
+
+    # خطای commit به همه‌ی درخواست‌های دسته میرسه و صف برای دسته‌ی بعد آماده است
+    async def scenario():
+        with monkeypatch.context() as patch:
+            patch.setattr(backend, "apply_writes", apply_writes)
+            failed = await asyncio.gather(
+                async_db.add_task(10, "one", "work", 1),
+                async_db.delete_task(1, 10),
+                return_exceptions=True,
+            )
+        return failed, await async_db.add_task(10, "two", "work", 1)
+
+    failed, task_id = run_async(scenario())
+    assert [type(error) for error in failed] == [RuntimeError, RuntimeError]
+    assert [task.id for task in backend.get_user_tasks(10)] == [task_id]
+
+
+def test_meta(backend):
+    assert backend.get_meta("key", "default") == "default"
+    backend.set_meta("key", 5)
+    assert backend.get_meta("key") == "5"
+    backend.set_meta("key", None)
+    assert backend.get_meta("key") is None
+
+
+def test_fsm_records(backend):
+    backend.save_fsm_records(
+        [
+            ("a", "RegisterState:waiting_for_name", "{}", 100),
+            ("b", None, '{"x": 1}', 50),
+        ]
+    )
+    assert backend.get_fsm_record("a") == ("RegisterState:waiting_for_name", "{}")
+    assert backend.get_fsm_record("a", min_updated_at=101) is None
+
+    assert backend.delete_expired_fsm_records(60) == 1
+    assert backend.get_fsm_record("b") is None
+
+    backend.save_fsm_records([("a", None, "{}", 200)])
+    assert backend.get_fsm_record("a") is None
+
+
+def fsm_key(user_id):
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+def test_fsm_storage(backend, monkeypatch):
+    saves = []
+    save_fsm_records = backend.save_fsm_records
+
+    def spy(records):
+        saves.append(sorted(key for key, *_ in records))
+        if len(saves) == 1:
+            raise RuntimeError("database is locked")
+        return save_fsm_records(records)
+
+    monkeypatch.setattr(backend, "save_fsm_records", spy)
+    builder = DefaultKeyBuilder(with_destiny=True)
+    # یک state قدیمی‌تر از state_ttl و یکی تازه که مستقیم در دیتابیس هستن
+    now = int(time.time())
+    save_fsm_records(
+        [
+            (builder.build(fsm_key(8)), "Old:state", "{}", now - 120),
+            (builder.build(fsm_key(9)), "Fresh:state", '{"a": 1}', now),
+        ]
+    )
+
+    async def scenario():
+        storage = SQLiteStorage(state_ttl=60, flush_interval=0.01)
+        # نوشتن‌های نزدیک به هم با یک save_fsm_records ثبت میشن؛ اولیش خطا میده
+        await storage.set_state(fsm_key(1), "Register:name")
+        await storage.set_data(fsm_key(1), {"name": "Ali"})
+        await storage.set_state(fsm_key(2), "Register:name")
+        await asyncio.sleep(0.05)
+        failed = list(saves)
+
+        # دفعه‌ی بعد همراه نوشتن جدید دوباره امتحان میشه و close() هم flush میکنه
+        await storage.set_state(fsm_key(3), None)
+        await storage.close()
+
+        fresh = SQLiteStorage(state_ttl=60)
+        return failed, [
+            await fresh.get_state(fsm_key(1)),
+            await fresh.get_data(fsm_key(1)),
+            await fresh.get_state(fsm_key(2)),
+            await fresh.get_state(fsm_key(8)),
+            await fresh.get_state(fsm_key(9)),
+            await fresh.get_data(fsm_key(9)),
+        ]
+
+    failed, loaded = run_async(scenario())
+    keys = [builder.build(fsm_key(user_id)) for user_id in (1, 2, 3)]
+    assert failed == [keys[:2]]
+    assert saves == [keys[:2], keys]
+    assert loaded == [
+        "Register:name",
+        {"name": "Ali"},
+        "Register:name",
+        None,
+        "Fresh:state",
+        {"a": 1},
+    ]
+
+
+def test_invalidation_routes_to_owner():
+    secret = "secret"
+    forgotten = {0: [], 1: [], 2: []}
+
+    async def scenario():
+        runners = []
+        base_port = None
+        for index in forgotten:
+            app = create_app(
+                Dispatcher(),
+                Bot("123:abc"),
+                path="/update",
+                secret=secret,
+                on_invalidate=forgotten[index].extend,
+            )
+            runner = web.AppRunner(app)
+            await runner.setup()
+            port = base_port + index if base_port else 0
+            site = web.TCPSite(runner, "127.0.0.1", port)
+            await site.start()
+            if base_port is None:
+                base_port = runner.addresses[0][1]
+            runners.append(runner)
+
+        invalidator = Invalidator()
+        invalidator.setup(
+            forgotten[1].extend,
+            index=1,
+            workers=3,
+            base_port=base_port,
+            secret=secret,
+        )
+        stranger = Invalidator()
+        stranger.setup(None, index=1, workers=3, base_port=base_port)
+        try:
+            await invalidator.invalidate([3, 4, 5, 6, 7, 9])
+            await stranger.invalidate([12])
+        finally:
+            await invalidator.close()
+            await stranger.close()
+            for runner in runners:
+                await runner.cleanup()
+        return invalidator, stranger
+
+    invalidator, stranger = run_async(scenario())
+    # worker خودش مستقیم، بقیه با یک درخواست برای هر worker
+    assert forgotten == {0: [3, 6, 9], 1: [4, 7], 2: [5]}
+    assert (invalidator.sent, invalidator.errors) == (2, 0)
+    # بدون secret درست چیزی باطل نمیشه
+    assert (stranger.sent, stranger.errors) == (0, 1)
+
+
+def test_invalidate_route_needs_secret():
+    def paths(app):
+        return {resource.canonical for resource in app.router.resources()}
+
+    dp, bot = Dispatcher(), Bot("123:abc")
+    assert INVALIDATE_PATH in paths(
+        create_app(dp, bot, secret="s", on_invalidate=print)
+    )
+    assert INVALIDATE_PATH not in paths(create_app(dp, bot, on_invalidate=print))
+    assert INVALIDATE_PATH not in paths(create_app(dp, bot, secret="s"))
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "title\n#cat\n2",
+        "title\n\n#cat\n2",
+        "title\n#cat\n\n2",
+        "\n title \n\n #cat \n 2 \n",
+    ],
+)
+def test_single_task_with_blank_lines(text):
+    blocks = split_task_blocks(text)
+    assert blocks == [["title", "#cat", "2"]]
+    assert parse_task(blocks[0]) == (("title", "cat", "2"), None)
+
+
+def test_invalid_blocks_are_checked_one_by_one():
+    # بدون یک کار درست از همه‌ی خط‌ها، هر بلوک جدا دلیل خودش رو داره
+    assert split_task_blocks("title\n\n2\n\n9") == [["title"], ["2"], ["9"]]
+    assert split_task_blocks("a\n1\n\nbad") == [["a", "1"], ["bad"]]
+
+
+def test_bulk_task_one_good_one_bad():
+    blocks = split_task_blocks("a\n1\n\nb\n7")
+    tasks, rejected = parse_task_blocks(blocks)
+    assert tasks == [("a", "نامشخص", "1")]
+
+    reply = bulk_task_text(len(tasks), len(blocks), rejected)
+    assert reply == (
+        "✅ 1 کار از 2 کار ثبت شد\n\n" f"❌ کار 2 (b): {TASK_ERROR_REASONS['priority']}"
+    )
+
+
+def test_bulk_task_reasons_per_block():
+    blocks = split_task_blocks("a\n1\n\nbad\n\nc\n#x #y\n2")
+    tasks, rejected = parse_task_blocks(blocks)
+    assert tasks == [("a", "نامشخص", "1")]
+    assert rejected == [
+        f"❌ کار 2 (bad): {TASK_ERROR_REASONS['format']}",
+        f"❌ کار 3 (c): {TASK_ERROR_REASONS['hashtag']}",
+    ]
+
+
+def test_multi_task_blocks():
+    blocks = split_task_blocks("a\n1\n\nb\n#work\n3\n\nonly\n\nc\n7")
+    assert blocks == [["a", "1"], ["b", "#work", "3"], ["only"], ["c", "7"]]
+    assert [parse_task(block) for block in blocks] == [
+        (("a", "نامشخص", "1"), None),
+        (("b", "work", "3"), None),
+        (None, "format"),
+        (None, "priority"),
+    ]
+
+
+def page_tasks(*ids):
+    return [Task(task_id, 1, f"task {task_id}") for task_id in ids]
+
+
+def buttons(markup):
+    return [
+        [(button.text, button.callback_data) for button in row]
+        for row in markup.inline_keyboard
+    ]
+
+
+@pytest.mark.parametrize("cursor", [0, 7])
+@pytest.mark.parametrize("has_next", [False, True])
+def test_task_pages_remove_task(cursor, has_next):
+    pages = TaskPagesCache()
+    pages.set(10, cursor, page_tasks(8, 9, 11), has_next)
+
+    # از وسط و از آخر صفحه
+    for task_id, left in ((9, (8, 11)), (11, (8,))):
+        pages.remove_task(10, task_id)
+        page = pages.get(10, cursor)
+        assert page["tasks"] == page_tasks(*left)
+        assert buttons(page["markup"]) == buttons(
+            tasks_keyboard(page_tasks(*left), cursor, has_next)
+        )
+
+    pages.remove_task(10, 8)
+    assert pages.get(10, cursor) is None
+
+
+@pytest.mark.parametrize("cursor", [0, 7])
+def test_task_pages_add_task(cursor):
+    pages = TaskPagesCache()
+    pages.set(10, cursor, page_tasks(8, 9), False)
+    pages.set(10, 100, page_tasks(101), True)
+
+    pages.add_task(10, page_tasks(12)[0])
+    page = pages.get(10, cursor)
+    assert page["tasks"] == page_tasks(8, 9, 12)
+    assert buttons(page["markup"]) == buttons(
+        tasks_keyboard(page_tasks(8, 9, 12), cursor, False)
+    )
+    # صفحه‌ای که بعدش صفحه‌ی دیگه‌ای هست دست نمیخوره
+    assert pages.get(10, 100)["tasks"] == page_tasks(101)
+
+    # صفحه‌ی پر دور ریخته میشه تا دوباره از دیتابیس خونده بشه
+    pages.set(10, cursor, page_tasks(*range(20, 20 + TASKS_PAGE_SIZE)), False)
+    pages.add_task(10, page_tasks(50)[0])
+    assert pages.get(10, cursor) is None
+
+
+def test_task_pages_read_write_race():
+    pages = TaskPagesCache()
+
+    # خوندن قبل از commit شروع شده و بعد از remove_task/add_task تموم میشه
+    for write in (
+        lambda: pages.remove_task(10, 2),
+        lambda: pages.add_task(10, page_tasks(4)[0]),
+        lambda: pages.invalidate(10),
+    ):
+        generation = pages.generation(10)
+        write()
+        page = pages.set(10, 0, page_tasks(1, 2, 3), False, generation=generation)
+        assert page["tasks"] == page_tasks(1, 2, 3)
+        assert pages.get(10, 0) is None
+
+    # خوندن بعد از commit تسک جدید رو دیده؛ add_task دوباره اضافه‌اش نمیکنه
+    generation = pages.generation(10)
+    pages.set(10, 0, page_tasks(1, 2, 4), False, generation=generation)
+    pages.add_task(10, page_tasks(4)[0])
+    page = pages.get(10, 0)
+    assert page["tasks"] == page_tasks(1, 2, 4)
+    assert buttons(page["markup"]) == buttons(tasks_keyboard(page_tasks(1, 2, 4)))
+
+    # نسل کاربرهای دیگه جداست
+    generation = pages.generation(11)
+    pages.remove_task(10, 1)
+    pages.set(11, 0, page_tasks(5), False, generation=generation)
+    assert pages.get(11, 0)["tasks"] == page_tasks(5)
+
+
+def test_task_pages_invalidate():
+    pages = TaskPagesCache()
+    pages.set(10, 0, page_tasks(1), False)
+    pages.set(11, 0, page_tasks(2), False)
+
+    pages.invalidate(10)
+    pages.invalidate(12)
+    assert pages.get(10, 0) is None
+    assert pages.get(11, 0)["tasks"] == page_tasks(2)
+
+
+class FakeMessage:
+    def __init__(self, user_id, text):
+        self.from_user = TgUser(id=user_id, is_bot=False, first_name="Ali")
+        self.text = text
+        self.answers = []
+
+    async def answer(self, text):
+        self.answers.append(text)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(throttling.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_throttling_burst_and_refill(clock):
+    throttler = ThrottlingMiddleware(read_rate=1, read_burst=3)
+
+    assert [throttler.allow(10, "read") for _ in range(5)] == [
+        (True, False),
+        (True, False),
+        (True, False),
+        (False, True),
+        (False, False),
+    ]
+    # هر bucket جداست
+    assert throttler.allow(10, "write") == (True, False)
+    assert throttler.allow(11, "read") == (True, False)
+
+    clock[0] += 1.5
+    assert throttler.allow(10, "read") == (True, False)
+    assert throttler.allow(10, "read") == (False, True)
+
+    clock[0] += 60
+    assert [throttler.allow(10, "read")[0] for _ in range(4)] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+
+
+def test_throttling_kinds():
+    throttler = ThrottlingMiddleware()
+    user = TgUser(id=10, is_bot=False, first_name="Ali")
+
+    def callback(data):
+        return CallbackQuery(id="1", from_user=user, chat_instance="1", data=data)
+
+    assert throttler.kind(callback("task_done_5_0")) == "write"
+    assert throttler.kind(callback("task_delete_5_0")) == "write"
+    assert throttler.kind(callback("task_next_5_0")) == "read"
+    assert throttler.kind(FakeMessage(10, "/start")) == "read"
+    assert throttler.kind(FakeMessage(10, "گزارش امروز")) == "read"
+    assert throttler.kind(FakeMessage(10, "کار جدید\nwork\n1")) == "write"
+
+
+def test_throttling_bucket_cap(clock):
+    throttler = ThrottlingMiddleware(read_burst=1, max_buckets=2)
+
+    throttler.allow(1, "read")
+    throttler.allow(2, "read")
+    assert throttler.allow(1, "read") == (False, True)
+    # قدیمی‌ترین bucket (کاربر 2) دور ریخته میشه و دوباره پر شروع میکنه
+    throttler.allow(3, "read")
+    assert throttler.stats()["buckets"] == 2
+    assert throttler.allow(2, "read") == (True, False)
+    assert throttler.allow(3, "read") == (False, True)
+
+
+def test_throttling_middleware(clock):
+    throttler = ThrottlingMiddleware(write_rate=1, write_burst=2, exempt=(99,))
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event)
+        return "ok"
+
+    async def scenario():
+        results = []
+        for user_id in (10, 10, 10, 10, 99, 99, 99):
+            message = FakeMessage(user_id, "کار جدید")
+            results.append((await throttler(handler, message, {}), message.answers))
+        return results
+
+    results = run_async(scenario())
+    assert results == [
+        ("ok", []),
+        ("ok", []),
+        (None, [THROTTLED_TEXT]),
+        (None, []),
+        ("ok", []),
+        ("ok", []),
+        ("ok", []),
+    ]
+    assert len(handled) == 5
+    assert throttler.stats() == {"read": 0, "write": 2, "buckets": 1}
+
+
+@pytest.fixture
+def memory():
+    repository.use("memory")
+    memory_db.reset()
+    yield memory_db
+    memory_db.reset()
+
+
+class FakeBot:
+    # errors: chat_id -> لیست exception هایی که به ترتیب یک بار raise میشن
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.sent = []
+        self.calls = []
+
+    async def send_message(self, chat_id, text):
+        self.calls.append(chat_id)
+        errors = self.errors.get(chat_id)
+        if errors:
+            raise errors.pop(0)
+        self.sent.append((chat_id, text))
+
+
+def done_task(telegram_id, title, priority, done_date):
+    task_id = memory_db.add_task(telegram_id, title, "work", priority)
+    memory_db._update_task(
+        memory_db._store.tasks[task_id], is_done=1, done_date=done_date
+    )
+
+
+@pytest.fixture
+def tehran_now(monkeypatch):
+    now = [None]
+
+    class FixedDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now[0].astimezone(tz)
+
+    def set_now(text):
+        now[0] = datetime.fromisoformat(text).replace(tzinfo=ZoneInfo("Asia/Tehran"))
+        return now[0]
+
+    monkeypatch.setattr(scheduler, "datetime", FixedDatetime)
+    return set_now
+
+
+def test_report_day_bounds():
+    reports = DailyReportScheduler(None, tz="Asia/Tehran")
+    # تهران +03:30 است و done_date به وقت UTC ذخیره میشه
+    assert reports.day_bounds(date(2026, 3, 1)) == (
+        "2026-02-28 20:30:00",
+        "2026-03-01 20:30:00",
+    )
+
+
+@pytest.mark.parametrize(
+    "now, last, expected_day, at_once",
+    [
+        ("2026-03-01 10:00", None, "2026-03-01", False),
+        ("2026-03-01 23:45", None, "2026-03-01", True),
+        ("2026-03-01 10:00", "2026-02-28", "2026-03-01", False),
+        ("2026-03-01 23:45", "2026-02-28", "2026-03-01", True),
+        # روز قبل از دست رفته؛ اول همون جبران میشه
+        ("2026-03-01 10:00", "2026-02-27", "2026-02-28", True),
+        # گزارش امروز فرستاده شده؛ دوباره فرستاده نمیشه
+        ("2026-03-01 23:45", "2026-03-01", "2026-03-02", False),
+    ],
+)
+def test_report_next_run(memory, tehran_now, now, last, expected_day, at_once):
+    now = tehran_now(now)
+    if last:
+        memory.set_meta(LAST_RUN_KEY, last)
+    reports = DailyReportScheduler(None, at="23:30", tz="Asia/Tehran")
+
+    day, run_at = run_async(reports.next_run())
+    assert day == date.fromisoformat(expected_day)
+    assert run_at == (now if at_once else reports.scheduled_at(day))
+
+
+def test_send_report(memory, tehran_now):
+    for telegram_id in range(1, 6):
+        memory.add_user(telegram_id, f"user {telegram_id}")
+        done_task(telegram_id, f"task {telegram_id}", 2, "2026-03-01 10:00:00")
+    # 00:30 به وقت تهران، و یک کار از دیروز تهران
+    done_task(1, "early", 1, "2026-02-28 21:00:00")
+    done_task(2, "yesterday", 1, "2026-02-28 20:00:00")
+    memory.add_user(6, "blocked")
+    done_task(6, "task 6", 1, "2026-03-01 10:00:00")
+    memory.set_user_active(6, False)
+
+    tehran_now("2026-03-01 23:31")
+    bot = FakeBot()
+    reports = DailyReportScheduler(bot, tz="Asia/Tehran", window=0, batch_size=2)
+
+    # cursor مونده از ارسال نیمه‌کاره‌ی روز دیگه بی‌اثره
+    memory.set_meta(CURSOR_KEY, "2026-02-28:4")
+    run_async(reports.send_report(date(2026, 3, 1)))
+    assert [chat_id for chat_id, _ in bot.sent] == [1, 2, 3, 4, 5]
+    assert bot.sent[0][1] == daily_report_text("2026-03-01", ["early", "task 1"], 3)
+    assert "yesterday" not in bot.sent[1][1]
+    assert memory.get_meta(LAST_RUN_KEY) == "2026-03-01"
+    assert memory.get_meta(CURSOR_KEY) is None
+
+    bot = FakeBot()
+    reports.bot = bot
+    memory.set_meta(CURSOR_KEY, "2026-03-02:2")
+    run_async(reports.send_report(date(2026, 3, 2)))
+    assert bot.sent == []
+
+    # ریستارت وسط ارسال: از کاربر بعد از cursor ادامه میده
+    memory.set_meta(CURSOR_KEY, "2026-03-01:3")
+    run_async(reports.send_report(date(2026, 3, 1)))
+    assert [chat_id for chat_id, _ in bot.sent] == [4, 5]
+
+    # بعد از ارسال امروز، اجرای بعدی فرداست
+    day, _ = run_async(reports.next_run())
+    assert day == date(2026, 3, 2)
+
+
+def test_broadcast_errors(memory, monkeypatch):
+    for telegram_id in range(1, 6):
+        memory.add_user(telegram_id, f"user {telegram_id}")
+    monkeypatch.setattr(broadcast, "BACKOFF_BASE", 0)
+
+    method = SendMessage(chat_id=1, text="hi")
+    bot = FakeBot(
+        {
+            1: [TelegramRetryAfter(method, "flood", 30)],
+            2: [TelegramNetworkError(method, "timeout")],
+            3: [TelegramServerError(method, "bad gateway")] * 4,
+            4: [TelegramForbiddenError(method, "blocked")],
+        }
+    )
+    broadcaster = Broadcaster(bot, rate=1000, per_chat_interval=0)
+    pauses = []
+
+    def pause(seconds):
+        # RetryAfter کل ارسال‌ها رو نگه میداره؛ اینجا فقط ثبت میشه
+        pauses.append(seconds)
+        broadcaster.limiter._next_at = 0
+
+    broadcaster.limiter.pause = pause
+
+    async def scenario():
+        users = await async_db.get_active_users()
+        return await broadcaster.run((chat_id, "hi") for chat_id in users)
+
+    result = run_async(scenario())
+    assert (result.sent, result.failed, result.blocked) == (3, 1, 1)
+    assert pauses == [30]
+    assert sorted(chat_id for chat_id, _ in bot.sent) == [1, 2, 5]
+    # یک بار بعد از flood، یک بار بعد از خطای شبکه، و 3 تلاش دوباره برای 3
+    assert sorted(bot.calls) == [1, 1, 2, 2, 3, 3, 3, 3, 4, 5]
+
+    assert not memory.get_user_by_telegram_id(4).is_active
+    assert memory.get_active_users() == [1, 2, 3, 5]
@@ -0,0 +1,109 @@
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery
+
+READ_RATE = 3
+READ_BURST = 10
+WRITE_RATE = 1
+WRITE_BURST = 5
+MAX_BUCKETS = 50000
+
+THROTTLED_TEXT = "⏳ کمی آهسته‌تر! چند ثانیه صبر کن"
+
+# دکمه‌هایی که در دیتابیس مینویسن
+WRITE_CALLBACKS = ("task_done_", "task_delete_")
+MENU_TEXTS = ("گزارش امروز", "پروفایل شما", "کارهای انجام نشده", "راهنمایی")
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    # token bucket جدا برای خواندن (دستورها، ورق زدن) و نوشتن (ثبت کار، انجام/حذف)
+    # هر bucket فقط [توکن‌ها، زمان آخرین به‌روزرسانی، هشدار داده شده] است
+    # و قدیمی‌ترین‌ها وقتی تعداد از max_buckets بیشتر بشه دور ریخته میشن
+    def __init__(
+        self,
+        read_rate=READ_RATE,
+        read_burst=READ_BURST,
+        write_rate=WRITE_RATE,
+        write_burst=WRITE_BURST,
+        max_buckets=MAX_BUCKETS,
+        exempt=(),
+    ):
+        self.limits = {
+            "read": (read_rate, read_burst),
+            "write": (write_rate, write_burst),
+        }
+        self.max_buckets = max_buckets
+        self.exempt = set(exempt)
+        self.throttled = {"read": 0, "write": 0}
+        self._buckets = OrderedDict()
+
+    def kind(self, event):
+        if isinstance(event, CallbackQuery):
+            if (event.data or "").startswith(WRITE_CALLBACKS):
+                return "write"
+            return "read"
+
+        # دستورها و دکمه‌های منو فقط میخونن؛ متن آزاد یعنی ثبت کار یا اسم
+        text = event.text or ""
+        if text.startswith("/") or text in MENU_TEXTS:
+            return "read"
+        return "write"
+
+    def allow(self, user_id, kind):
+        rate, burst = self.limits[kind]
+        now = time.monotonic()
+        key = (user_id, kind)
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [burst, now, False]
+            if len(self._buckets) > self.max_buckets:
+                # bucket ای که مدتی استفاده نشده به هر حال پر شده بود
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return True, False
+
+        # فقط بار اول بعد از محدود شدن جواب میدیم، بقیه بی‌صدا دور ریخته میشن
+        warn = not bucket[2]
+        bucket[2] = True
+        return False, warn
+
+    async def __call__(self, handler, event, data):
+        user = event.from_user
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+
+        kind = self.kind(event)
+        allowed, warn = self.allow(user.id, kind)
+        if allowed:
+            return await handler(event, data)
+
+        self.throttled[kind] += 1
+        if isinstance(event, CallbackQuery):
+            # بدون جواب، دکمه در کلاینت در حال بارگذاری میمونه
+            await event.answer(THROTTLED_TEXT if warn else None)
+        elif warn:
+            await event.answer(THROTTLED_TEXT)
+
+    def stats(self):
+        return {
+            "read": self.throttled["read"],
+            "write": self.throttled["write"],
+            "buckets": len(self._buckets),
+        }
+
+
+def setup(dp, **kwargs):
+    throttling = ThrottlingMiddleware(**kwargs)
+    dp.message.outer_middleware(throttling)
+    dp.callback_query.outer_middleware(throttling)
+    return throttling
@@ -1,25 +1,167 @@
+from datetime import timezone
+
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
-from aiogram.types import InlineKeyboardButton
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+from cache import TTLCache
+
+
+TASKS_PAGE_SIZE = 10
 
-def tasks_keyboard(tasks):
+
+def tasks_keyboard(tasks, cursor=0, has_next=False):
+    # cursor: id آخرین تسک قبل از این صفحه (0 یعنی صفحه‌ی اول)
     builder = InlineKeyboardBuilder()
 
     for task in tasks:
         builder.row(
             InlineKeyboardButton(
-                text=task["title"], callback_data=f"task_open_{task['id']}"
+                text=task.title, callback_data=f"task_open_{task.id}_{cursor}"
             )
         )
         builder.row(
-            InlineKeyboardButton(text="✅", callback_data=f"task_done_{task['id']}"),
-            InlineKeyboardButton(text="❌", callback_data=f"task_delete_{task['id']}"),
+            InlineKeyboardButton(
+                text="✅", callback_data=f"task_done_{task.id}_{cursor}"
+            ),
+            InlineKeyboardButton(
+                text="❌", callback_data=f"task_delete_{task.id}_{cursor}"
+            ),
+        )
+
+    nav = []
+    if cursor:
+        nav.append(
+            InlineKeyboardButton(text="« قبلی", callback_data=f"task_prev_{cursor}")
+        )
+    if has_next and tasks:
+        nav.append(
+            InlineKeyboardButton(
+                text="بعدی »",
+                callback_data=f"task_next_{tasks[-1].id}_{cursor}",
+            )
         )
+    if nav:
+        builder.row(*nav)
 
     return builder.as_markup()
 
 
+class TaskPagesCache:
+    # telegram_id -> {cursor: صفحه}؛ هر صفحه تسک‌ها و کیبورد ساخته شده‌اش رو نگه میداره
+    # تا بعد از done/delete بدون کوئری و بدون ساخت دوباره‌ی کیبورد ویرایش بشه
+    # هر تغییر صفحه‌های یک کاربر نسلش رو عوض میکنه؛ صفحه‌ای که از دیتابیس خونده
+    # شده فقط وقتی کش میشه که وسط خوندنش تغییری نرسیده باشه
+    def __init__(self, maxsize=5000, ttl=600):
+        self._users = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._generations = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._counter = 0
+
+    def generation(self, telegram_id):
+        return self._generations.get(telegram_id, 0)
+
+    def _bump(self, telegram_id):
+        # شمارنده‌ی سراسری تا نسل کاربری که از کش بیرون افتاده دوباره تکرار نشه
+        self._counter += 1
+        self._generations.set(telegram_id, self._counter)
+
+    def get(self, telegram_id, cursor):
+        pages = self._users.get(telegram_id)
+        if not pages:
+            return None
+        return pages.get(cursor)
+
+    def set(
+        self, telegram_id, cursor, tasks, has_next, prev_cursor=None, generation=None
+    ):
+        page = {
+            "tasks": tasks,
+            "has_next": has_next,
+            "prev": prev_cursor,
+            "markup": tasks_keyboard(tasks, cursor, has_next),
+        }
+        # generation: مقدار generation() قبل از کوئری
+        if generation is not None and generation != self.generation(telegram_id):
+            return page
+
+        pages = self._users.get(telegram_id) or {}
+        pages[cursor] = page
+        self._users.set(telegram_id, pages)
+        return page
+
+    def remove_task(self, telegram_id, task_id):
+        self._bump(telegram_id)
+        pages = self._users.get(telegram_id)
+        if not pages:
+            return
+
+        for cursor, page in list(pages.items()):
+            tasks = [task for task in page["tasks"] if task.id != task_id]
+            if len(tasks) == len(page["tasks"]):
+                continue
+
+            if not tasks:
+                del pages[cursor]
+                continue
+
+            # فقط دو ردیف همین تسک از کیبورد حذف میشه
+            rows = [
+                row
+                for row in _task_rows(page["markup"])
+                if _row_task_id(row) != task_id
+            ]
+            page["tasks"] = tasks
+            page["markup"] = InlineKeyboardMarkup(
+                inline_keyboard=rows + _nav_rows(tasks, cursor, page["has_next"])
+            )
+
+    def add_task(self, telegram_id, task):
+        self._bump(telegram_id)
+        pages = self._users.get(telegram_id)
+        if not pages:
+            return
+
+        # تسک جدید بزرگترین id رو داره پس فقط به صفحه‌ی آخر اضافه میشه
+        for cursor, page in list(pages.items()):
+            # صفحه‌ای که بعد از commit خونده شده خودش این تسک رو داره
+            if page["has_next"] or any(t.id == task.id for t in page["tasks"]):
+                continue
+
+            if len(page["tasks"]) >= TASKS_PAGE_SIZE:
+                del pages[cursor]
+                continue
+
+            tasks = page["tasks"] + [task]
+            rows = _task_rows(page["markup"]) + _task_rows(
+                tasks_keyboard([task], cursor)
+            )
+            page["tasks"] = tasks
+            page["markup"] = InlineKeyboardMarkup(
+                inline_keyboard=rows + _nav_rows(tasks, cursor, False)
+            )
+
+    def invalidate(self, telegram_id):
+        self._bump(telegram_id)
+        self._users.pop(telegram_id)
+
+
+def _task_rows(markup):
+    return [row for row in markup.inline_keyboard if _row_task_id(row) is not None]
+
+
+def _nav_rows(tasks, cursor, has_next):
+    # دکمه‌ی «بعدی» به id آخرین تسک صفحه بستگی داره
+    rows = tasks_keyboard(tasks[-1:], cursor, has_next).inline_keyboard
+    return [row for row in rows if _row_task_id(row) is None]
+
+
+def _row_task_id(row):
+    _, action, value = row[0].callback_data.split("_")[:3]
+    if action in ("open", "done", "delete"):
+        return int(value)
+    return None
+
+
 # def tasks_keyboard(tasks):
 #     builder = InlineKeyboardBuilder()
 
@@ -42,17 +184,163 @@ def tasks_keyboard(tasks):
 #     return builder.as_markup()
 
 
-def main_menu_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="گزارش امروز")],
-            [KeyboardButton(text="پروفایل شما")],
-            [KeyboardButton(text="کارهای انجام نشده")],
-            [KeyboardButton(text="راهنمایی")],
-        ],
-        resize_keyboard=True,
+def utc_str(moment):
+    # done_date و created_at با CURRENT_TIMESTAMP یعنی به وقت UTC ذخیره میشن
+    return moment.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def daily_report_text(day_str, titles, total_smiles):
+    task_lines = [f"✅ {title}" for title in titles]
+    return (
+        f"خسته نباشید 🌱\n\n"
+        f"🗒 گزارش امروز: {day_str}\n\n"
+        + "\n".join(task_lines)
+        + f"\n\n🙂 تعداد لبخندهای امروز: {total_smiles}"
     )
-    return keyboard
+
+
+# ثبت کار: سقف کارهای یک پیام چند کاره و متن هر عدد اولویت
+MAX_TASKS_PER_MESSAGE = 30
+
+PRIORITY_MAP = {"1": "معمولی", "2": "مهم", "3": "فوری"}
+
+# پیام کامل برای پیامی که فقط یک کار داره، و دلیل کوتاه برای هر بلوک پیام چند کاره
+TASK_ERRORS = {
+    "format": (
+        "فرمت درست:\n\n"
+        "تیتر\n#دسته‌بندی (اختیاری)\nعدد اولویت (1 تا 3)\n\n"
+        "یا بدون دسته‌بندی:\nتیتر\nعدد اولویت\n\n"
+        "برای ثبت چند کار با یک پیام، بین کارها یک خط خالی بگذارید"
+    ),
+    "hashtag": "اگر دسته‌بندی می‌نویسی باید دقیقا یک هشتگ باشد\nمثال:\n#کدنویسی",
+    "priority": "عدد اولویت باید 1، 2 یا 3 باشد",
+}
+TASK_ERROR_REASONS = {
+    "format": "باید 2 یا 3 خط باشد",
+    "hashtag": "دسته‌بندی باید دقیقا یک هشتگ باشد",
+    "priority": "عدد اولویت باید 1، 2 یا 3 باشد",
+    "limit": f"بیشتر از {MAX_TASKS_PER_MESSAGE} کار در یک پیام",
+}
+
+
+def split_task_blocks(text):
+    # بلوک‌ها با خط خالی از هم جدا میشن؛ هر بلوک لیست خط‌های غیر خالی است
+    blocks = []
+    current = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line:
+            current.append(line)
+        elif current:
+            blocks.append(current)
+            current = []
+    if current:
+        blocks.append(current)
+
+    # اگه همه‌ی خط‌ها با هم یک کار درست باشن، خط خالی فقط فاصله بوده
+    # (مثلا "تیتر\n\n#دسته\n2")؛ وگرنه هر بلوک جدا بررسی میشه
+    if len(blocks) > 1:
+        lines = [line for block in blocks for line in block]
+        if parse_task(lines)[1] is None:
+            blocks = [lines]
+
+    return blocks
+
+
+def parse_task_blocks(blocks):
+    # خروجی: کارهای درست و یک خط توضیح برای هر بلوک رد شده
+    tasks = []
+    rejected = []
+    for number, lines in enumerate(blocks, start=1):
+        task, error = parse_task(lines)
+        if not error and len(tasks) >= MAX_TASKS_PER_MESSAGE:
+            error = "limit"
+        if error:
+            rejected.append(
+                f"❌ کار {number} ({lines[0][:30]}): {TASK_ERROR_REASONS[error]}"
+            )
+        else:
+            tasks.append(task)
+    return tasks, rejected
+
+
+def bulk_task_text(count, total, rejected):
+    text = f"✅ {count} کار از {total} کار ثبت شد"
+    if rejected:
+        text += "\n\n" + "\n".join(rejected)
+    return text
+
+
+def parse_task(lines):
+    # خروجی: ((title, category, priority), None) یا (None, کلید خطا در TASK_ERRORS)
+    if len(lines) not in (2, 3):
+        return None, "format"
+
+    title = lines[0]
+
+    if len(lines) == 2:
+        category = "نامشخص"
+        priority_num = lines[1]
+    else:
+        hashtags = [word for word in lines[1].split() if word.startswith("#")]
+        if len(hashtags) != 1:
+            return None, "hashtag"
+        category = hashtags[0][1:]
+        priority_num = lines[2]
+
+    if priority_num not in PRIORITY_MAP:
+        return None, "priority"
+
+    return (title, category, priority_num), None
+
+
+EXPORT_FIELDS = (
+    "id",
+    "title",
+    "category",
+    "priority",
+    "created_at",
+    "status",
+    "done_date",
+    "archived",
+)
+
+
+def export_record(task):
+    # یک Task از iter_user_tasks برای فایل /export
+    if task.is_done:
+        status = "done"
+    elif task.is_expired:
+        status = "expired"
+    else:
+        status = "pending"
+
+    return {
+        "id": task.id,
+        "title": task.title,
+        "category": task.category,
+        "priority": task.priority,
+        "created_at": task.created_at,
+        "status": status,
+        "done_date": task.done_date,
+        "archived": bool(task.archived),
+    }
+
+
+# کیبورد ثابت است، یک بار ساخته میشه
+MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="گزارش امروز")],
+        [KeyboardButton(text="پروفایل شما")],
+        [KeyboardButton(text="کارهای انجام نشده")],
+        [KeyboardButton(text="راهنمایی")],
+    ],
+    resize_keyboard=True,
+)
+
+
+def main_menu_keyboard():
+    return MAIN_MENU_KEYBOARD
 
 
 START_MENU = """
@@ -67,8 +355,12 @@ HELP_MENU = """
 #دسته‌بندی
 عدد اولویت (1 تا 3)
 
+برای ثبت چند کار با یک پیام، بین کارها یک خط خالی بگذارید
+
 برای نمایش گزارش امروز /today رو بزنید
 برای دیدن کارها /tasks رو بزنید
+برای دیدن جدول امتیازات /top رو بزنید
+برای گرفتن فایل همه‌ی کارها /export (یا /export json) رو بزنید
 
 برنامه‌نویس: علی حیدری (آقای ربات) ❤️
 برای حمایت از این برنامه میتونید از لینک زیر برام یه کافی بخرین! 
@@ -0,0 +1,73 @@
+import asyncio
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from invalidation import INVALIDATE_PATH
+
+
+def create_app(dp, bot, path="/webhook", secret=None, on_invalidate=None):
+    app = web.Application()
+
+    # آپدیت در پس‌زمینه پردازش میشه و تلگرام فورا جواب 200 میگیره
+    # اگه secret تنظیم شده باشه، هدر X-Telegram-Bot-Api-Secret-Token چک میشه
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret,
+        handle_in_background=True,
+    ).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+
+    # supervisor.py با این مسیر زنده بودن worker ها رو چک میکنه
+    async def health(request):
+        return web.Response(text="ok")
+
+    app.router.add_get("/health", health)
+
+    # worker های دیگه (invalidation.py) کش کاربرهای این worker رو باطل میکنن؛
+    # بدون secret هر کسی میتونست کش‌ها رو خالی کنه، پس اصلا ثبت نمیشه
+    if on_invalidate and secret:
+
+        async def invalidate(request):
+            if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+                return web.Response(status=401)
+            try:
+                users = [int(user) for user in (await request.json())["users"]]
+            except (ValueError, TypeError, KeyError):
+                return web.Response(status=400)
+            on_invalidate(users)
+            return web.Response(text="ok")
+
+        app.router.add_post(INVALIDATE_PATH, invalidate)
+
+    return app
+
+
+async def run_webhook(
+    dp,
+    bot,
+    host="0.0.0.0",
+    port=8080,
+    path="/webhook",
+    secret=None,
+    url=None,
+    on_invalidate=None,
+):
+    app = create_app(dp, bot, path=path, secret=secret, on_invalidate=on_invalidate)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+
+    # بدون url فقط سرور محلی بالا میاد (برای تست با POST کردن Update به همین مسیر)
+    if url:
+        await bot.set_webhook(url.rstrip("/") + path, secret_token=secret)
+
+    print(f"Webhook server listening on {host}:{port}{path}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()